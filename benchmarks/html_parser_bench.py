@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark the HTML parsers used for formatted messages.
+
+Parses the HTML corpus of tests/color_test.py with both the HTMLParser based
+MatrixHtmlParser and the MatrixHtmlTokenizer:
+
+    python3 benchmarks/html_parser_bench.py [rounds]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "tests"))
+
+from color_test import HTML_CORPUS  # noqa: E402
+from matrix.colors import Formatted  # noqa: E402
+
+
+def parse_corpus(fast):
+    for html in HTML_CORPUS:
+        Formatted.from_html(html, fast)
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    messages = rounds * len(HTML_CORPUS)
+    parsers = (("HTMLParser", False), ("tokenizer", True))
+    results = {name: float("inf") for name, _ in parsers}
+
+    # Alternate between the parsers so both see the same machine load.
+    for _ in range(7):
+        for name, fast in parsers:
+            elapsed = timeit.timeit(lambda: parse_corpus(fast), number=rounds)
+            results[name] = min(results[name], elapsed)
+
+    for name, _ in parsers:
+        elapsed = results[name]
+        print("{:>10}: {:.3f}s for {} messages ({:.1f}us per message)".format(
+            name, elapsed, messages, elapsed / messages * 1e6
+        ))
+
+    print("speedup: {:.2f}x".format(
+        results["HTMLParser"] / results["tokenizer"]
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark parsing of long input lines with markdown formatting.
+
+Parses a long pasted message as it would be sent from the input bar:
+
+    python3 benchmarks/markdown_bench.py [line length in kB]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import matrix.globals as G  # noqa: E402
+from matrix._weechat import MockConfig  # noqa: E402
+from matrix.colors import Formatted  # noqa: E402
+
+G.CONFIG = MockConfig()
+
+PARAGRAPH = (
+    "Some **bold** text and *emphasized* text, snake_case_names, a link to "
+    "https://example.org/some_path/*glob* and `inline code` with an escaped "
+    "\\* star. Then a much longer run of plain text that doesn't contain any "
+    "formatting at all, as most of a typical pasted log or message does. "
+)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    line = PARAGRAPH * (size * 1024 // len(PARAGRAPH) + 1)
+    rounds = 10
+
+    elapsed = min(timeit.repeat(
+        lambda: Formatted.from_input_line(line), number=rounds, repeat=3
+    )) / rounds
+
+    print("{} kB line: {:.2f}ms per line ({:.1f} MB/s)".format(
+        len(line) // 1024, elapsed * 1000, len(line) / elapsed / 1e6
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark adding the members of a large room to a room buffer.
+
+The members are added the same way the lazy user loading timer adds them,
+using the mock weechat module so this can run outside of weechat:
+
+    python3 benchmarks/nicklist_bench.py [member count]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import matrix.globals as G  # noqa: E402
+from matrix._weechat import MockConfig  # noqa: E402
+from matrix.buffer import RoomBuffer  # noqa: E402
+from matrix.server import MatrixServer  # noqa: E402
+from nio import MatrixRoom  # noqa: E402
+
+G.CONFIG = MockConfig()
+G.CONFIG.network.max_nicklist_users = 100000
+
+OWN_USER_ID = "@alice:example.org"
+
+
+def create_room(member_count):
+    room = MatrixRoom("!bench:example.org", OWN_USER_ID)
+
+    for i in range(member_count):
+        # Every tenth user shares its local part with another user on a
+        # different homeserver so the nick collision handling is exercised
+        # as well.
+        if i % 10 == 0:
+            user_id = "@user{}:other.org".format(i - 1)
+        else:
+            user_id = "@user{}:example.org".format(i)
+
+        room.add_member(user_id, "User {}".format(i), None)
+
+    return room
+
+
+def main():
+    member_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    room = create_room(member_count)
+    homeserver = MatrixServer._parse_url("example.org", 443)
+    room_buffer = RoomBuffer(room, "example", homeserver, None)
+
+    start = time.perf_counter()
+
+    room_buffer.queue_users(room.users)
+    users = room_buffer.unhandled_users
+
+    while users:
+        batch = [users.pop() for _ in range(min(100, len(users)))]
+        room_buffer.add_users(batch)
+
+    elapsed = time.perf_counter() - start
+
+    print("Added {} members in {:.3f}s ({:.1f}us per member)".format(
+        len(room_buffer.displayed_nicks),
+        elapsed,
+        elapsed / max(len(room_buffer.displayed_nicks), 1) * 1e6
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark the formatting of printed room lines.
+
+Prints messages, notices, emotes and join messages to a room buffer using the
+mock weechat module. The mock doesn't output anything so this only measures
+the work that is done in the script for every line:
+
+    python3 benchmarks/print_bench.py [line count]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import matrix.globals as G  # noqa: E402
+from matrix._weechat import MockConfig  # noqa: E402
+from matrix.buffer import RoomBuffer  # noqa: E402
+from matrix.globals import W  # noqa: E402
+from matrix.server import MatrixServer  # noqa: E402
+from nio import MatrixRoom  # noqa: E402
+
+G.CONFIG = MockConfig()
+G.CONFIG.network.max_nicklist_users = 5000
+
+OWN_USER_ID = "@alice:example.org"
+USER_COUNT = 50
+
+
+def create_room_buffer():
+    room = MatrixRoom("!bench:example.org", OWN_USER_ID)
+
+    for i in range(USER_COUNT):
+        room.add_member("@user{}:example.org".format(i), None, None)
+
+    homeserver = MatrixServer._parse_url("example.org", 443)
+    room_buffer = RoomBuffer(room, "example", homeserver, None)
+    room_buffer.add_users(list(room.users))
+
+    return room_buffer
+
+
+def main():
+    line_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    room_buffer = create_room_buffer()
+    buffer = room_buffer.weechat_buffer
+    users = list(buffer.users.values())
+    now = int(time.time())
+
+    # Only the script side is measured.
+    W.prnt_date_tags = lambda *_: None
+
+    start = time.perf_counter()
+
+    for i in range(line_count):
+        user = users[i % len(users)]
+
+        if i % 4 == 0:
+            buffer.notice(user.nick, "Notice {}".format(i), now)
+        elif i % 4 == 1:
+            buffer.action(user.nick, "waves {}".format(i), now)
+        elif i % 4 == 2:
+            buffer.join(user, now)
+        else:
+            buffer.message(user.nick, "Message {}".format(i), now)
+
+    elapsed = time.perf_counter() - start
+
+    print("Printed {} lines in {:.3f}s ({:.2f}us per line)".format(
+        line_count, elapsed, elapsed / line_count * 1e6
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -32,6 +32,7 @@ if os.path.exists(activate_this):
 import socket
 import ssl
 import textwrap
+import time
 # pylint: disable=redefined-builtin
 from builtins import str
 from itertools import chain
@@ -88,17 +89,29 @@ from matrix.completion import (init_completion, matrix_command_completion_cb,
                                matrix_room_completion_cb)
 from matrix.config import (MatrixConfig, config_log_category_cb,
                            config_log_level_cb, config_server_buffer_cb,
-                           matrix_config_reload_cb, config_pgup_cb)
+                           matrix_config_reload_cb, config_pgup_cb,
+                           matrix_config_change_cb,
+                           config_decryption_threads_cb,
+                           config_max_undecrypted_events_cb,
+                           config_bridge_nick_rules_cb,
+                           config_nick_colors_cb,
+                           config_weechat_colors_cb,
+                           config_conditions_cb,
+                           config_render_cache_cb)
 from matrix.globals import SCRIPT_NAME, SERVERS, W
+from matrix.message_renderer import HIGHLIGHTER
 from matrix.server import (MatrixServer, create_default_server,
                            matrix_config_server_change_cb,
                            matrix_config_server_read_cb,
                            matrix_config_server_write_cb, matrix_timer_cb,
-                           send_cb, matrix_load_users_cb)
+                           send_cb, matrix_load_users_cb,
+                           matrix_to_device_cb)
 from matrix.utf import utf8_decode
-from matrix.utils import server_buffer_prnt, server_buffer_set_title
+from matrix.utils import (CONDITION_CACHE, server_buffer_prnt,
+                          server_buffer_set_title)
 
 from matrix.uploads import UploadsBuffer, upload_cb
+from matrix.workers import worker_pool_fd_cb
 
 try:
     from urllib.parse import urlunparse
@@ -341,6 +354,8 @@ def receive_cb(server_name, file_descriptor):
 
         if response:
             server.handle_response(response)
+            # Handling the response might have queued up to-device messages.
+            server.schedule_to_device_flush()
             break
 
     return W.WEECHAT_RC_OK
@@ -507,8 +522,11 @@ def room_close_cb(data, buffer):
 @utf8_decode
 def matrix_unload_cb():
     for server in SERVERS.values():
+        server.stop_decryption_pool()
         server.config.free()
 
+    HIGHLIGHTER.stop()
+
     G.CONFIG.free()
 
     return W.WEECHAT_RC_OK
@@ -580,6 +598,9 @@ def buffer_switch_cb(_, _signal, buffer_ptr):
         if not room_buffer:
             continue
 
+        server.undecrypted_events.touch_room(room_buffer.room.room_id)
+        room_buffer.last_view_time = time.time()
+
         last_event_id = room_buffer.last_event_id
 
         if room_buffer.should_send_read_marker:
@@ -613,10 +634,13 @@ def typing_notification_cb(data, signal, buffer_ptr):
     This function is called every time the input text is changed.
     It checks if we are on a buffer we own, and if we are sends out a typing
     notification if the room is configured to send them out.
+
+    In encrypted rooms the group session is shared ahead of time as well.
     """
     for server in SERVERS.values():
         room_buffer = server.find_room_from_ptr(buffer_ptr)
         if room_buffer:
+            server.prepare_group_session(room_buffer)
             server.room_send_typing_notice(room_buffer)
             return W.WEECHAT_RC_OK
 
@@ -626,6 +650,16 @@ def typing_notification_cb(data, signal, buffer_ptr):
     return W.WEECHAT_RC_OK
 
 
+def condition_cache_signal_cb(data, signal, buffer_ptr):
+    """Forget the evaluated typing notice and read marker conditions.
+
+    The cached conditions may use the local variables of a buffer, this is
+    called every time they might change.
+    """
+    CONDITION_CACHE.clear()
+    return W.WEECHAT_RC_OK
+
+
 def buffer_command_cb(data, _, command):
     """Override the buffer command to allow switching buffers by short name."""
     command = command[7:].strip()
@@ -704,6 +738,18 @@ if __name__ == "__main__":
         W.hook_signal("buffer_switch", "buffer_switch_cb", "")
         W.hook_signal("input_text_changed", "typing_notification_cb", "")
 
+        for signal in ("buffer_localvar_*", "buffer_renamed", "buffer_moved",
+                       "buffer_closed"):
+            W.hook_signal(signal, "condition_cache_signal_cb", "")
+        W.hook_config("weechat.look.nick_color_*", "config_nick_colors_cb", "")
+        W.hook_config("weechat.color.chat_nick_colors",
+                      "config_nick_colors_cb", "")
+
+        # Colors of weechat.color.* options are resolved when a line is
+        # displayed, only the escapes of these options embed their value.
+        for option in ("irc.color.notice", "logger.color.backlog_line"):
+            W.hook_config(option, "config_weechat_colors_cb", "")
+
         if not SERVERS:
             create_default_server(G.CONFIG)
 
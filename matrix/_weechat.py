@@ -2,6 +2,8 @@ import datetime
 import random
 import string
 
+WEECHAT_RC_OK = 0
+
 WEECHAT_BASE_COLORS = {
     "black":        "0",
     "red":          "1",
@@ -36,6 +38,7 @@ class MockConfig(object):
         'color': {
             'error_message_bg': "",
             'error_message_fg': "",
+            'nick_prefixes': {},
             'quote_bg': "",
             'quote_fg': "",
             'unconfirmed_message_bg': "",
@@ -50,6 +53,7 @@ class MockConfig(object):
             'render': None,
         },
         'look': {
+            'background_highlight_lines': 0,
             'bar_item_typing_notice_prefix': None,
             'busy_sign': None,
             'code_block_margin': None,
@@ -57,8 +61,9 @@ class MockConfig(object):
             'disconnect_sign': None,
             'encrypted_room_sign': None,
             'encryption_warning_sign': None,
+            'fast_html_parser': True,
             'max_typing_notice_item_length': None,
-            'pygments_style': None,
+            'pygments_style': 'native',
             'redactions': None,
             'server_buffer': None,
             'new_channel_position': None,
@@ -68,15 +73,18 @@ class MockConfig(object):
             'debug_buffer': None,
             'debug_category': None,
             'debug_level': None,
+            'decryption_threads': 0,
             'fetch_backlog_on_pgup': None,
             'lag_min_show': None,
             'lag_reconnect': None,
             'lazy_load_room_users': None,
             'max_initial_sync_events': None,
+            'max_member_requests': 8,
             'max_nicklist_users': None,
+            'max_undecrypted_events': 10000,
             'print_unconfirmed_messages': None,
-            'read_markers_conditions': None,
-            'typing_notice_conditions': None,
+            'read_markers_conditions': "${markers_enabled}",
+            'typing_notice_conditions': "${typing_enabled}",
             'autoreconnect_delay_growing': None,
             'autoreconnect_delay_max': None,
         },
@@ -93,6 +101,12 @@ class MockConfig(object):
 
             setattr(self, category, category_object)
 
+        from matrix.utils import BridgeNickRules, DEFAULT_BRIDGE_NICK_RULES
+
+        self.look.bridge_nick_rules = BridgeNickRules.parse(
+            DEFAULT_BRIDGE_NICK_RULES
+        )
+
 
 def color(color_name):
     # type: (str) -> str
@@ -179,7 +193,7 @@ def prefix(prefix_string):
     }
 
     if prefix_string in prefix_to_symbol:
-        return prefix_to_symbol[prefix]
+        return prefix_to_symbol[prefix_string]
 
     return ""
 
@@ -252,9 +266,29 @@ def nicklist_remove_nick(*_, **__):
     return
 
 
+def nicklist_search_group(*args, **kwargs):
+    return buffer_new(args, kwargs)
+
+
 def nicklist_search_nick(*args, **kwargs):
     return buffer_new(args, kwargs)
 
 
 def string_remove_color(message, _):
     return message
+
+
+def hook_fd(*_, **__):
+    return buffer_new()
+
+
+def unhook(*_, **__):
+    return
+
+
+def hdata_get(*_, **__):
+    return ""
+
+
+def hdata_pointer(*_, **__):
+    return None
@@ -17,13 +17,24 @@
 
 from __future__ import unicode_literals
 
+import heapq
 import time
 import attr
 import pprint
 from builtins import super
+from collections import OrderedDict
 from functools import partial
-from collections import deque
-from typing import Dict, List, NamedTuple, Optional, Set
+from itertools import count
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
 from uuid import UUID
 
 from nio import (
@@ -49,16 +60,23 @@ from nio import (
     UnknownEvent,
     FullyReadEvent,
     BadEvent,
+    MatrixUser,
     UnknownBadEvent,
 )
 
 from . import globals as G
+from .completion import UserCompletionIndex
 from .colors import Formatted
 from .config import RedactType, NewChannelPosition
 from .globals import SCRIPT_NAME, SERVERS, W, TYPING_NOTICE_TIMEOUT
 from .utf import utf8_decode
 from .message_renderer import Render
+from .undecrypted import UndecryptedEvents
 from .utils import (
+    CONDITION_CACHE,
+    OrderedSet,
+    SortedSet,
+    cached_color,
     server_ts_to_weechat,
     shorten_sender,
     string_strikethrough,
@@ -66,6 +84,11 @@ from .utils import (
 )
 
 
+# The number of users that spoke most recently a room buffer remembers, they
+# are offered first by the user completion.
+MAX_RECENT_SPEAKERS = 100
+
+
 @attr.s
 class OwnMessages(object):
     sender = attr.ib(type=str)
@@ -139,17 +162,26 @@ def room_buffer_close_cb(server_name, buffer):
         room_id = room_buffer.room.room_id
         server.buffers.pop(room_id, None)
         server.room_buffers.pop(room_id, None)
+        server.undecrypted_events.remove_room(room_id)
+
+        for user_id in list(room_buffer.displayed_nicks):
+            room_buffer.remove_displayed_nick(user_id)
 
     return W.WEECHAT_RC_OK
 
 
 class WeechatUser(object):
-    def __init__(self, nick, host=None, prefix="", join_time=None):
-        # type: (str, str, str, int) -> None
+    __slots__ = (
+        "nick", "host", "prefix", "color", "join_time", "speaking_time"
+    )
+
+    def __init__(self, nick, host=None, prefix="", join_time=None,
+                 color=None):
+        # type: (str, str, str, int, Optional[str]) -> None
         self.nick = nick
         self.host = host
         self.prefix = prefix
-        self.color = W.info_get("nick_color_name", nick)
+        self.color = color or W.info_get("nick_color_name", nick)
         self.join_time = join_time or time.time()
         self.speaking_time = None  # type: Optional[int]
 
@@ -175,10 +207,13 @@ class WeechatUser(object):
 
 
 class RoomUser(WeechatUser):
-    def __init__(self, nick, user_id=None, power_level=0, join_time=None):
-        # type: (str, str, int, int) -> None
+    __slots__ = ()
+
+    def __init__(self, nick, user_id=None, power_level=0, join_time=None,
+                 color=None):
+        # type: (str, str, int, int, Optional[str]) -> None
         prefix = self._get_prefix(power_level)
-        super().__init__(nick, user_id, prefix, join_time)
+        super().__init__(nick, user_id, prefix, join_time, color)
 
     @property
     def power_level(self):
@@ -208,6 +243,113 @@ class RoomUser(WeechatUser):
         return ""
 
 
+class RegisteredUser(object):
+    __slots__ = ("user_id", "display_name", "short_name", "rooms")
+
+    def __init__(self, user_id):
+        # type: (str) -> None
+        self.user_id = user_id
+        self.display_name = None  # type: Optional[str]
+        self.short_name = None  # type: Optional[str]
+        # The number of room buffers that display the user.
+        self.rooms = 0
+
+
+class UserRegistry(object):
+    """Server wide registry of the users shown in room buffers.
+
+    The parts of a user that don't depend on the room, the user_id, the nick
+    picked by the bridge nick rules and the nick color, are computed once and
+    shared between all the rooms of a server. Room buffers only keep the power
+    level and the join and speaking times of their users.
+
+    Users and nick colors are forgotten once no room buffer displays them
+    anymore.
+    """
+
+    def __init__(self):
+        self._users = dict()  # type: Dict[str, RegisteredUser]
+        self._colors = dict()  # type: Dict[str, str]
+        # The number of displayed users that use a nick.
+        self._nicks = dict()  # type: Dict[str, int]
+
+    def __len__(self):
+        return len(self._users)
+
+    def register(self, user_id):
+        # type: (str) -> RegisteredUser
+        """Register that a room buffer displays the user."""
+        user = self._users.get(user_id)
+
+        if user is None:
+            user = RegisteredUser(user_id)
+            self._users[user_id] = user
+
+        user.rooms += 1
+        return user
+
+    def unregister(self, user_id, nick):
+        # type: (str, str) -> None
+        """Register that a room buffer stopped displaying the user under the
+        given nick."""
+        user = self._users.get(user_id)
+
+        if user is not None:
+            user.rooms -= 1
+            if user.rooms <= 0:
+                del self._users[user_id]
+
+        count = self._nicks.get(nick, 0) - 1
+
+        if count > 0:
+            self._nicks[nick] = count
+        else:
+            self._nicks.pop(nick, None)
+            self._colors.pop(nick, None)
+
+    def short_name(self, user):
+        # type: (MatrixUser) -> str
+        """Return the nick the bridge nick rules pick for the user."""
+        registered = self._users.get(user.user_id)
+
+        # Users that aren't displayed anywhere, e.g. the ones waiting to be
+        # added to a nicklist, don't get an entry.
+        if registered is None:
+            return G.CONFIG.look.bridge_nick_rules.nick(
+                user.user_id, user.display_name
+            )
+
+        # The display name might have changed since we picked the nick.
+        if (registered.short_name is None
+                or registered.display_name != user.display_name):
+            registered.display_name = user.display_name
+            registered.short_name = G.CONFIG.look.bridge_nick_rules.nick(
+                user.user_id, user.display_name
+            )
+
+        return registered.short_name
+
+    def nick_color(self, nick):
+        # type: (str) -> str
+        """Return the color of a nick a room buffer starts displaying."""
+        self._nicks[nick] = self._nicks.get(nick, 0) + 1
+        color = self._colors.get(nick)
+
+        if color is None:
+            color = W.info_get("nick_color_name", nick)
+            self._colors[nick] = color
+
+        return color
+
+    def clear_nicks(self):
+        """Forget the nicks picked by the bridge nick rules."""
+        for user in self._users.values():
+            user.short_name = None
+
+    def clear_colors(self):
+        self._colors.clear()
+
+
 class WeechatChannelBuffer(object):
     tags = {
         "message": [SCRIPT_NAME + "_message", "notify_message", "log1"],
@@ -385,10 +527,19 @@ class WeechatChannelBuffer(object):
         self.name = ""
         self.users = {}  # type: Dict[str, WeechatUser]
         self.smart_filtered_nicks = set()  # type: Set[str]
+        # A min-heap of (speaking time, insertion count, user) tuples, users
+        # get a new entry every time they speak, the old ones are skipped when
+        # they reach the top.
+        self._speaking_heap = []  # type: List[Tuple[float, int, WeechatUser]]
+        self._speaking_counter = count()
+        # The nicks of the users that spoke most recently, the most recent
+        # one last.
+        self.recent_speakers = OrderedDict()  # type: OrderedDict[str, None]
 
         self.topic_author = ""
         self.topic_date = None
 
+        self._localvar_type = "private"
         W.buffer_set(self._ptr, "localvar_set_type", "private")
         W.buffer_set(self._ptr, "type", "formatted")
 
@@ -425,6 +576,13 @@ class WeechatChannelBuffer(object):
     def _hdata(self):
         return W.hdata_get("buffer")
 
+    @property
+    def exists(self):
+        # type: () -> bool
+        """Is the weechat buffer still open."""
+        buffers = W.hdata_get_list(self._hdata, "gui_buffers")
+        return bool(W.hdata_check_pointer(self._hdata, buffers, self._ptr))
+
     def add_smart_filtered_nick(self, nick):
         self.smart_filtered_nicks.add(nick)
 
@@ -547,26 +705,30 @@ class WeechatChannelBuffer(object):
         # A message from a non joined user
         return WeechatUser(nick)
 
-    def _print_message(self, user, message, date, tags, extra_prefix=""):
+    def _format_message(self, user, message, extra_prefix=""):
         prefix_string = (
             extra_prefix
             if not user.prefix
             else "{}{}{}{}".format(
                 extra_prefix,
-                W.color(self._get_prefix_color(user.prefix)),
+                cached_color(self._get_prefix_color(user.prefix)),
                 user.prefix,
-                W.color("reset"),
+                cached_color("reset"),
             )
         )
 
         data = "{prefix}{color}{author}{ncolor}\t{msg}".format(
             prefix=prefix_string,
-            color=W.color(user.color),
+            color=cached_color(user.color),
             author=user.nick,
-            ncolor=W.color("reset"),
+            ncolor=cached_color("reset"),
             msg=message,
         )
 
+        return data
+
+    def _print_message(self, user, message, date, tags, extra_prefix=""):
+        data = self._format_message(user, message, extra_prefix)
         self.print_date_tags(data, date, tags)
 
     def message(self, nick, message, date, extra_tags=None, extra_prefix=""):
@@ -576,24 +738,22 @@ class WeechatChannelBuffer(object):
         tags = self._message_tags(user, tags_type) + (extra_tags or [])
         self._print_message(user, message, date, tags, extra_prefix)
 
-        user.update_speaking_time(date)
+        self._user_spoke(user, date)
         self.unmask_smart_filtered_nick(nick)
 
-    def notice(self, nick, message, date, extra_tags=None, extra_prefix=""):
-        # type: (str, str, int, Optional[List[str]], str) -> None
-        user = self._get_user(nick)
+    def _format_notice(self, user, message, extra_prefix=""):
         user_prefix = (
             ""
             if not user.prefix
             else "{}{}{}".format(
-                W.color(self._get_prefix_color(user.prefix)),
+                cached_color(self._get_prefix_color(user.prefix)),
                 user.prefix,
-                W.color("reset"),
+                cached_color("reset"),
             )
         )
 
         user_string = "{}{}{}{}".format(
-            user_prefix, W.color(user.color), user.nick, W.color("reset")
+            user_prefix, cached_color(user.color), user.nick, cached_color("reset")
         )
 
         data = (
@@ -603,17 +763,23 @@ class WeechatChannelBuffer(object):
         ).format(
             extra_prefix=extra_prefix,
             prefix=W.prefix("network"),
-            color=W.color("irc.color.notice"),
-            del_color=W.color("chat_delimiters"),
-            ncolor=W.color("reset"),
+            color=cached_color("irc.color.notice"),
+            del_color=cached_color("chat_delimiters"),
+            ncolor=cached_color("reset"),
             user=user_string,
             message=message,
         )
 
+        return data
+
+    def notice(self, nick, message, date, extra_tags=None, extra_prefix=""):
+        # type: (str, str, int, Optional[List[str]], str) -> None
+        user = self._get_user(nick)
+        data = self._format_notice(user, message, extra_prefix)
         tags = self._message_tags(user, "notice") + (extra_tags or [])
         self.print_date_tags(data, date, tags)
 
-        user.update_speaking_time(date)
+        self._user_spoke(user, date)
         self.unmask_smart_filtered_nick(nick)
 
     def _format_action(self, user, message):
@@ -621,9 +787,9 @@ class WeechatChannelBuffer(object):
             ""
             if not user.prefix
             else "{}{}{}".format(
-                W.color(self._get_prefix_color(user.prefix)),
+                cached_color(self._get_prefix_color(user.prefix)),
                 user.prefix,
-                W.color("reset"),
+                cached_color("reset"),
             )
         )
 
@@ -631,20 +797,22 @@ class WeechatChannelBuffer(object):
             "{nick_prefix}{nick_color}{author}"
             "{ncolor} {msg}").format(
             nick_prefix=nick_prefix,
-            nick_color=W.color(user.color),
+            nick_color=cached_color(user.color),
             author=user.nick,
-            ncolor=W.color("reset"),
+            ncolor=cached_color("reset"),
             msg=message,
         )
         return data
 
-    def _print_action(self, user, message, date, tags, extra_prefix=""):
+    def _format_action_line(self, user, message, extra_prefix=""):
         data = self._format_action(user, message)
-        data = "{extra_prefix}{prefix}{data}".format(
+        return "{extra_prefix}{prefix}{data}".format(
             extra_prefix=extra_prefix,
             prefix=W.prefix("action"),
             data=data)
 
+    def _print_action(self, user, message, date, tags, extra_prefix=""):
+        data = self._format_action_line(user, message, extra_prefix)
         self.print_date_tags(data, date, tags)
 
     def action(self, nick, message, date, extra_tags=None, extra_prefix=""):
@@ -654,7 +822,7 @@ class WeechatChannelBuffer(object):
         tags = self._message_tags(user, tags_type) + (extra_tags or [])
         self._print_action(user, message, date, tags, extra_prefix)
 
-        user.update_speaking_time(date)
+        self._user_spoke(user, date)
         self.unmask_smart_filtered_nick(nick)
 
     @staticmethod
@@ -677,9 +845,14 @@ class WeechatChannelBuffer(object):
 
         return G.CONFIG.color.nick_prefixes.get(prefix, "")
 
-    def _add_user_to_nicklist(self, user):
-        # type: (WeechatUser) -> None
-        nick_pointer = W.nicklist_search_nick(self._ptr, "", user.nick)
+    def _add_user_to_nicklist(self, user, search=True):
+        # type: (WeechatUser, bool) -> None
+        # Users that we don't know about can't be in the nicklist, no need to
+        # search for them.
+        if search:
+            nick_pointer = W.nicklist_search_nick(self._ptr, "", user.nick)
+        else:
+            nick_pointer = None
 
         if not nick_pointer:
             group = W.nicklist_search_group(
@@ -710,27 +883,92 @@ class WeechatChannelBuffer(object):
             "{channel_color}{room}{ncolor}"
         ).format(
             prefix=W.prefix(prefix),
-            color=W.color(user.color),
+            color=cached_color(user.color),
             author=user.nick,
-            ncolor=W.color("reset"),
-            del_color=W.color("chat_delimiters"),
-            host_color=W.color("chat_host"),
+            ncolor=cached_color("reset"),
+            del_color=cached_color("chat_delimiters"),
+            host_color=cached_color("chat_host"),
             host=user.host,
-            action_color=W.color(action_color),
+            action_color=cached_color(action_color),
             message=membership_message,
-            channel_color=W.color("chat_channel"),
+            channel_color=cached_color("chat_channel"),
             room=self.short_name,
         )
 
         return message
 
+    def _track_user(self, user):
+        # type: (WeechatUser) -> None
+        entry = (user.speaking_time or 0, next(self._speaking_counter), user)
+        heapq.heappush(self._speaking_heap, entry)
+
+        # Drop the outdated entries if they start to pile up.
+        if len(self._speaking_heap) > 2 * len(self.users) + 64:
+            self._speaking_heap = [
+                (u.speaking_time or 0, next(self._speaking_counter), u)
+                for u in self.users.values()
+            ]
+            heapq.heapify(self._speaking_heap)
+
+    def _user_spoke(self, user, date):
+        # type: (WeechatUser, int) -> None
+        user.update_speaking_time(date)
+
+        if self.users.get(user.nick) is user:
+            self._track_user(user)
+
+            speakers = self.recent_speakers
+            speakers[user.nick] = None
+            speakers.move_to_end(user.nick)
+
+            if len(speakers) > MAX_RECENT_SPEAKERS:
+                speakers.popitem(last=False)
+
+    def pop_stalest_user(self, older_than):
+        # type: (float) -> Optional[WeechatUser]
+        """Return the user without a power level that spoke the least
+        recently, if they haven't spoken since older_than.
+
+        The user won't be returned again until they speak or rejoin.
+        """
+        heap = self._speaking_heap
+        privileged = []
+        stalest = None
+
+        while heap:
+            speaking_time, _, user = heap[0]
+
+            # The user left or spoke again since the entry was added.
+            if (self.users.get(user.nick) is not user
+                    or (user.speaking_time or 0) != speaking_time):
+                heapq.heappop(heap)
+                continue
+
+            if speaking_time >= older_than:
+                break
+
+            entry = heapq.heappop(heap)
+
+            if user.prefix:
+                privileged.append(entry)
+                continue
+
+            stalest = user
+            break
+
+        for entry in privileged:
+            heapq.heappush(heap, entry)
+
+        return stalest
+
     def join(self, user, date, message=True, extra_tags=None):
         # type: (WeechatUser, int, Optional[bool], Optional[List[str]]) -> None
-        self._add_user_to_nicklist(user)
+        self._add_user_to_nicklist(user, user.nick in self.users)
         self.users[user.nick] = user
+        self._track_user(user)
 
         if len(self.users) > 2:
-            W.buffer_set(self._ptr, "localvar_set_type", "channel")
+            self._set_localvar_type("channel")
 
         if message:
             tags = self._message_tags(user, "join")
@@ -742,6 +980,14 @@ class WeechatChannelBuffer(object):
             self.print_date_tags(msg, date, tags)
             self.add_smart_filtered_nick(user.nick)
 
+    def _set_localvar_type(self, buffer_type):
+        # type: (str) -> None
+        # Every join and leave lands here, only bother weechat if the type
+        # actually changes.
+        if buffer_type != self._localvar_type:
+            self._localvar_type = buffer_type
+            W.buffer_set(self._ptr, "localvar_set_type", buffer_type)
+
     def invite(self, nick, date, extra_tags=None):
         # type: (str, int, Optional[List[str]]) -> None
         user = self._get_user(nick)
@@ -762,7 +1008,7 @@ class WeechatChannelBuffer(object):
         self.remove_user_from_nicklist(user)
 
         if len(self.users) <= 2:
-            W.buffer_set(self._ptr, "localvar_set_type", "private")
+            self._set_localvar_type("private")
 
         if message:
             tags = self._message_tags(user, leave_type)
@@ -775,6 +1021,8 @@ class WeechatChannelBuffer(object):
             self.print_date_tags(msg, date, tags + (extra_tags or []))
             self.remove_smart_filtered_nick(user.nick)
 
+        self.recent_speakers.pop(user.nick, None)
+
         if user.nick in self.users:
             del self.users[user.nick]
 
@@ -797,14 +1045,14 @@ class WeechatChannelBuffer(object):
         ).format(
             prefix=W.prefix("network"),
             nick=user.nick,
-            chan_color=W.color("chat_channel"),
-            ncolor=W.color("reset"),
+            chan_color=cached_color("chat_channel"),
+            ncolor=cached_color("reset"),
             room=self.short_name,
             topic=topic,
         )
 
         self.print_date_tags(data, date, tags)
-        user.update_speaking_time(date)
+        self._user_spoke(user, date)
         self.unmask_smart_filtered_nick(nick)
 
     @property
@@ -815,11 +1063,13 @@ class WeechatChannelBuffer(object):
     def topic(self, topic):
         W.buffer_set(self._ptr, "title", topic)
 
-    def change_topic(self, nick, topic, date, message=True):
+    def change_topic(self, nick, topic, date, message=True, set_title=True):
         if message:
             self._print_topic(nick, topic, date)
 
-        self.topic = topic
+        if set_title:
+            self.topic = topic
+
         self.topic_author = nick
         self.topic_date = date
 
@@ -838,6 +1088,24 @@ class WeechatChannelBuffer(object):
     def type(self):
         return W.buffer_get_string(self._ptr, "localvar_type")
 
+    @property
+    def displayed(self):
+        # type: () -> bool
+        """Is the buffer currently displayed in a window."""
+        return W.buffer_get_integer(self._ptr, "num_displayed") > 0
+
+    @property
+    def hotlist_priority(self):
+        # type: () -> int
+        """The priority of the buffer in the hotlist, -1 if it isn't in the
+        hotlist."""
+        hotlist = W.hdata_pointer(self._hdata, self._ptr, "hotlist")
+
+        if not hotlist:
+            return -1
+
+        return W.hdata_integer(W.hdata_get("hotlist"), hotlist, "priority")
+
     @property
     def short_name(self):
         return W.buffer_get_string(self._ptr, "short_name")
@@ -877,7 +1145,15 @@ class WeechatChannelBuffer(object):
 
 
 class RoomBuffer(object):
-    def __init__(self, room, server_name, homeserver, prev_batch):
+    def __init__(
+        self,
+        room,
+        server_name,
+        homeserver,
+        prev_batch,
+        undecrypted_events=None,
+        user_registry=None
+    ):
         self.room = room
         self.homeserver = homeserver
         self._backlog_pending = False
@@ -886,13 +1162,31 @@ class RoomBuffer(object):
         self.leave_event_id = None  # type: Optional[str]
         self.members_fetched = False
         self.first_view = True
+        self.last_view_time = 0  # type: float
         self.first_backlog_request = True
-        self.unhandled_users = []   # type: List[str]
-        self.inactive_users = []
+        self.unhandled_users = SortedSet(
+            self._nicklist_sort_key
+        )  # type: SortedSet
+        self.inactive_users = OrderedSet()  # type: OrderedSet
+
+        # Buffer metadata that changed while a sync response was handled, it
+        # is pushed to weechat once per sync by update_metadata().
+        self.name_dirty = False
+        self.modes_dirty = False
+        self.pending_topic = None  # type: Optional[str]
+        # The power levels that the nicklist reflects.
+        self.applied_power_levels = {}  # type: Dict[str, int]
+        self.applied_users_default = 0
 
         self.sent_messages_queue = dict()  # type: Dict[UUID, OwnMessage]
         self.printed_before_ack_queue = list()  # type: List[UUID]
-        self.undecrypted_events = deque(maxlen=5000)
+        # The store is shared between all the rooms of a server.
+        self.undecrypted_events = (undecrypted_events
+                                   if undecrypted_events is not None
+                                   else UndecryptedEvents())
+        self.user_registry = (user_registry
+                              if user_registry is not None
+                              else UserRegistry())
 
         self.typing_notice_time = None
         self._typing = False
@@ -908,7 +1202,11 @@ class RoomBuffer(object):
 
         # This dict remembers the connection from a user_id to the name we
         # displayed in the buffer
-        self.displayed_nicks = {}
+        self.displayed_nicks = {}  # type: Dict[str, str]
+        # And the reverse, a nick to user_id mapping, so we can check for
+        # nick collisions without going through all the displayed nicks.
+        self.nick_user_ids = {}  # type: Dict[str, str]
+        self.completion_index = UserCompletionIndex()
         user = shorten_sender(self.room.own_user_id)
 
         self.weechat_buffer = WeechatChannelBuffer(
@@ -940,6 +1238,17 @@ class RoomBuffer(object):
         W.bar_item_update("buffer_modes")
         W.bar_item_update("matrix_modes")
 
+    @property
+    def lazy_load_priority(self):
+        # type: () -> Tuple[bool, int, float]
+        """The sort key of the room for the lazy user loading, lower values
+        get their users added first."""
+        return (
+            not self.weechat_buffer.displayed,
+            -self.weechat_buffer.hotlist_priority,
+            -self.last_view_time,
+        )
+
     @property
     def warning_prefix(self):
         return G.CONFIG.look.encryption_warning_sign
@@ -1012,12 +1321,10 @@ class RoomBuffer(object):
     def read_markers_enabled(self):
         # type: () -> bool
         """Check if read receipts are enabled for this room."""
-        return bool(int(W.string_eval_expression(
+        return CONDITION_CACHE.evaluate(
             G.CONFIG.network.read_markers_conditions,
-            {},
-            {"markers_enabled": str(int(self._read_markers_enabled))},
-            {"type": "condition"}
-        )))
+            {"markers_enabled": str(int(self._read_markers_enabled))}
+        )
 
     @read_markers_enabled.setter
     def read_markers_enabled(self, value):
@@ -1031,6 +1338,46 @@ class RoomBuffer(object):
 
         return user_id
 
+    def speaking_time(self, user_id):
+        # type: (str) -> Optional[float]
+        """Return when the user last spoke, if the user is displayed."""
+        nick = self.displayed_nicks.get(user_id)
+        user = self.weechat_buffer.users.get(nick) if nick else None
+        return user.speaking_time if user else None
+
+    def recent_speakers(self):
+        # type: () -> Iterator[str]
+        """Return the user ids of the users that spoke most recently, the most
+        recent one first."""
+        for nick in reversed(self.weechat_buffer.recent_speakers):
+            user_id = self.nick_user_ids.get(nick)
+
+            if user_id:
+                yield user_id
+
+    def find_user_id(self, nick):
+        # type: (str) -> Optional[str]
+        """Find the user_id of a displayed nick."""
+        return self.nick_user_ids.get(nick)
+
+    def _add_displayed_nick(self, user_id, nick):
+        # type: (str, str) -> None
+        self.displayed_nicks[user_id] = nick
+        self.nick_user_ids[nick] = user_id
+
+    def remove_displayed_nick(self, user_id):
+        # type: (str) -> None
+        """Forget the nick that was displayed for the user_id."""
+        nick = self.displayed_nicks.pop(user_id, None)
+
+        if nick is None:
+            return
+
+        if self.nick_user_ids.get(nick) == user_id:
+            del self.nick_user_ids[nick]
+
+        self.user_registry.unregister(user_id, nick)
+
     def add_user(self, user_id, date, is_state, force_add=False):
         # User is already added don't add him again.
         if user_id in self.displayed_nicks:
@@ -1054,51 +1401,29 @@ class RoomBuffer(object):
         if is_state and not force_add and user.power_level <= 0:
             if (len(self.displayed_nicks) >=
                     G.CONFIG.network.max_nicklist_users):
-                self.inactive_users.append(user_id)
+                self.inactive_users.add(user_id)
                 return
 
-        try:
-            self.inactive_users.remove(user_id)
-        except ValueError:
-            pass
+        self.inactive_users.discard(user_id)
 
-        short_name = shorten_sender(user.user_id)
-
-        # TODO handle this special case for discord bridge users and
-        # freenode bridge users better
-        if (user.user_id.startswith("@_discord_") or
-                user.user_id.startswith("@_slack_") or
-                user.user_id.startswith("@_discordpuppet_") or
-                user.user_id.startswith("@_slackpuppet_") or
-                user.user_id.startswith("@whatsapp_") or
-                user.user_id.startswith("@facebook_") or
-                user.user_id.startswith("@telegram_") or
-                user.user_id.startswith("@signal_") or
-                user.user_id.startswith("@_telegram_") or
-                user.user_id.startswith("@_xmpp_") or
-                user.user_id.startswith("@irc_")):
-            if user.display_name:
-                short_name = user.display_name[0:50]
-        elif user.user_id.startswith("@twilio_"):
-            short_name = shorten_sender(user.user_id[7:])
-        elif user.user_id.startswith("@freenode_"):
-            short_name = shorten_sender(user.user_id[9:])
-        elif user.user_id.startswith("@_ircnet_"):
-            short_name = shorten_sender(user.user_id[8:])
-        elif user.user_id.startswith("@_oftc_"):
-            short_name = shorten_sender(user.user_id[6:])
-        elif user.user_id.startswith("@gitter_"):
-            short_name = shorten_sender(user.user_id[7:])
+        registered = self.user_registry.register(user_id)
+        short_name = self.user_registry.short_name(user)
 
         # TODO make this configurable
-        if not short_name or short_name in self.displayed_nicks.values():
+        if not short_name or short_name in self.nick_user_ids:
             # Use the full user id, but don't include the @
             nick = user_id[1:]
         else:
             nick = short_name
 
-        buffer_user = RoomUser(nick, user_id, user.power_level, date)
-        self.displayed_nicks[user_id] = nick
+        buffer_user = RoomUser(
+            nick,
+            registered.user_id,
+            user.power_level,
+            date,
+            self.user_registry.nick_color(nick)
+        )
+        self._add_displayed_nick(user_id, nick)
 
         if self.room.own_user_id == user_id:
             buffer_user.color = "weechat.color.chat_nick_self"
@@ -1106,14 +1431,44 @@ class RoomBuffer(object):
 
         self.weechat_buffer.join(buffer_user, date, not is_state)
 
+    def add_users(self, user_ids):
+        # type: (Iterable[str]) -> None
+        """Add multiple users from the room state at once."""
+        for user_id in user_ids:
+            self.add_user(user_id, 0, True)
+
+    def _nicklist_sort_key(self, user_id):
+        # type: (str) -> Tuple[str, str]
+        user = self.room.users.get(user_id)
+
+        if not user:
+            return ("", user_id.lower())
+
+        return (
+            RoomUser._get_prefix(user.power_level),
+            self.user_registry.short_name(user).lower(),
+        )
+
+    def queue_users(self, user_ids):
+        # type: (Iterable[str]) -> None
+        """Queue users to be lazily added to the nicklist.
+
+        Weechat inserts a nick into the nicklist by walking the sorted list
+        of nicks of its group until it finds its place. The queue is kept in
+        the reverse nicklist order, this way every nick ends up at the front
+        of its group without walking the list.
+        """
+        self.unhandled_users.update(user_ids)
+
     def handle_membership_events(self, event, is_state):
         date = server_ts_to_weechat(event.server_timestamp)
+        self.completion_index.invalidate()
 
         if event.content["membership"] == "join":
             if (event.state_key not in self.displayed_nicks
                     and event.state_key not in self.inactive_users):
                 if len(self.room.users) > 100:
-                    self.unhandled_users.append(event.state_key)
+                    self.unhandled_users.add(event.state_key)
                     return
 
                 self.add_user(event.state_key, date, is_state)
@@ -1123,17 +1478,18 @@ class RoomBuffer(object):
 
         elif event.content["membership"] == "leave":
             if event.state_key in self.unhandled_users:
-                self.unhandled_users.remove(event.state_key)
+                self.unhandled_users.discard(event.state_key)
                 return
 
+            self.inactive_users.discard(event.state_key)
+
             nick = self.find_nick(event.state_key)
             if event.sender == event.state_key:
                 self.weechat_buffer.part(nick, date, not is_state)
             else:
                 self.weechat_buffer.kick(nick, date, not is_state)
 
-            if event.state_key in self.displayed_nicks:
-                del self.displayed_nicks[event.state_key]
+            self.remove_displayed_nick(event.state_key)
 
             # We left the room, remember the event id of our leave, if we
             # rejoin we get events that came before this event as well as
@@ -1148,7 +1504,27 @@ class RoomBuffer(object):
             self.weechat_buffer.invite(event.state_key, date)
             return
 
-        self.update_buffer_name()
+        self.name_dirty = True
+
+    def update_metadata(self):
+        # type: () -> bool
+        """Push the metadata that changed during the last sync to weechat.
+
+        Returns True if the modes of the room changed and the bar items
+        showing them need to be updated.
+        """
+        if self.name_dirty:
+            self.name_dirty = False
+            self.update_buffer_name()
+
+        if self.pending_topic is not None:
+            self.weechat_buffer.topic = self.pending_topic
+            self.pending_topic = None
+
+        modes_dirty = self.modes_dirty
+        self.modes_dirty = False
+
+        return modes_dirty
 
     def update_buffer_name(self):
         if self.room.is_named:
@@ -1168,11 +1544,14 @@ class RoomBuffer(object):
             # Use placeholder room name
             room_name = 'Empty room (?)'
 
-        self.weechat_buffer.short_name = room_name
+        # Renaming a buffer sends out signals, skip it if nothing changed.
+        if self.weechat_buffer.short_name != room_name:
+            self.weechat_buffer.short_name = room_name
 
         if G.CONFIG.human_buffer_names:
             buffer_name = "{}.{}".format(self.server_name, room_name)
-            self.weechat_buffer.name = buffer_name
+            if self.weechat_buffer.name != buffer_name:
+                self.weechat_buffer.name = buffer_name
 
     def update_canonical_alias_localvar(self):
         W.buffer_set(
@@ -1255,7 +1634,9 @@ class RoomBuffer(object):
             event.topic,
             server_ts_to_weechat(event.server_timestamp),
             not is_state,
+            set_title=False,
         )
+        self.pending_topic = event.topic
 
     @staticmethod
     def get_event_tags(event):
@@ -1271,19 +1652,40 @@ class RoomBuffer(object):
         return tags
 
     def _handle_power_level(self, _):
-        for user_id in self.room.power_levels.users:
-            if user_id in self.displayed_nicks:
-                nick = self.find_nick(user_id)
+        power_levels = self.room.power_levels
+        users_default = power_levels.defaults.users_default
 
-                user = self.weechat_buffer.users[nick]
-                user.power_level = self.room.power_levels.get_user_level(
-                    user_id
-                )
+        # Only look at users whose level changed since the last power level
+        # event, unless the default level changed which can affect everyone.
+        if users_default != self.applied_users_default:
+            changed = list(self.displayed_nicks)
+        else:
+            old_levels = self.applied_power_levels
+            new_levels = power_levels.users
+            changed = [
+                user_id for user_id in set(old_levels) | set(new_levels)
+                if old_levels.get(user_id) != new_levels.get(user_id)
+            ]
+
+        self.applied_power_levels = dict(power_levels.users)
+        self.applied_users_default = users_default
+
+        for user_id in changed:
+            if user_id not in self.displayed_nicks:
+                continue
+
+            user = self.weechat_buffer.users[self.find_nick(user_id)]
+            level = power_levels.get_user_level(user_id)
+
+            if RoomUser._get_prefix(level) == user.prefix:
+                continue
+
+            user.power_level = level
 
-                # There is no way to change the group of a user without
-                # removing him from the nicklist
-                self.weechat_buffer.remove_user_from_nicklist(user)
-                self.weechat_buffer._add_user_to_nicklist(user)
+            # There is no way to change the group of a user without
+            # removing him from the nicklist
+            self.weechat_buffer.remove_user_from_nicklist(user)
+            self.weechat_buffer._add_user_to_nicklist(user)
 
     def handle_state_event(self, event):
         if isinstance(event, RoomMemberEvent):
@@ -1293,9 +1695,9 @@ class RoomBuffer(object):
         elif isinstance(event, PowerLevelsEvent):
             self._handle_power_level(event)
         elif isinstance(event, (RoomNameEvent, RoomAliasEvent)):
-            self.update_buffer_name()
+            self.name_dirty = True
         elif isinstance(event, RoomEncryptionEvent):
-            pass
+            self.modes_dirty = True
 
     def handle_own_message_in_timeline(self, event):
         """Check if our own message is already printed if not print it.
@@ -1331,7 +1733,11 @@ class RoomBuffer(object):
         extra_tags = extra_tags or []
         nick = self.find_nick(event.sender)
 
-        data = Render.message(event.body, event.formatted_body)
+        data = Render.message(
+            event.body,
+            event.formatted_body,
+            partial(self.replace_event_message, event.event_id)
+        )
 
         extra_prefix = (self.warning_prefix if event.decrypted
                         and not event.verified else "")
@@ -1367,17 +1773,20 @@ class RoomBuffer(object):
             extra_prefix
         )
 
+    def _render_media(self, event):
+        if isinstance(event, RoomMessageMedia):
+            return Render.media(event.url, event.body, self.homeserver.geturl())
+
+        return Render.encrypted_media(
+            event.url, event.body, event.key["k"], event.hashes["sha256"],
+            event.iv, self.homeserver.geturl(), event.mimetype,
+        )
+
     def print_room_media(self, event, extra_tags=None):
         extra_tags = extra_tags or []
         nick = self.find_nick(event.sender)
         date = server_ts_to_weechat(event.server_timestamp)
-        if isinstance(event, RoomMessageMedia):
-            data = Render.media(event.url, event.body, self.homeserver.geturl())
-        else:
-            data = Render.encrypted_media(
-                event.url, event.body, event.key["k"], event.hashes["sha256"],
-                event.iv, self.homeserver.geturl(), event.mimetype,
-            )
+        data = self._render_media(event)
 
         extra_prefix = (self.warning_prefix if event.decrypted
                         and not event.verified else "")
@@ -1425,7 +1834,13 @@ class RoomBuffer(object):
         nick = self.find_nick(event.sender)
         date = server_ts_to_weechat(event.server_timestamp)
 
-        data = Render.megolm()
+        server = SERVERS.get(self.server_name)
+
+        if server and server.decrypt_in_background(event):
+            data = Render.megolm_pending()
+        else:
+            data = Render.megolm()
+            self.undecrypted_events.add(self.room.room_id, event)
 
         session_id_tag = SCRIPT_NAME + "_sessionid_" + event.session_id
         self.weechat_buffer.message(
@@ -1435,8 +1850,6 @@ class RoomBuffer(object):
             self.get_event_tags(event) + [session_id_tag] + extra_tags
         )
 
-        self.undecrypted_events.append(event)
-
     def print_bad_event(self, event, extra_tags=None):
         extra_tags = extra_tags or []
         nick = self.find_nick(event.sender)
@@ -1478,10 +1891,7 @@ class RoomBuffer(object):
         if (event.sender not in self.displayed_nicks and
             event.sender in self.room.users):
 
-            try:
-                self.unhandled_users.remove(event.sender)
-            except ValueError:
-                pass
+            self.unhandled_users.discard(event.sender)
 
             self.add_user(event.sender, 0, True, True)
 
@@ -1499,7 +1909,7 @@ class RoomBuffer(object):
             self.handle_membership_events(event, False)
 
         elif isinstance(event, (RoomNameEvent, RoomAliasEvent)):
-            self.update_buffer_name()
+            self.name_dirty = True
 
         elif isinstance(event, RoomTopicEvent):
             self._handle_topic(event, False)
@@ -1532,6 +1942,7 @@ class RoomBuffer(object):
 
         elif isinstance(event, RoomEncryptionEvent):
             self.print_room_encryption(event, extra_tags)
+            self.modes_dirty = True
 
         elif isinstance(event, PowerLevelsEvent):
             # TODO we should print out a message for this event
@@ -1601,9 +2012,9 @@ class RoomBuffer(object):
         message = last_line.message
         message += (" {del_color}<{ncolor}{error_color}Error sending "
                     "message{del_color}>{ncolor}").format(
-            del_color=W.color("chat_delimiters"),
-            ncolor=W.color("reset"),
-            error_color=W.color(color_pair(
+            del_color=cached_color("chat_delimiters"),
+            ncolor=cached_color("reset"),
+            error_color=cached_color(color_pair(
                 G.CONFIG.color.error_message_fg,
                 G.CONFIG.color.error_message_bg)))
 
@@ -1639,42 +2050,128 @@ class RoomBuffer(object):
             new_tags.append(SCRIPT_NAME + "_id_" + new_message.event_id)
             line.tags = new_tags
 
+    @staticmethod
+    def _find_by_event_id_predicate(event_id, line):
+        event_tag = SCRIPT_NAME + "_id_{}".format(event_id)
+        if event_tag in line.tags:
+            return True
+        return False
+
+    def replace_event_message(self, event_id, message):
+        # type: (str, str) -> None
+        """Replace the message of the printed lines of an event line by line.
+
+        The lines are only replaced if the new message has the same number of
+        lines as the printed one.
+        """
+        if not self.weechat_buffer.exists:
+            return
+
+        new_lines = message.split("\n")
+        lines = self.weechat_buffer.find_lines(
+            partial(self._find_by_event_id_predicate, event_id),
+            len(new_lines)
+        )
+
+        if len(lines) != len(new_lines):
+            return
+
+        # The lines are found starting from the newest one.
+        for line, new_line in zip(reversed(lines), new_lines):
+            line.message = new_line
+
+    def _format_decrypted(self, event):
+        # type: (Event) -> Optional[str]
+        """Format a decrypted event the same way the print_* methods would."""
+        user = self.weechat_buffer._get_user(self.find_nick(event.sender))
+        extra_prefix = "" if event.verified else self.warning_prefix
+
+        # Emotes need to be checked before the text messages, see
+        # handle_timeline_event()
+        if isinstance(event, RoomMessageEmote):
+            return self.weechat_buffer._format_action_line(
+                user, event.body, extra_prefix
+            )
+
+        if isinstance(event, RoomMessageText):
+            data = Render.message(event.body, event.formatted_body)
+        elif isinstance(event, RoomMessageNotice):
+            return self.weechat_buffer._format_notice(
+                user, event.body, extra_prefix
+            )
+        elif isinstance(event, (RoomMessageMedia, RoomEncryptedMedia)):
+            data = self._render_media(event)
+        elif isinstance(event, RoomMessageUnknown):
+            data = Render.unknown(event.type, event.content)
+        else:
+            return None
+
+        return self.weechat_buffer._format_message(user, data, extra_prefix)
+
     def replace_undecrypted_line(self, event):
         """Find an undecrypted message in the buffer and replace it with the now
         decrypted event."""
-        # TODO different messages need different formatting
-        # To implement this, refactor out the different formatting code
-        # snippets to a Formatter class and reuse them here.
-        if not isinstance(event, RoomMessageText):
-            return
+        self.replace_undecrypted_lines([event])
 
-        def predicate(event_id, line):
-            event_tag = SCRIPT_NAME + "_id_{}".format(event_id)
-            if event_tag in line.tags:
-                return True
-            return False
+    def replace_undecrypted_lines(self, events):
+        # type: (List[Event]) -> None
+        """Replace the lines of multiple now decrypted events.
+
+        The buffer lines are walked only once, starting from the newest line,
+        until all the events are found. Events that don't get a line of their
+        own, e.g. reactions or redactions, remove their placeholder and are
+        handled like any other timeline event.
+        """
+        replacements = {}
+        unprinted = []
+
+        for event in events:
+            data = self._format_decrypted(event)
+
+            if data is None:
+                unprinted.append(event)
+                data = ""
+
+            replacements[SCRIPT_NAME + "_id_" + event.event_id] = data
 
+        for line in self.weechat_buffer.lines:
+            if not replacements:
+                break
+
+            tags = line.tags
+            tag = next((t for t in tags if t in replacements), None)
+
+            if not tag:
+                continue
+
+            data = replacements.pop(tag)
+            prefix, message = (data.split("\t", 1) if "\t" in data
+                               else ("", data))
+
+            # TODO this isn't right if the data has multiple lines, that is
+            # everything is printed on a single line and newlines are shown
+            # as a space.
+            # Weechat should support deleting lines and printing new ones at
+            # an arbitrary position.
+            # To implement this without weechat support either only handle
+            # single line messages or edit the first line in place, print new
+            # ones at the bottom and sort the buffer lines.
+            line.update(prefix=prefix, message=message)
+
+        for event in unprinted:
+            self.handle_timeline_event(event)
+
+    def undecryptable_line(self, event):
+        # type: (MegolmEvent) -> None
+        """Mark a line whose background decryption failed as undecrypted."""
         lines = self.weechat_buffer.find_lines(
-            partial(predicate, event.event_id)
+            partial(self._find_by_event_id_predicate, event.event_id), 1
         )
 
-        if not lines:
-            return
+        if lines:
+            lines[0].message = Render.megolm()
 
-        formatted = None
-        if event.formatted_body:
-            formatted = Formatted.from_html(event.formatted_body)
-
-        data = formatted.to_weechat() if formatted else event.body
-        # TODO this isn't right if the data has multiple lines, that is
-        # everything is printed on a single line and newlines are shown as a
-        # space.
-        # Weechat should support deleting lines and printing new ones at an
-        # arbitrary position.
-        # To implement this without weechat support either only handle single
-        # line messages or edit the first line in place, print new ones at the
-        # bottom and sort the buffer lines.
-        lines[0].message = data
+        self.undecrypted_events.add(self.room.room_id, event)
 
     def old_message(self, event):
         tags = list(self.weechat_buffer.tags["old_message"])
@@ -1795,9 +2292,9 @@ class RoomBuffer(object):
                     W.buffer_set(self.weechat_buffer._ptr, "hotlist", "-1")
 
         # We didn't handle all joined users, the room display name might still
-        # be outdated because of that, update it now.
+        # be outdated because of that, update it with the rest of the metadata.
         if self.unhandled_users:
-            self.update_buffer_name()
+            self.name_dirty = True
 
     def handle_left_room(self, info):
         self.joined = False
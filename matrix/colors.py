@@ -26,17 +26,20 @@ import textwrap
 # pylint: disable=redefined-builtin
 from builtins import str
 from collections import namedtuple
-from typing import Dict, List, Optional, Union
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import webcolors
 from pygments import highlight
 from pygments.formatter import Formatter, get_style_by_name
+from pygments.lexer import Lexer
 from pygments.lexers import get_lexer_by_name
 from pygments.util import ClassNotFound
 
 from . import globals as G
 from .globals import W
-from .utils import (string_strikethrough,
+from .utils import (cached_color,
+                    string_strikethrough,
                     string_color_and_reset,
                     color_pair,
                     text_block,
@@ -47,15 +50,178 @@ try:
 except ImportError:
     from html.parser import HTMLParser
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping  # type: ignore
+
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+
+class Attributes(Mapping):
+    """The formatting attributes of a FormattedString.
+
+    The boolean attributes are stored as bits of a single integer, the code
+    language and the colors as interned strings. Comparing attributes or
+    checking if any attribute is set boils down to a couple of integer
+    compares.
+
+    The attributes can still be read and set like a dict with a fixed set of
+    keys, iteration follows the order of Attributes.KEYS.
+    """
+
+    __slots__ = ("flags", "code", "fgcolor", "bgcolor")
+
+    BOLD = 1 << 0
+    ITALIC = 1 << 1
+    UNDERLINE = 1 << 2
+    STRIKETHROUGH = 1 << 3
+    PREFORMATTED = 1 << 4
+    QUOTE = 1 << 5
+
+    FLAGS = (
+        ("bold", BOLD),
+        ("italic", ITALIC),
+        ("underline", UNDERLINE),
+        ("strikethrough", STRIKETHROUGH),
+        ("preformatted", PREFORMATTED),
+        ("quote", QUOTE),
+    )
+    VALUES = ("code", "fgcolor", "bgcolor")
+    KEYS = tuple(key for key, _ in FLAGS) + VALUES
+
+    _flag_bits = dict(FLAGS)
+    _key_set = frozenset(KEYS)
+
+    def __init__(self, attributes=None):
+        # type: (Optional[Mapping[str, Union[bool, Optional[str]]]]) -> None
+        self.flags = 0
+        self.code = None  # type: Optional[str]
+        self.fgcolor = None  # type: Optional[str]
+        self.bgcolor = None  # type: Optional[str]
+
+        if attributes:
+            self.update(attributes)
+
+    def __getitem__(self, key):
+        flag = self._flag_bits.get(key)
+
+        if flag:
+            return bool(self.flags & flag)
+
+        if key in self.VALUES:
+            return getattr(self, key)
+
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        flag = self._flag_bits.get(key)
+
+        if flag:
+            if value:
+                self.flags |= flag
+            else:
+                self.flags &= ~flag
+        elif key in self.VALUES:
+            if isinstance(value, str):
+                value = intern(value)
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __contains__(self, key):
+        return key in self._key_set
+
+    def __eq__(self, other):
+        if isinstance(other, Attributes):
+            return (
+                self.flags == other.flags
+                and self.code == other.code
+                and self.fgcolor == other.fgcolor
+                and self.bgcolor == other.bgcolor
+            )
+        return Mapping.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self):
+        return "Attributes({!r})".format(dict(self.items()))
+
+    def update(self, attributes):
+        # type: (Mapping[str, Union[bool, Optional[str]]]) -> None
+        if isinstance(attributes, Attributes):
+            self.flags = attributes.flags
+            self.code = attributes.code
+            self.fgcolor = attributes.fgcolor
+            self.bgcolor = attributes.bgcolor
+            return
+
+        for key, value in attributes.items():
+            self[key] = value
+
+    def copy(self):
+        # type: () -> Attributes
+        attributes = Attributes.__new__(Attributes)
+        attributes.flags = self.flags
+        attributes.code = self.code
+        attributes.fgcolor = self.fgcolor
+        attributes.bgcolor = self.bgcolor
+        return attributes
+
+    def is_default(self):
+        # type: () -> bool
+        return (
+            not self.flags
+            and self.code is None
+            and self.fgcolor is None
+            and self.bgcolor is None
+        )
+
+    def active(self):
+        """Iterate over the attributes that are set, in the order of KEYS."""
+        flags = self.flags
+
+        if flags:
+            for key, flag in self.FLAGS:
+                if flags & flag:
+                    yield key, True
+
+        for key in self.VALUES:
+            value = getattr(self, key)
+            if value:
+                yield key, value
+
 
 class FormattedString:
     __slots__ = ("text", "attributes")
 
     def __init__(self, text, attributes):
-        self.attributes = DEFAULT_ATTRIBUTES.copy()
-        self.attributes.update(attributes)
+        # type: (str, Mapping[str, Union[bool, Optional[str]]]) -> None
+        self.attributes = Attributes(attributes)
         self.text = text
 
+    @classmethod
+    def shared(cls, text, attributes):
+        # type: (str, Attributes) -> FormattedString
+        """Create a formatted string that uses the attributes without copying
+        them, they must not be modified afterwards."""
+        formatted_string = cls.__new__(cls)
+        formatted_string.attributes = attributes
+        formatted_string.text = text
+        return formatted_string
+
 
 class Formatted(object):
     def __init__(self, substrings):
@@ -72,7 +238,7 @@ class Formatted(object):
     def is_formatted(self):
         # type: (Formatted) -> bool
         for string in self.substrings:
-            if string.attributes != DEFAULT_ATTRIBUTES:
+            if not string.attributes.is_default():
                 return True
         return False
 
@@ -91,25 +257,7 @@ class Formatted(object):
         # If this is false, only IRC formatting characters will be parsed.
         do_markdown = G.CONFIG.look.markdown_input
 
-        # Disallow backticks in URLs so that code blocks are unaffected by the
-        # URL handling
-        url_regex = r"\b[a-z]+://[^\s`]+"
-
-        # Escaped things are not markdown delimiters, so substitute them away
-        # when (quickly) looking for the last delimiters in the line.
-        # Additionally, URLs are ignored for the purposes of markdown
-        # delimiters.
-        # Note that the replacement needs to be the same length as the original
-        # for the indices to be correct.
-        escaped_masked = re.sub(
-            r"\\[\\*_`]|(?:" + url_regex + ")",
-            lambda m: "a" * len(m.group(0)),
-            line
-        )
-
-        def last_match_index(regex, offset_in_match):
-            matches = list(re.finditer(regex, escaped_masked))
-            return matches[-1].span()[0] + offset_in_match if matches else -1
+        last_index = markdown_closing_indexes(line)
 
         # 'needs_word': whether the wrapper must surround words, for example
         #   '*italic*' and not '* not-italic *'.
@@ -117,25 +265,25 @@ class Formatted(object):
         wrappers = {
             "**": {
                 "key": "bold",
-                "last_index": last_match_index(r"\S\*\*", 1),
+                "last_index": last_index["**"],
                 "needs_word": True,
                 "validate": lambda attrs: not attrs["code"],
             },
             "*": {
                 "key": "italic",
-                "last_index": last_match_index(r"\S\*($|[^*])", 1),
+                "last_index": last_index["*"],
                 "needs_word": True,
                 "validate": lambda attrs: not attrs["code"],
             },
             "_": {
                 "key": "italic",
-                "last_index": last_match_index(r"\S_", 1),
+                "last_index": last_index["_"],
                 "needs_word": True,
                 "validate": lambda attrs: not attrs["code"],
             },
             "`": {
                 "key": "code",
-                "last_index": last_match_index(r"`", 0),
+                "last_index": last_index["`"],
                 "needs_word": False,
                 "validate": lambda attrs: True,
             }
@@ -154,7 +302,7 @@ class Formatted(object):
         escapable_chars.add("\\")
 
         # Collect URL spans
-        url_spans = [m.span() for m in re.finditer(url_regex, line)]
+        url_spans = [m.span() for m in INPUT_URL_REGEX.finditer(line)]
         url_spans.reverse()  # we'll be popping from the end
 
         # Whether we are currently in a URL
@@ -184,7 +332,7 @@ class Formatted(object):
             # IRC bold/italic/underline
             elif line[i] in irc_toggles and not attributes["code"]:
                 if text:
-                    substrings.append(FormattedString(text, attributes.copy()))
+                    substrings.append(FormattedString(text, attributes))
                 text = ""
                 key = irc_toggles[line[i]]
                 attributes[key] = not attributes[key]
@@ -193,7 +341,7 @@ class Formatted(object):
             # IRC reset
             elif line[i] == "\x0F" and not attributes["code"]:
                 if text:
-                    substrings.append(FormattedString(text, attributes.copy()))
+                    substrings.append(FormattedString(text, attributes))
                 text = ""
                 # Reset all the attributes
                 attributes = DEFAULT_ATTRIBUTES.copy()
@@ -202,7 +350,7 @@ class Formatted(object):
             # IRC color
             elif line[i] == "\x03" and not attributes["code"]:
                 if text:
-                    substrings.append(FormattedString(text, attributes.copy()))
+                    substrings.append(FormattedString(text, attributes))
                 text = ""
                 i = i + 1
 
@@ -259,7 +407,7 @@ class Formatted(object):
                                     if descriptor["key"] == "code":
                                         text = re.sub(r"\s+", " ", text.strip())
                                     substrings.append(
-                                        FormattedString(text, attributes.copy()))
+                                        FormattedString(text, attributes))
                                 text = ""
                                 attributes[descriptor["key"]] = False
                                 i = i + l
@@ -274,7 +422,7 @@ class Formatted(object):
                                     not descriptor["needs_word"]):
                             if text:
                                 substrings.append(
-                                    FormattedString(text, attributes.copy()))
+                                    FormattedString(text, attributes))
                             text = ""
                             attributes[descriptor["key"]] = True
                             i = i + l
@@ -292,10 +440,20 @@ class Formatted(object):
                     text = text + line[i]
                     i = i + 1
 
-            # Normal text
+            # Normal text, copy everything up to the next character that might
+            # need special handling at once. Stop at the next URL boundary as
+            # well so the 'in_url' flag stays correct.
             else:
-                text = text + line[i]
-                i = i + 1
+                match = INPUT_SPECIAL_CHARS.search(line, i + 1)
+                end = match.start() if match else len(line)
+
+                if url_spans:
+                    url_start, url_end = url_spans[-1]
+                    end = min(end, url_start if i < url_start else url_end)
+
+                end = max(end, i + 1)
+                text = text + line[i:end]
+                i = end
 
         if text:
             substrings.append(FormattedString(text, attributes))
@@ -303,9 +461,17 @@ class Formatted(object):
         return cls(substrings)
 
     @classmethod
-    def from_html(cls, html):
-        # type: (str) -> Formatted
-        parser = MatrixHtmlParser()
+    def from_html(cls, html, fast=None):
+        # type: (str, Optional[bool]) -> Formatted
+        """Parse a Matrix HTML message.
+
+        Uses the MatrixHtmlTokenizer unless fast is False, by default this is
+        controlled by the look.fast_html_parser option.
+        """
+        if fast is None:
+            fast = G.CONFIG.look.fast_html_parser
+
+        parser = MatrixHtmlTokenizer() if fast else MatrixHtmlParser()
         parser.feed(html)
         return cls(parser.get_substrings())
 
@@ -365,15 +531,16 @@ class Formatted(object):
 
         def format_string(formatted_string):
             text = formatted_string.text
-            attributes = formatted_string.attributes.copy()
+            attributes = formatted_string.attributes
+            preformatted = attributes.flags & Attributes.PREFORMATTED
 
             # Escape HTML tag characters
             text = text.replace("&", "&amp;") \
                        .replace("<", "&lt;") \
                        .replace(">", "&gt;")
 
-            if attributes["code"]:
-                if attributes["preformatted"]:
+            if attributes.code:
+                if preformatted:
                     # XXX: This can't really happen since there's no way of
                     # creating preformatted code blocks in weechat (because
                     # there is not multiline input), but I'm creating this
@@ -382,22 +549,21 @@ class Formatted(object):
                     pass
                 else:
                     text = add_attribute(text, "code", True)
-                    attributes.pop("code")
 
-            if attributes["fgcolor"] or attributes["bgcolor"]:
+            if attributes.fgcolor or attributes.bgcolor:
                 text = add_color(
                     text,
-                    attributes["fgcolor"],
-                    attributes["bgcolor"]
+                    attributes.fgcolor,
+                    attributes.bgcolor
                 )
 
-                if attributes["fgcolor"]:
-                    attributes.pop("fgcolor")
+            for key, value in attributes.active():
+                if key in ("fgcolor", "bgcolor"):
+                    continue
 
-                if attributes["bgcolor"]:
-                    attributes.pop("bgcolor")
+                if key == "code" and not preformatted:
+                    continue
 
-            for key, value in attributes.items():
                 text = add_attribute(text, key, value)
 
             return text
@@ -423,27 +589,36 @@ class Formatted(object):
         plain_string = map(format_string, self.substrings)
         return "".join(plain_string)
 
-    def to_weechat(self):
+    def to_weechat(self, highlight_code=None):
+        """Convert the formatted string to a string for weechat's print
+        functions.
+
+        Code blocks are syntax highlighted with highlight_code(code, lexer,
+        formatter), if it returns None the block is shown without
+        highlighting.
+        """
+        highlight_code = highlight_code or highlight_code_block
+
         def add_attribute(string, name, value, attributes):
             if not value:
                 return string
             elif name == "bold":
                 return "{bold_on}{text}{bold_off}".format(
-                    bold_on=W.color("bold"),
+                    bold_on=cached_color("bold"),
                     text=string,
-                    bold_off=W.color("-bold"),
+                    bold_off=cached_color("-bold"),
                 )
             elif name == "italic":
                 return "{italic_on}{text}{italic_off}".format(
-                    italic_on=W.color("italic"),
+                    italic_on=cached_color("italic"),
                     text=string,
-                    italic_off=W.color("-italic"),
+                    italic_off=cached_color("-italic"),
                 )
             elif name == "underline":
                 return "{underline_on}{text}{underline_off}".format(
-                    underline_on=W.color("underline"),
+                    underline_on=cached_color("underline"),
                     text=string,
-                    underline_off=W.color("-underline"),
+                    underline_off=cached_color("-underline"),
                 )
             elif name == "strikethrough":
                 return string_strikethrough(string)
@@ -463,9 +638,9 @@ class Formatted(object):
                 else:
                     # Don't wrap, just add quote markers to all lines
                     return "{color_on}{text}{color_off}".format(
-                        color_on=W.color(quote_pair),
+                        color_on=cached_color(quote_pair),
                         text="> " + W.string_remove_color(string.replace("\n", "\n> "), ""),
-                        color_off=W.color("resetcolor")
+                        color_off=cached_color("resetcolor")
                     )
             elif name == "code":
                 code_color_pair = color_pair(
@@ -477,10 +652,9 @@ class Formatted(object):
 
                 if attributes["preformatted"]:
                     # code block
+                    lexer = get_lexer(value)
 
-                    try:
-                        lexer = get_lexer_by_name(value)
-                    except ClassNotFound:
+                    if not lexer:
                         if G.CONFIG.look.code_blocks:
                             return colored_text_block(
                                 string,
@@ -490,38 +664,43 @@ class Formatted(object):
                             return string_color_and_reset(string,
                                                           code_color_pair)
 
-                    try:
-                        style = get_style_by_name(G.CONFIG.look.pygments_style)
-                    except ClassNotFound:
-                        style = "native"
+                    formatter = get_formatter(G.CONFIG.look.pygments_style)
 
                     if G.CONFIG.look.code_blocks:
                         code_block = text_block(string, margin=margin)
                     else:
                         code_block = string
 
-                    # highlight adds a newline to the end of the string, remove
-                    # it from the output
-                    highlighted_code = highlight(
+                    highlighted_code = highlight_code(
                         code_block,
                         lexer,
-                        WeechatFormatter(style=style)
-                    ).rstrip()
+                        formatter
+                    )
+
+                    if highlighted_code is None:
+                        # The block is highlighted later on, until then run
+                        # it through the plain text lexer so the lines are
+                        # laid out the same way.
+                        highlighted_code = highlight_code_block(
+                            code_block,
+                            get_lexer("text"),
+                            formatter
+                        )
 
                     return highlighted_code
                 else:
                     return string_color_and_reset(string, code_color_pair)
             elif name == "fgcolor":
                 return "{color_on}{text}{color_off}".format(
-                    color_on=W.color(value),
+                    color_on=cached_color(value),
                     text=string,
-                    color_off=W.color("resetcolor"),
+                    color_off=cached_color("resetcolor"),
                 )
             elif name == "bgcolor":
                 return "{color_on}{text}{color_off}".format(
-                    color_on=W.color("," + value),
+                    color_on=cached_color("," + value),
                     text=string,
-                    color_off=W.color("resetcolor"),
+                    color_off=cached_color("resetcolor"),
                 )
             else:
                 return string
@@ -533,20 +712,14 @@ class Formatted(object):
             # We need to handle strikethrough first, since doing
             # a strikethrough followed by other attributes succeeds in the
             # terminal, but doing it the other way around results in garbage.
-            if "strikethrough" in attributes:
-                text = add_attribute(
-                    text,
-                    "strikethrough",
-                    attributes["strikethrough"],
-                    attributes
-                )
-                attributes.pop("strikethrough")
+            if attributes.flags & Attributes.STRIKETHROUGH:
+                text = string_strikethrough(text)
 
             def indent(text, prefix):
                 return prefix + text.replace("\n", "\n{}".format(prefix))
 
-            for key, value in attributes.items():
-                if not value:
+            for key, value in attributes.active():
+                if key == "strikethrough":
                     continue
 
                 # Don't use textwrap to quote the code
@@ -584,17 +757,114 @@ class Formatted(object):
         return "".join(strings).strip()
 
 
-DEFAULT_ATTRIBUTES = {
-    "bold": False,
-    "italic": False,
-    "underline": False,
-    "strikethrough": False,
-    "preformatted": False,
-    "quote": False,
-    "code": None,
-    "fgcolor": None,
-    "bgcolor": None,
-}  # type: Dict[str, Union[bool, Optional[str]]]
+DEFAULT_ATTRIBUTES = Attributes()
+
+
+@lru_cache(maxsize=64)
+def get_lexer(language):
+    # type: (str) -> Optional[Lexer]
+    """Get the pygments lexer for a code block language, None if pygments
+    doesn't know the language."""
+    try:
+        return get_lexer_by_name(language)
+    except ClassNotFound:
+        return None
+
+
+@lru_cache(maxsize=4)
+def get_formatter(style_name):
+    # type: (str) -> WeechatFormatter
+    """Get the formatter for a pygments style. Creating a formatter converts
+    the colors of the whole style, the formatters are cached and need to be
+    cleared if the weechat colors change."""
+    try:
+        style = get_style_by_name(style_name)
+    except ClassNotFound:
+        style = "native"
+
+    return WeechatFormatter(style=style)
+
+
+def highlight_code_block(code, lexer, formatter):
+    # type: (str, Lexer, WeechatFormatter) -> str
+    """Syntax highlight a code block.
+
+    This doesn't use the weechat API so it may run on a worker thread as long
+    as the formatter was created on the main thread.
+    """
+    # highlight adds a newline to the end of the string, remove it from the
+    # output
+    return highlight(code, lexer, formatter).rstrip()
+
+
+# Disallow backticks in URLs so that code blocks are unaffected by the URL
+# handling
+INPUT_URL_REGEX = re.compile(r"\b[a-z]+://[^\s`]+")
+
+# Characters of the input line that might need special handling, runs of other
+# characters are copied verbatim.
+INPUT_SPECIAL_CHARS = re.compile(r"[\\\x02\x03\x0f\x1d\x1f*_`]")
+
+# Escaped characters and URLs are matched as a whole so the markdown delimiters
+# inside of them are skipped.
+MARKDOWN_DELIMITERS = re.compile(
+    r"(\\[\\*_`]|" + INPUT_URL_REGEX.pattern + r")|[*_`]"
+)
+
+
+def markdown_closing_indexes(line):
+    # type: (str) -> Dict[str, int]
+    r"""Find the last position at which each markdown delimiter could close.
+
+    Returns the index of the last closing "**", "*", "_" and "`" delimiter,
+    or -1 if there is none. Escaped delimiters and delimiters inside of URLs
+    don't count, closing emphasis delimiters need to follow a non whitespace
+    character.
+
+    The line is scanned once, for every delimiter type the result is the same
+    as the last non-overlapping match of the regular expressions \S\*\*,
+    \S\*($|[^*]), \S_ and ` over the line with escapes and URLs masked out.
+    """
+    last_index = {"**": -1, "*": -1, "_": -1, "`": -1}
+
+    # Where the next non-overlapping match of a pattern may start.
+    next_bold = next_emph = next_underscore = 0
+    # The end of the last escape or URL, those count as non whitespace.
+    masked_end = 0
+    length = len(line)
+
+    for match in MARKDOWN_DELIMITERS.finditer(line):
+        if match.group(1):
+            masked_end = match.end()
+            continue
+
+        i = match.start()
+        char = line[i]
+
+        if char == "`":
+            last_index["`"] = i
+            continue
+
+        start = i - 1
+
+        if start < 0 or (start >= masked_end and line[start].isspace()):
+            continue
+
+        if char == "_":
+            if start >= next_underscore:
+                last_index["_"] = i
+                next_underscore = i + 1
+
+        elif i + 1 < length and line[i + 1] == "*":
+            if start >= next_bold:
+                last_index["**"] = i
+                next_bold = i + 2
+
+        elif start >= next_emph:
+            last_index["*"] = i
+            next_emph = i + 2
+
+    return last_index
 
 
 class MatrixHtmlParser(HTMLParser):
@@ -622,7 +892,7 @@ class MatrixHtmlParser(HTMLParser):
 
     def _toggle_attribute(self, attribute):
         if self.text:
-            self.add_substring(self.text, self.attributes.copy())
+            self.add_substring(self.text, self.attributes)
         self.text = ""
         self.attributes[attribute] = not self.attributes[attribute]
 
@@ -650,20 +920,20 @@ class MatrixHtmlParser(HTMLParser):
             lang = lang or "unknown"
 
             if self.text:
-                self.add_substring(self.text, self.attributes.copy())
+                self.add_substring(self.text, self.attributes)
             self.text = ""
             self.attributes["code"] = lang
         elif tag == "p":
             if self.text:
-                self.add_substring(self.text, self.attributes.copy())
+                self.add_substring(self.text, self.attributes)
             self.text = "\n"
-            self.add_substring(self.text, DEFAULT_ATTRIBUTES.copy())
+            self.add_substring(self.text, DEFAULT_ATTRIBUTES)
             self.text = ""
         elif tag == "br":
             if self.text:
-                self.add_substring(self.text, self.attributes.copy())
+                self.add_substring(self.text, self.attributes)
             self.text = "\n"
-            self.add_substring(self.text, DEFAULT_ATTRIBUTES.copy())
+            self.add_substring(self.text, DEFAULT_ATTRIBUTES)
             self.text = ""
         elif tag == "font":
             for key, value in attrs:
@@ -674,7 +944,7 @@ class MatrixHtmlParser(HTMLParser):
                         continue
 
                     if self.text:
-                        self.add_substring(self.text, self.attributes.copy())
+                        self.add_substring(self.text, self.attributes)
                     self.text = ""
                     self.attributes["fgcolor"] = color
 
@@ -684,7 +954,7 @@ class MatrixHtmlParser(HTMLParser):
                         continue
 
                     if self.text:
-                        self.add_substring(self.text, self.attributes.copy())
+                        self.add_substring(self.text, self.attributes)
                     self.text = ""
                     self.attributes["bgcolor"] = color
 
@@ -704,17 +974,17 @@ class MatrixHtmlParser(HTMLParser):
             self._toggle_attribute("preformatted")
         elif tag == "code":
             if self.text:
-                self.add_substring(self.text, self.attributes.copy())
+                self.add_substring(self.text, self.attributes)
             self.text = ""
             self.attributes["code"] = None
         elif tag == "blockquote":
             self._toggle_attribute("quote")
             self.text = "\n"
-            self.add_substring(self.text, DEFAULT_ATTRIBUTES.copy())
+            self.add_substring(self.text, DEFAULT_ATTRIBUTES)
             self.text = ""
         elif tag == "font":
             if self.text:
-                self.add_substring(self.text, self.attributes.copy())
+                self.add_substring(self.text, self.attributes)
             self.text = ""
             self.attributes["fgcolor"] = None
         else:
@@ -731,11 +1001,221 @@ class MatrixHtmlParser(HTMLParser):
 
     def get_substrings(self):
         if self.text:
-            self.add_substring(self.text, self.attributes.copy())
+            self.add_substring(self.text, self.attributes)
 
         return self.substrings
 
 
+class MatrixHtmlTokenizer(MatrixHtmlParser):
+    """A faster replacement for the HTMLParser based MatrixHtmlParser.
+
+    Matrix HTML is a small, well formed subset of HTML, it's split into tags
+    and text using a couple of regular expressions in a single pass. Text is
+    collected in a list and joined once per substring, the attributes are
+    only copied when a tag changes them and are shared by the substrings
+    that use them. The result is the same as the one of MatrixHtmlParser.
+
+    Input that might need the more elaborate error handling of HTMLParser
+    (comments, declarations, stray "<" characters, raw text elements, ...)
+    is passed to HTMLParser instead.
+    """
+
+    _tag = re.compile(
+        r"<(?:"
+        r"(?P<start>[a-zA-Z][a-zA-Z0-9-]*)(?P<attrs>(?:\s+"
+        r"[a-zA-Z_:][-a-zA-Z0-9_:.]*"
+        r"(?:\s*=\s*(?:\"[^\"]*\"|'[^']*'|[^\s\"'=<>`/]+))?)*)"
+        r"\s*(?P<close>/?)"
+        r"|/(?P<end>[a-zA-Z][a-zA-Z0-9-]*)\s*"
+        r")>"
+    )
+    _attr = re.compile(
+        r"([a-zA-Z_:][-a-zA-Z0-9_:.]*)"
+        r"(?:\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s\"'=<>`/]+)))?"
+    )
+    _reference_end = re.compile(r"[\s;]")
+    # Comments, declarations, processing instructions and elements whose
+    # content HTMLParser doesn't parse as HTML.
+    _html_parser_syntax = re.compile(r"<[!?]|<(?:script|style)\b",
+                                     re.IGNORECASE)
+    _flags = {
+        "strong": "bold",
+        "em": "italic",
+        "u": "underline",
+        "del": "strikethrough",
+        "blockquote": "quote",
+        "pre": "preformatted",
+    }
+
+    def __init__(self):  # pylint: disable=super-init-not-called
+        # HTMLParser is only set up if the message needs it, see feed().
+        self.text = ""  # type: str
+        self.substrings = []  # type: List[FormattedString]
+        self._pieces = []  # type: List[str]
+        self._attributes = DEFAULT_ATTRIBUTES
+
+    def _needs_html_parser(self, data):
+        # type: (str) -> bool
+        if "<" in data and self._html_parser_syntax.search(data):
+            return True
+
+        # HTMLParser holds back text with a trailing, possibly incomplete,
+        # character reference. The check is repeated once the position of
+        # the last tag is known, this catches the common case early.
+        ampersand = data.rfind("&", len(data) - 34)
+
+        return (
+            ampersand > data.rfind(">")
+            and not self._reference_end.search(data, ampersand)
+        )
+
+    def _parse(self, data):
+        # type: (str) -> bool
+        """Parse the message, returns False if it needs to be parsed by
+        HTMLParser."""
+        tag = self._tag
+        position = 0
+
+        while True:
+            start = data.find("<", position)
+
+            if start < 0:
+                ampersand = data.rfind("&", max(position, len(data) - 34))
+
+                if (ampersand >= 0
+                        and not self._reference_end.search(data, ampersand)):
+                    return False
+
+                if position < len(data):
+                    self._add_text(data[position:])
+
+                return True
+
+            if start > position:
+                self._add_text(data[position:start])
+
+            match = tag.match(data, start)
+
+            if not match:
+                return False
+
+            end_tag = match.group("end")
+
+            if end_tag:
+                self._end_tag(end_tag.lower())
+            else:
+                name = match.group("start").lower()
+                self._start_tag(name, match.group("attrs"))
+
+                if match.group("close"):
+                    self._end_tag(name)
+
+            position = match.end()
+
+    def _attribute_values(self, attrs):
+        # type: (str) -> List[Tuple[str, Optional[str]]]
+        attributes = []
+
+        for match in self._attr.finditer(attrs):
+            key, double_quoted, single_quoted, unquoted = match.groups()
+
+            if double_quoted is not None:
+                value = double_quoted  # type: Optional[str]
+            elif single_quoted is not None:
+                value = single_quoted
+            else:
+                value = unquoted
+
+            if value is not None and "&" in value:
+                value = html.unescape(value)
+
+            attributes.append((key.lower(), value))
+
+        return attributes
+
+    def _add_text(self, text):
+        # type: (str) -> None
+        self._pieces.append(html.unescape(text) if "&" in text else text)
+
+    def _flush(self):
+        if self._pieces:
+            self.substrings.append(FormattedString.shared(
+                "".join(self._pieces),
+                self._attributes
+            ))
+            self._pieces = []
+
+    def _set_attribute(self, key, value):
+        self._flush()
+        attributes = self._attributes.copy()
+        attributes[key] = value
+        self._attributes = attributes
+
+    def _add_newline(self):
+        self._flush()
+        self.substrings.append(FormattedString.shared("\n",
+                                                      DEFAULT_ATTRIBUTES))
+
+    def _start_tag(self, tag, attrs):
+        # type: (str, str) -> None
+        flag = self._flags.get(tag)
+
+        if flag:
+            self._set_attribute(flag, not self._attributes[flag])
+        elif tag == "p" or tag == "br":
+            self._add_newline()
+        elif tag == "code":
+            lang = None
+
+            for key, value in self._attribute_values(attrs):
+                if key == "class":
+                    if value.startswith("language-"):
+                        lang = value.split("-", 1)[1]
+
+            self._set_attribute("code", lang or "unknown")
+        elif tag == "font":
+            for key, value in self._attribute_values(attrs):
+                if key in ["data-mx-color", "color"]:
+                    color = color_html_to_weechat(value)
+
+                    if color:
+                        self._set_attribute("fgcolor", color)
+
+                elif key in ["data-mx-bg-color"]:
+                    color = color_html_to_weechat(value)
+
+                    if color:
+                        self._set_attribute("bgcolor", color)
+
+    def _end_tag(self, tag):
+        # type: (str) -> None
+        flag = self._flags.get(tag)
+
+        if flag:
+            self._set_attribute(flag, not self._attributes[flag])
+
+            if tag == "blockquote":
+                self._add_newline()
+        elif tag == "code":
+            self._set_attribute("code", None)
+        elif tag == "font":
+            self._set_attribute("fgcolor", None)
+
+    def feed(self, data):
+        # type: (str) -> None
+        if not self._needs_html_parser(data) and self._parse(data):
+            return
+
+        # Start over, HTMLParser parses the whole message.
+        MatrixHtmlParser.__init__(self)
+        self._pieces = []
+        MatrixHtmlParser.feed(self, data)
+
+    def get_substrings(self):
+        self._flush()
+        return MatrixHtmlParser.get_substrings(self)
+
+
 def color_line_to_weechat(color_string):
     # type: (str) -> str
     line_colors = {
@@ -919,6 +1399,51 @@ def color_find_rgb(r, g, b):
     return idx
 
 
+class XtermColorTable(object):
+    """Precomputed version of color_find_rgb().
+
+    The parts of color_find_rgb() that depend on a single channel or on the
+    sum of the channels are tabulated on first use. Converted colors are
+    cached by color_html_to_weechat() anyways, so there's no need to tabulate
+    the whole 24 bit color space.
+    """
+
+    def __init__(self):
+        self._cube_index = []  # type: List[int]
+        self._cube_dist = []  # type: List[int]
+        self._grey_index = []  # type: List[int]
+
+    def _build(self):
+        cube_index = [color_to_6cube(v) for v in range(256)]
+        q2c = [0x00, 0x5f, 0x87, 0xaf, 0xd7, 0xff]
+
+        self._cube_index = cube_index
+        self._cube_dist = [(q2c[q] - v) ** 2 for v, q in enumerate(cube_index)]
+        self._grey_index = [
+            23 if s // 3 > 238 else (s // 3 - 3) // 10 for s in range(766)
+        ]
+
+    def find(self, r, g, b):
+        # type: (int, int, int) -> int
+        if not self._cube_index:
+            self._build()
+
+        grey_idx = self._grey_index[r + g + b]
+        grey = 8 + (10 * grey_idx)
+        grey_dist = color_dist_sq(grey, grey, grey, r, g, b)
+        cube_dist = self._cube_dist
+
+        if grey_dist < cube_dist[r] + cube_dist[g] + cube_dist[b]:
+            return 232 + grey_idx
+
+        cube_index = self._cube_index
+        return 16 + (36 * cube_index[r]) + (6 * cube_index[g]) + cube_index[b]
+
+
+XTERM_COLOR_TABLE = XtermColorTable()
+
+
+@lru_cache(maxsize=1024)
 def color_html_to_weechat(color):
     # type: (str) -> str
     # yapf: disable
@@ -950,7 +1475,7 @@ def color_html_to_weechat(color):
     if rgb_color in weechat_basic_colors:
         return weechat_basic_colors[rgb_color]
 
-    return str(color_find_rgb(*rgb_color))
+    return str(XTERM_COLOR_TABLE.find(*rgb_color))
 
 
 def color_weechat_to_html(color):
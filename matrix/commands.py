@@ -29,6 +29,7 @@ from nio import EncryptionError, LocalProtocolError
 from . import globals as G
 from .colors import Formatted
 from .globals import SERVERS, W, UPLOADS, SCRIPT_NAME
+from .message_renderer import RENDER_CACHE
 from .server import MatrixServer
 from .utf import utf8_decode
 from .utils import key_from_value, parse_redact_args
@@ -241,6 +242,7 @@ def hook_commands():
             "connect <server-name> ||"
             "disconnect <server-name> ||"
             "reconnect <server-name> ||"
+            "debug <debug-type> [<server-name>] ||"
             "help <matrix-command>"
         ),
         # Description
@@ -249,6 +251,7 @@ def hook_commands():
             "   connect: connect to Matrix servers\n"
             "disconnect: disconnect from one or all Matrix servers\n"
             " reconnect: reconnect to server(s)\n"
+            "     debug: show internal state of the script\n"
             "      help: show detailed command help\n\n"
             "Use /matrix help [command] to find out more.\n"
         ),
@@ -258,6 +261,7 @@ def hook_commands():
             "connect %(matrix_servers) ||"
             "disconnect %(matrix_servers) ||"
             "reconnect %(matrix_servers) ||"
+            "debug %(matrix_debug_types) %(matrix_servers) ||"
             "help %(matrix_commands)"
         ),
         # Function name
@@ -910,6 +914,7 @@ def matrix_olm_command_cb(data, buffer, args):
                 prefix=W.prefix("error")))
             W.prnt(server.server_buffer, message)
 
+        server.devices_changed()
         W.bar_item_update("buffer_modes")
         W.bar_item_update("matrix_modes")
 
@@ -1498,6 +1503,27 @@ def matrix_command_help(args):
                 ncolor=W.color("reset"),
             )
 
+        elif command == "debug":
+            message = (
+                "{delimiter_color}[{ncolor}matrix{delimiter_color}]  "
+                "{ncolor}{cmd_color}/debug{ncolor} "
+                "<debug-type> [<server-name>...]"
+                "\n\n"
+                "show internal state of the script"
+                "\n\n"
+                " debug-type: one of:\n"
+                "             undecrypted: undecrypted messages that are "
+                "kept until their room key arrives\n"
+                "                  render: the cache of rendered formatted "
+                "messages\n"
+                "server-name: server to show (internal name), all servers "
+                "are shown if omitted"
+            ).format(
+                delimiter_color=W.color("chat_delimiters"),
+                cmd_color=W.color("chat_buffer"),
+                ncolor=W.color("reset"),
+            )
+
         elif command == "help":
             message = (
                 "{delimiter_color}[{ncolor}matrix{delimiter_color}]  "
@@ -1842,6 +1868,49 @@ def matrix_server_command(command, args):
         W.prnt("", message)
 
 
+def matrix_debug_command(debug_type, args):
+    servers = [
+        SERVERS[name] for name in args
+        if check_server_existence(name, SERVERS)
+    ] if args else list(SERVERS.values())
+
+    if debug_type == "undecrypted":
+        for server in servers:
+            store = server.undecrypted_events
+            W.prnt("", "\nUndecrypted messages of {color}{server}{ncolor}: "
+                       "{count}/{limit} messages, {size} bytes, "
+                       "{rooms} rooms".format(
+                           color=W.color("chat_server"),
+                           ncolor=W.color("reset"),
+                           server=server.name,
+                           count=len(store),
+                           limit=store.max_events,
+                           size=store.size,
+                           rooms=store.room_count))
+
+            # Show the most recently viewed rooms first.
+            for room_id, count, size in reversed(store.room_stats()):
+                room_buffer = server.room_buffers.get(room_id)
+                name = (room_buffer.weechat_buffer.short_name
+                        if room_buffer else room_id)
+                W.prnt("", "    {name}: {count} messages, {size} bytes".format(
+                    name=name, count=count, size=size))
+    elif debug_type == "render":
+        W.prnt("", "\nRender cache: {size}/{limit} messages, {hits} hits, "
+                   "{misses} misses, {rate:.1%} hit rate".format(
+                       size=len(RENDER_CACHE),
+                       limit=RENDER_CACHE.max_size,
+                       hits=RENDER_CACHE.hits,
+                       misses=RENDER_CACHE.misses,
+                       rate=RENDER_CACHE.hit_rate))
+    else:
+        message = (
+            "{prefix}matrix: Error: unknown debug type, "
+            '"{debug_type}" (type /matrix help debug for help)'
+        ).format(prefix=W.prefix("error"), debug_type=debug_type)
+        W.prnt("", message)
+
+
 @utf8_decode
 def matrix_command_cb(data, buffer, args):
     def connect_server(args):
@@ -1890,6 +1959,16 @@ def matrix_command_cb(data, buffer, args):
         else:
             matrix_server_command("list", "")
 
+    elif command == "debug":
+        if len(args) >= 1:
+            matrix_debug_command(args[0], args[1:])
+        else:
+            message = (
+                "{prefix}matrix: Too few arguments for command "
+                '"/matrix debug" (see /matrix help debug)'
+            ).format(prefix=W.prefix("error"))
+            W.prnt("", message)
+
     elif command == "help":
         matrix_command_help(args)
 
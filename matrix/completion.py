@@ -16,7 +16,9 @@
 
 from __future__ import unicode_literals
 
-from typing import List, Optional
+import heapq
+from bisect import bisect_left
+from typing import Callable, Collection, Iterable, List, Optional
 from matrix.globals import SERVERS, W, SCRIPT_NAME
 from matrix.utf import utf8_decode
 from matrix.utils import tags_from_line_data
@@ -87,7 +89,7 @@ def matrix_command_completion_cb(data, completion_item, buffer, completion):
 
 @utf8_decode
 def matrix_debug_completion_cb(data, completion_item, buffer, completion):
-    for debug_type in ["messaging", "network", "timing"]:
+    for debug_type in ["undecrypted", "render"]:
         W.hook_completion_list_add(
             completion, debug_type, 0, W.WEECHAT_LIST_POS_SORT
         )
@@ -257,13 +259,82 @@ def matrix_own_devices_completion_cb(
     return W.WEECHAT_RC_OK
 
 
-@utf8_decode
-def matrix_user_completion_cb(data, completion_item, buffer, completion):
-    def add_user(completion, user):
-        W.hook_completion_list_add(
-            completion, user, 0, W.WEECHAT_LIST_POS_SORT
+# The maximal number of users offered by the user completion.
+MAX_USER_COMPLETIONS = 100
+# The maximal number of matching users that are ranked for the user
+# completion, this bounds the work done for short prefixes in big rooms.
+MAX_USER_COMPLETION_MATCHES = 2000
+
+
+class UserCompletionIndex(object):
+    """A sorted index of the user ids of a room used for the user completion.
+
+    The index is rebuilt lazily after the members of the room changed.
+    """
+
+    def __init__(self):
+        self._keys = []  # type: List[str]
+        self._user_ids = []  # type: List[str]
+        self._dirty = True
+
+    def invalidate(self):
+        self._dirty = True
+
+    def _rebuild(self, user_ids):
+        # type: (Iterable[str]) -> None
+        entries = sorted((user_id.lower(), user_id) for user_id in user_ids)
+        self._keys = [key for key, _ in entries]
+        self._user_ids = [user_id for _, user_id in entries]
+        self._dirty = False
+
+    def complete(self, user_ids, prefix, speaking_time,
+                 limit=MAX_USER_COMPLETIONS, recent_speakers=()):
+        # type: (Collection[str], str, Callable[[str], float], int, Iterable[str]) -> List[str]
+        """Return the user ids (without the @) that match the prefix.
+
+        The matching recent speakers come first, in the given order. The rest
+        is filled up from the sorted index, the users that spoke most
+        recently first, the rest sorted by name.
+        """
+        # Member lists that are fetched don't go through the membership
+        # event handling, notice them by the changed member count.
+        if self._dirty or len(user_ids) != len(self._keys):
+            self._rebuild(user_ids)
+
+        prefix = "@" + prefix.lstrip("@").lower()
+        completions = []
+
+        for user_id in recent_speakers:
+            if len(completions) >= limit:
+                break
+
+            if user_id in user_ids and user_id.lower().startswith(prefix):
+                completions.append(user_id)
+
+        offered = set(completions)
+        start = bisect_left(self._keys, prefix)
+        matches = []
+
+        for i in range(start, len(self._keys)):
+            if (not self._keys[i].startswith(prefix)
+                    or len(matches) >= MAX_USER_COMPLETION_MATCHES):
+                break
+
+            user_id = self._user_ids[i]
+
+            if user_id not in offered:
+                matches.append((-(speaking_time(user_id) or 0), i, user_id))
+
+        completions.extend(
+            user_id for _, _, user_id in
+            heapq.nsmallest(limit - len(completions), matches)
         )
 
+        return [user_id[1:] for user_id in completions]
+
+
+@utf8_decode
+def matrix_user_completion_cb(data, completion_item, buffer, completion):
     for server in SERVERS.values():
         if buffer == server.server_buffer:
             return W.WEECHAT_RC_OK
@@ -273,12 +344,18 @@ def matrix_user_completion_cb(data, completion_item, buffer, completion):
         if not room_buffer:
             continue
 
-        users = room_buffer.room.users
-
-        users = [user[1:] for user in users]
+        base_word = W.hook_completion_get_string(completion, "base_word")
+        users = room_buffer.completion_index.complete(
+            room_buffer.room.users,
+            base_word,
+            room_buffer.speaking_time,
+            recent_speakers=room_buffer.recent_speakers()
+        )
 
         for user in users:
-            add_user(completion, user)
+            W.hook_completion_list_add(
+                completion, user, 0, W.WEECHAT_LIST_POS_END
+            )
 
     return W.WEECHAT_RC_OK
 
@@ -26,6 +26,7 @@ Server specific configuration options are handled in server.py
 
 from builtins import super
 from collections import namedtuple
+from functools import lru_cache
 from enum import IntEnum, Enum, unique
 
 import logbook
@@ -33,6 +34,10 @@ import logbook
 import nio
 from matrix.globals import SCRIPT_NAME, SERVERS, W
 from matrix.utf import utf8_decode
+from matrix.colors import get_formatter
+from matrix.message_renderer import RENDER_CACHE
+from matrix.utils import (BridgeNickRules, CONDITION_CACHE,
+                          DEFAULT_BRIDGE_NICK_RULES, clear_color_cache)
 
 from . import globals as G
 
@@ -130,8 +135,34 @@ class Option(
         )
 
 
+@utf8_decode
+def matrix_config_change_cb(data, option):
+    """Change callback of all the global options.
+
+    Updates the stored value of the option before the option specific change
+    callback runs.
+    """
+    section_name, option_name = data.split(".", 1)
+    section = getattr(G.CONFIG, section_name, None)
+
+    # Options might be set while the config is being created.
+    if section is None:
+        return W.WEECHAT_RC_OK
+
+    section.refresh(option_name)
+    change_callback = section._options[option_name].change_callback
+
+    if change_callback:
+        return change_callback("", option)
+
+    return W.WEECHAT_RC_OK
+
+
 @utf8_decode
 def matrix_config_reload_cb(data, config_file):
+    RENDER_CACHE.clear()
+    get_formatter.cache_clear()
+    clear_color_cache()
     return W.WEECHAT_RC_OK
 
 
@@ -203,6 +234,78 @@ def config_pgup_cb(data, option):
     return 1
 
 
+@utf8_decode
+def config_decryption_threads_cb(data, option):
+    """Callback for the network.decryption_threads option.
+    Stops the running decryption workers, they are restarted with the new
+    thread count once they are needed again."""
+    for server in SERVERS.values():
+        server.stop_decryption_pool()
+
+    return 1
+
+
+@utf8_decode
+def config_max_undecrypted_events_cb(data, option):
+    """Callback for the network.max_undecrypted_events option."""
+    for server in SERVERS.values():
+        server.undecrypted_events.resize(
+            G.CONFIG.network.max_undecrypted_events
+        )
+
+    return 1
+
+
+@utf8_decode
+def config_bridge_nick_rules_cb(data, option):
+    """Callback for the look.bridge_nick_rules option.
+    Forgets the nicks that were picked using the old rules, already displayed
+    nicks don't change."""
+    for server in SERVERS.values():
+        server.user_registry.clear_nicks()
+
+    return 1
+
+
+@utf8_decode
+def config_nick_colors_cb(data, option, value):
+    """Callback for the weechat nick color options.
+    Forgets the cached nick colors, already displayed nicks keep their
+    color."""
+    for server in SERVERS.values():
+        server.user_registry.clear_colors()
+
+    return W.WEECHAT_RC_OK
+
+
+@utf8_decode
+def config_weechat_colors_cb(data, option, value):
+    """Callback for the color options of other plugins we use by name, their
+    escapes embed the color so the cached escapes need to be forgotten."""
+    # The evaluated signs may contain colors.
+    G.CONFIG.look.refresh()
+    clear_color_cache()
+    RENDER_CACHE.clear()
+    get_formatter.cache_clear()
+    return W.WEECHAT_RC_OK
+
+
+@utf8_decode
+def config_conditions_cb(data, option):
+    """Callback for the typing notice and read marker conditions, forgets the
+    evaluated conditions."""
+    CONDITION_CACHE.clear()
+    return W.WEECHAT_RC_OK
+
+
+@utf8_decode
+def config_render_cache_cb(data, option):
+    """Callback for the options that change how formatted messages are
+    rendered, already rendered messages need to be rendered again."""
+    RENDER_CACHE.clear()
+    return 1
+
+
 def level_to_logbook(value):
     if value == 0:
         return logbook.ERROR
@@ -267,6 +370,15 @@ def parse_nick_prefix_colors(value):
     return prefix_colors
 
 
+@lru_cache(maxsize=4)
+def parse_bridge_nick_rules(value):
+    """Parses the bridge nick rules setting string
+    ("@_discord_=displayname;@freenode_=strip") into a BridgeNickRules
+    object. The option is read for every added user, the compiled rules are
+    cached."""
+    return BridgeNickRules.parse(value)
+
+
 def eval_cast(string):
     """A function that passes a string to weechat which evaluates it using its
     expression evaluation syntax.
@@ -329,33 +441,46 @@ class ConfigSection(object):
     config sections."""
     @classmethod
     def build(cls, name, options):
+        """Build a section class whose option values are kept as plain
+        attributes.
+
+        The values are read once and updated by the change callback of the
+        options, reading an option is a simple attribute access.
+        """
         def constructor(self, name, config_ptr, options):
             self._ptr = W.config_new_section(
                 config_ptr, name, 0, 0, "", "", "", "", "", "", "", "", "", ""
             )
             self._config_ptr = config_ptr
             self._option_ptrs = {}
+            self._options = {}
 
             for option in options:
-                self._add_option(option)
-
-        attributes = {
-            option.name: cls.option_property(
-                option.name, option.type, cast_func=option.cast_func
-            )
-            for option in options
-        }
-        attributes["__init__"] = constructor
-
-        section_class = type(name.title() + "Section", (cls,), attributes)
+                self._options[option.name] = option
+                self._add_option(
+                    option,
+                    "matrix_config_change_cb",
+                    "{}.{}".format(name, option.name)
+                )
+
+            self.refresh()
+
+        section_class = type(
+            name.title() + "Section",
+            (cls,),
+            {"__init__": constructor}
+        )
         return section_class
 
     def free(self):
         W.config_section_free_options(self._ptr)
         W.config_section_free(self._ptr)
 
-    def _add_option(self, option):
-        cb = option.change_callback.__name__ if option.change_callback else ""
+    def _add_option(self, option, callback=None, callback_data=""):
+        if callback is None:
+            callback = (option.change_callback.__name__
+                        if option.change_callback else "")
+
         option_ptr = W.config_new_option(
             self._config_ptr,
             self._ptr,
@@ -370,14 +495,36 @@ class ConfigSection(object):
             0,
             "",
             "",
-            cb,
-            "",
+            callback,
+            callback_data,
             "",
             "",
         )
 
         self._option_ptrs[option.name] = option_ptr
 
+    def refresh(self, option_name=None):
+        # type: (Optional[str]) -> None
+        """Update the stored value of an option, of all options if no option
+        name is given."""
+        names = [option_name] if option_name else list(self._options)
+
+        for name in names:
+            option = self._options[name]
+            ptr = self._option_ptrs[name]
+
+            if option.type == "boolean":
+                value = bool(W.config_boolean(ptr))
+            elif option.type == "integer":
+                value = W.config_integer(ptr)
+            else:
+                value = W.config_string(ptr)
+
+            if option.cast_func:
+                value = option.cast_func(value)
+
+            setattr(self, name, value)
+
     @staticmethod
     def option_property(name, option_type, evaluate=False, cast_func=None):
         """Create a property for this class that makes the reading of config
@@ -480,6 +627,22 @@ class MatrixConfig(WeechatConfig):
                 "channel/pv of server)",
                 NewChannelPosition,
             ),
+            Option(
+                "bridge_nick_rules",
+                "string",
+                "",
+                0,
+                0,
+                DEFAULT_BRIDGE_NICK_RULES,
+                ("Semicolon separated list of rules picking the nick of "
+                 "bridge puppets (\"@prefix_=action\"). Users whose id "
+                 "starts with the prefix use their display name as the nick "
+                 "if the action is \"displayname\", if the action is "
+                 "\"strip\" the nick is the user id without the prefix and "
+                 "the server part. Already displayed nicks don't change."),
+                parse_bridge_nick_rules,
+                config_bridge_nick_rules_cb,
+            ),
             Option(
                 "max_typing_notice_item_length",
                 "integer",
@@ -552,6 +715,8 @@ class MatrixConfig(WeechatConfig):
                 0,
                 "native",
                 "Pygments style to use for highlighting source code blocks",
+                None,
+                config_render_cache_cb,
             ),
             Option(
                 "code_blocks",
@@ -563,6 +728,8 @@ class MatrixConfig(WeechatConfig):
                 ("Display preformatted code blocks as rectangular areas by "
                  "padding them with whitespace up to the length of the longest"
                  " line (with optional margin)"),
+                None,
+                config_render_cache_cb,
             ),
             Option(
                 "code_block_margin",
@@ -573,6 +740,20 @@ class MatrixConfig(WeechatConfig):
                 "2",
                 ("Number of spaces to add as a margin around around a code "
                  "block"),
+                None,
+                config_render_cache_cb,
+            ),
+            Option(
+                "background_highlight_lines",
+                "integer",
+                "",
+                0,
+                1000000,
+                "200",
+                ("Code blocks with at least this many lines are syntax "
+                 "highlighted in a background thread, until that is done they "
+                 "are shown without highlighting (0 to always highlight them "
+                 "right away)"),
             ),
             Option(
                 "quote_wrap",
@@ -583,6 +764,19 @@ class MatrixConfig(WeechatConfig):
                 "67",
                 ("After how many characters to soft-wrap lines in a quote "
                  "block (reply message). Set to -1 to disable soft-wrapping."),
+                None,
+                config_render_cache_cb,
+            ),
+            Option(
+                "fast_html_parser",
+                "boolean",
+                "",
+                0,
+                0,
+                "on",
+                ("Use the built in tokenizer for the HTML of formatted "
+                 "messages instead of the python HTMLParser, unusual HTML "
+                 "is always parsed by HTMLParser."),
             ),
             Option(
                 "human_buffer_names",
@@ -681,6 +875,18 @@ class MatrixConfig(WeechatConfig):
                  "proactively, they will be loaded when the user switches to "
                  "the room buffer. This only affects non-encrypted rooms."),
             ),
+            Option(
+                "max_member_requests",
+                "integer",
+                "",
+                1,
+                64,
+                "8",
+                ("Maximal number of room member list requests that are sent "
+                 "out at the same time while fetching the members of rooms in "
+                 "the background. Encrypted and displayed rooms are fetched "
+                 "first."),
+            ),
             Option(
                 "max_nicklist_users",
                 "integer",
@@ -693,6 +899,35 @@ class MatrixConfig(WeechatConfig):
                  " Inactive users will be removed from the nicklist after a "
                  "day of inactivity."),
             ),
+            Option(
+                "decryption_threads",
+                "integer",
+                "",
+                0,
+                8,
+                "0",
+                ("Number of background threads used to decrypt messages in "
+                 "encrypted rooms. Messages are shown with a placeholder "
+                 "that is replaced once they are decrypted. Note that "
+                 "highlights aren't re-evaluated for such messages. "
+                 "0 decrypts messages while the sync response is processed."),
+                None,
+                config_decryption_threads_cb,
+            ),
+            Option(
+                "max_undecrypted_events",
+                "integer",
+                "",
+                100,
+                1000000,
+                "10000",
+                ("Maximal number of undecrypted messages per server that are "
+                 "remembered so they can be decrypted once their room key "
+                 "arrives. If the limit is reached messages of rooms that "
+                 "weren't viewed recently are forgotten first."),
+                None,
+                config_max_undecrypted_events_cb,
+            ),
             Option(
                 "lag_reconnect",
                 "integer",
@@ -755,6 +990,8 @@ class MatrixConfig(WeechatConfig):
                  "variables the typing_enabled variable is also expanded; "
                  "the typing_enabled variable can be manipulated with the "
                  "/room command, see /help room"),
+                None,
+                config_conditions_cb,
             ),
             Option(
                 "read_markers_conditions",
@@ -768,6 +1005,8 @@ class MatrixConfig(WeechatConfig):
                  "variables the markers_enabled variable is also expanded; "
                  "the markers_enabled variable can be manipulated with the "
                  "/room command, see /help room"),
+                None,
+                config_conditions_cb,
             ),
             Option(
                 "resending_ignores_devices",
@@ -794,6 +1033,8 @@ class MatrixConfig(WeechatConfig):
                 0,
                 "lightgreen",
                 "Foreground color for matrix style blockquotes",
+                None,
+                config_render_cache_cb,
             ),
             Option(
                 "quote_bg",
@@ -803,6 +1044,8 @@ class MatrixConfig(WeechatConfig):
                 0,
                 "default",
                 "Background counterpart of quote_fg",
+                None,
+                config_render_cache_cb,
             ),
             Option(
                 "error_message_fg",
@@ -852,6 +1095,8 @@ class MatrixConfig(WeechatConfig):
                 "blue",
                 ("Foreground color for code without a language specifier. "
                  "Also used for `inline code`."),
+                None,
+                config_render_cache_cb,
             ),
             Option(
                 "untagged_code_bg",
@@ -861,6 +1106,8 @@ class MatrixConfig(WeechatConfig):
                 0,
                 "default",
                 "Background counterpart of untagged_code_fg",
+                None,
+                config_render_cache_cb,
             ),
             Option(
                 "nick_prefixes",
@@ -908,6 +1155,10 @@ class MatrixConfig(WeechatConfig):
 
     def read(self):
         super().read()
+
+        for section in (self.network, self.look, self.color):
+            section.refresh()
+
         self.human_buffer_names = self.look.human_buffer_names
 
     def free(self):
@@ -18,9 +18,138 @@
 """Module for rendering matrix messages in Weechat."""
 
 from __future__ import unicode_literals
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Tuple
 from nio import Api
-from .globals import W
-from .colors import Formatted
+from . import globals as G
+from .colors import Formatted, highlight_code_block
+from .utils import cached_color
+from .workers import WorkerPool
+
+# The number of rendered formatted messages that are remembered.
+RENDER_CACHE_SIZE = 1000
+
+
+class RenderCache(object):
+    """LRU cache of formatted message bodies rendered for weechat.
+
+    Bots and bridges tend to send the same formatted bodies over and over
+    again. The rendered message depends on some look and color options, the
+    cache needs to be cleared if they change.
+    """
+
+    def __init__(self, max_size=RENDER_CACHE_SIZE):
+        # type: (int) -> None
+        self.max_size = max_size
+        self._cache = OrderedDict()  # type: OrderedDict[str, str]
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def hit_rate(self):
+        # type: () -> float
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, formatted_body):
+        # type: (str) -> Optional[str]
+        rendered = self._cache.get(formatted_body)
+
+        if rendered is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._cache.move_to_end(formatted_body)
+        return rendered
+
+    def put(self, formatted_body, rendered):
+        # type: (str, str) -> None
+        self._cache[formatted_body] = rendered
+
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        self._cache.clear()
+
+
+RENDER_CACHE = RenderCache()
+
+
+class BackgroundHighlighter(object):
+    """Syntax highlights large code blocks on a worker thread.
+
+    Messages containing large code blocks are first rendered with the large
+    blocks left unhighlighted, the fully rendered message is passed to a
+    callback once the highlighting is done.
+    """
+
+    def __init__(self):
+        self._pool = None  # type: Optional[WorkerPool]
+
+    def render(self, formatted_body, formatted, callback):
+        # type: (str, Formatted, Callable[[str], None]) -> str
+        """Render a formatted message, highlighting large code blocks in the
+        background.
+
+        Returns the preliminary rendering of the message, callback is called
+        with the final one if there were any large code blocks.
+        """
+        min_lines = G.CONFIG.look.background_highlight_lines
+        blocks = []  # type: List[Tuple[str, Any, Any]]
+
+        def defer_large_blocks(code, lexer, formatter):
+            if not min_lines or code.count("\n") + 1 < min_lines:
+                return highlight_code_block(code, lexer, formatter)
+
+            blocks.append((code, lexer, formatter))
+            return None
+
+        rendered = formatted.to_weechat(defer_large_blocks)
+
+        if not blocks:
+            RENDER_CACHE.put(formatted_body, rendered)
+            return rendered
+
+        def highlight_blocks():
+            return {
+                code: highlight_code_block(code, lexer, formatter)
+                for code, lexer, formatter in blocks
+            }
+
+        def highlighted(highlighted_blocks, error):
+            # If the pool was shut down the message stays unhighlighted.
+            if error:
+                return
+
+            def lookup_block(code, lexer, formatter):
+                if code in highlighted_blocks:
+                    return highlighted_blocks[code]
+                return highlight_code_block(code, lexer, formatter)
+
+            rendered = formatted.to_weechat(lookup_block)
+            RENDER_CACHE.put(formatted_body, rendered)
+            callback(rendered)
+
+        if not self._pool:
+            self._pool = WorkerPool("highlight", 1)
+
+        self._pool.submit(highlight_blocks, (), highlighted)
+
+        return rendered
+
+    def stop(self):
+        if self._pool:
+            pool = self._pool
+            self._pool = None
+            pool.shutdown()
+
+
+HIGHLIGHTER = BackgroundHighlighter()
 
 
 class Render(object):
@@ -30,8 +159,8 @@ class Render(object):
     def _media(url, description):
         return ("{del_color}<{ncolor}{desc}{del_color}>{ncolor} "
                 "{del_color}[{ncolor}{url}{del_color}]{ncolor}").format(
-                    del_color=W.color("chat_delimiters"),
-                    ncolor=W.color("reset"),
+                    del_color=cached_color("chat_delimiters"),
+                    ncolor=cached_color("reset"),
                     desc=description, url=url)
 
     @staticmethod
@@ -57,11 +186,30 @@ class Render(object):
         return Render._media(url, description)
 
     @staticmethod
-    def message(body, formatted_body):
-        """Render a room message."""
+    def message(body, formatted_body, highlighted_cb=None):
+        """Render a room message.
+
+        If a highlighted_cb is given large code blocks are syntax highlighted
+        in the background, the callback is called with the final rendering of
+        the message.
+        """
         if formatted_body:
-            formatted = Formatted.from_html(formatted_body)
-            return formatted.to_weechat()
+            rendered = RENDER_CACHE.get(formatted_body)
+
+            if rendered is None:
+                formatted = Formatted.from_html(formatted_body)
+
+                if highlighted_cb:
+                    return HIGHLIGHTER.render(
+                        formatted_body,
+                        formatted,
+                        highlighted_cb
+                    )
+
+                rendered = formatted.to_weechat()
+                RENDER_CACHE.put(formatted_body, rendered)
+
+            return rendered
 
         return body
 
@@ -78,9 +226,9 @@ class Render(object):
             "{del_color}<{log_color}Message redacted by: "
             "{censor}{log_color}{reason}{del_color}>{ncolor}"
         ).format(
-            del_color=W.color("chat_delimiters"),
-            ncolor=W.color("reset"),
-            log_color=W.color("logger.color.backlog_line"),
+            del_color=cached_color("chat_delimiters"),
+            ncolor=cached_color("reset"),
+            log_color=cached_color("logger.color.backlog_line"),
             censor=censor,
             reason=reason,
         )
@@ -111,9 +259,18 @@ class Render(object):
         return ("{del_color}<{log_color}Unable to decrypt: "
                 "The sender's device has not sent us "
                 "the keys for this message{del_color}>{ncolor}").format(
-                    del_color=W.color("chat_delimiters"),
-                    log_color=W.color("logger.color.backlog_line"),
-                    ncolor=W.color("reset"))
+                    del_color=cached_color("chat_delimiters"),
+                    log_color=cached_color("logger.color.backlog_line"),
+                    ncolor=cached_color("reset"))
+
+    @staticmethod
+    def megolm_pending():
+        """Render a megolm event that is being decrypted in the background."""
+        return ("{del_color}<{log_color}Decrypting..."
+                "{del_color}>{ncolor}").format(
+                    del_color=cached_color("chat_delimiters"),
+                    log_color=cached_color("logger.color.backlog_line"),
+                    ncolor=cached_color("reset"))
 
     @staticmethod
     def bad(event):
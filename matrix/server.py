@@ -22,7 +22,10 @@ import socket
 import ssl
 import time
 import copy
+import heapq
+from functools import partial
 from collections import defaultdict, deque
+from itertools import chain
 from atomicwrites import atomic_write
 from typing import (
     Any,
@@ -31,12 +34,14 @@ from typing import (
     Optional,
     List,
     NamedTuple,
+    Set,
     DefaultDict,
+    Tuple,
     Type,
     Union,
 )
 
-from uuid import UUID
+from uuid import UUID, uuid4
 
 from nio import (
     Api,
@@ -70,6 +75,11 @@ from nio import (
     JoinedMembersResponse,
     JoinedMembersError,
     RoomKeyEvent,
+    MegolmEvent,
+    Event,
+    BadEvent,
+    BadEventType,
+    UnknownBadEvent,
     KeyVerificationStart,
     KeyVerificationCancel,
     KeyVerificationKey,
@@ -81,12 +91,20 @@ from nio import (
 )
 
 from . import globals as G
-from .buffer import OwnAction, OwnMessage, RoomBuffer
+from .buffer import OwnAction, OwnMessage, RoomBuffer, UserRegistry
 from .config import ConfigSection, Option, ServerBufferType
 from .globals import SCRIPT_NAME, SERVERS, W, TYPING_NOTICE_TIMEOUT
 from .utf import utf8_decode
-from .utils import create_server_buffer, key_from_value, server_buffer_prnt
+from .utils import (
+    CONDITION_CACHE,
+    SortedSet,
+    create_server_buffer,
+    key_from_value,
+    server_buffer_prnt,
+)
 from .uploads import Upload
+from .undecrypted import UndecryptedEvents
+from .workers import WorkerPool
 
 from .colors import Formatted, FormattedString, DEFAULT_ATTRIBUTES
 
@@ -110,6 +128,202 @@ EncryptionQueueItem = NamedTuple(
 )
 
 
+# The maximal number of to-device messages that are sent out in a single
+# request.
+TO_DEVICE_BATCH_SIZE = 100
+
+
+class ToDeviceBatch(object):
+    """Multiple to-device messages of the same type sent out in one request.
+
+    Quacks like a nio ToDeviceMessage so it can be passed to
+    HttpClient.to_device().
+    """
+
+    def __init__(self, message_type):
+        # type: (str) -> None
+        self.type = message_type
+        self.tx_id = str(uuid4())
+        self.messages = []  # type: List[ToDeviceMessage]
+        self._content = defaultdict(dict) \
+            # type: DefaultDict[str, Dict[str, Dict[Any, Any]]]
+
+    def add(self, message):
+        # type: (ToDeviceMessage) -> bool
+        """Add a message to the batch.
+
+        Returns False if the batch is full or already contains a message for
+        the same device.
+        """
+        devices = self._content[message.recipient]
+
+        if (len(self.messages) >= TO_DEVICE_BATCH_SIZE
+                or message.recipient_device in devices):
+            return False
+
+        devices[message.recipient_device] = message.content
+        self.messages.append(message)
+        return True
+
+    def as_dict(self):
+        return {"messages": dict(self._content)}
+
+
+# The number of inactive users that are removed from the nicklists per timer
+# tick.
+USER_GC_BATCH_SIZE = 200
+
+# The interval of the lazy user loading timer in seconds.
+LAZY_LOAD_INTERVAL = 1
+
+
+class AdaptiveBudget(object):
+    """The number of users the lazy loader adds per timer tick.
+
+    Adding users blocks the weechat main loop. The budget grows while a tick
+    stays below the target time and the timer fires on time, and is halved
+    if a tick takes too long or the timer fires late because the main loop
+    is busy with something else.
+    """
+
+    def __init__(self, target=0.05, minimum=20, maximum=5000):
+        # type: (float, int, int) -> None
+        self.target = target
+        self.minimum = minimum
+        self.maximum = maximum
+        self.value = 100
+        self.last_tick = None  # type: Optional[float]
+
+    def lateness(self, now):
+        # type: (float) -> float
+        """How late the current tick fired."""
+        last_tick, self.last_tick = self.last_tick, now
+
+        if last_tick is None:
+            return 0
+
+        return max(now - last_tick - LAZY_LOAD_INTERVAL, 0)
+
+    def update(self, work_time, lateness):
+        # type: (float, float) -> None
+        if work_time > self.target or lateness > self.target:
+            self.value = max(self.value // 2, self.minimum)
+        else:
+            self.value = min(
+                self.value + max(self.value // 4, self.minimum),
+                self.maximum
+            )
+
+    def reset(self):
+        self.last_tick = None
+
+
+class WorkerDecryptedSession(object):
+    """An inbound group session whose ciphertext a decryption worker already
+    decrypted.
+
+    It stands in for the inbound group store of nio while nio finishes the
+    decryption, nio finds the session and gets the plaintext of the worker
+    instead of decrypting the ciphertext again. Everything else is read from
+    the real session.
+    """
+
+    def __init__(self, session, plaintext, message_index):
+        # type: (Any, str, int) -> None
+        self.session = session
+        self.plaintext = plaintext
+        self.message_index = message_index
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def get(self, room_id, sender_key, session_id):
+        # type: (str, str, str) -> Optional[WorkerDecryptedSession]
+        if session_id != self.session.id:
+            return None
+
+        return self
+
+    def decrypt(self, ciphertext):
+        # type: (str) -> Tuple[str, int]
+        return self.plaintext, self.message_index
+
+
+class MatrixClient(HttpClient):
+    """HttpClient that can leave megolm decryption to the decryption
+    workers.
+
+    Only events whose inbound group session we already have are left to the
+    workers, and the workers only decrypt the ciphertext. Everything that
+    touches the Olm state, the replay protection, device verification and key
+    queries, is left to nio on the main thread in finish_megolm_decryption().
+    """
+
+    def background_session(self, event, room_id=None):
+        # type: (MegolmEvent, Optional[str]) -> Any
+        """Return the inbound group session the event can be decrypted with
+        in the background.
+
+        Returns None if background decryption is disabled or if the session is
+        missing, nio needs to handle those events on the main thread, it may
+        want to request the room key or unwedge the Olm session.
+        """
+        if not self.olm or not G.CONFIG.network.decryption_threads:
+            return None
+
+        return self.olm.inbound_group_store.get(
+            room_id or event.room_id,
+            event.sender_key,
+            event.session_id
+        )
+
+    def _handle_timeline_event(self, event, room_id, room, encrypted_rooms):
+        if (isinstance(event, MegolmEvent)
+                and self.background_session(event, room_id)):
+            # The event is decrypted after it was printed, see
+            # MatrixServer.decrypt_in_background().
+            event.room_id = room_id
+            room.handle_event(event)
+            return None
+
+        return super()._handle_timeline_event(
+            event,
+            room_id,
+            room,
+            encrypted_rooms
+        )
+
+    def finish_megolm_decryption(self, event, session, plaintext,
+                                 message_index):
+        # type: (MegolmEvent, Any, str, int) -> Union[Event, BadEventType]
+        """Turn the plaintext a worker produced into an event.
+
+        nio's decrypt_megolm_event() does the replay check, the device
+        verification and the parsing, it raises EncryptionError if the event
+        shouldn't be trusted.
+        """
+        olm = self.olm
+        store = olm.inbound_group_store
+        olm.inbound_group_store = WorkerDecryptedSession(
+            session,
+            plaintext,
+            message_index
+        )
+
+        try:
+            return olm.decrypt_megolm_event(event)
+        finally:
+            olm.inbound_group_store = store
+
+        new_event.decrypted = True
+        new_event.verified = verified
+        new_event.sender_key = event.sender_key
+        new_event.session_id = event.session_id
+        new_event.room_id = event.room_id
+
+        return new_event
+
+
 class ServerConfig(ConfigSection):
     def __init__(self, server_name, config_ptr):
         # type: (str, str) -> None
@@ -325,9 +539,17 @@ class MatrixServer(object):
         self.backlog_queue = dict()      # type: Dict[str, str]
 
         self.user_gc_time = time.time()    # type: float
-        self.member_request_list = []         # type: List[str]
-        self.rooms_with_missing_members = []  # type: List[str]
+        self.user_gc_rooms = deque()       # type: Deque[RoomBuffer]
+        # Rooms whose member list we requested and the ones that are still
+        # waiting for a free request slot.
+        self.member_requests = set()                   # type: Set[str]
+        # Rooms whose member list we still need, the ones we need the most
+        # come first.
+        self.rooms_with_missing_members = SortedSet(
+            self._member_fetch_priority
+        )  # type: SortedSet
         self.lazy_load_hook = None       # type: Optional[str]
+        self.lazy_load_budget = AdaptiveBudget()
 
         # These flags remember if we made some requests so that we don't
         # make them again while we wait on a response, the flags need to be
@@ -336,7 +558,22 @@ class MatrixServer(object):
         self.keys_claimed = defaultdict(bool)          # type: Dict[str, bool]
         self.group_session_shared = defaultdict(bool)  # type: Dict[str, bool]
         self.ignore_while_sharing = defaultdict(bool)  # type: Dict[str, bool]
-        self.to_device_sent = []  # type: List[ToDeviceMessage]
+        # Rooms whose group session couldn't be shared ahead of time because
+        # of unverified devices, cleared when devices or their trust change.
+        self.group_session_untrusted = set()           # type: Set[str]
+        # To-device requests that wait for a response, keyed by the
+        # transaction id and the ids of the messages they contain.
+        self.to_device_sent = dict()  # type: Dict[str, ToDeviceBatch]
+        self.to_device_in_flight = set()  # type: Set[int]
+        self.to_device_hook = None  # type: Optional[str]
+
+        self.user_registry = UserRegistry()
+
+        self.decryption_pool = None  # type: Optional[WorkerPool]
+        self.undecrypted_events = UndecryptedEvents(
+            G.CONFIG.network.max_undecrypted_events,
+            self._room_displayed
+        )
 
         # Try to load the device id, the device id is loaded every time the
         # user changes but some login flows don't use a user so try to load the
@@ -412,7 +649,7 @@ class MatrixServer(object):
 
         config = ClientConfig(store_sync_tokens=True)
 
-        self.client = HttpClient(
+        self.client = MatrixClient(
             homeserver.geturl(),
             self.config.username,
             self.device_id,
@@ -503,6 +740,7 @@ class MatrixServer(object):
             device = sas.other_olm_device
 
             if sas.verified:
+                self.devices_changed()
                 self.info_highlight("Device {} of user {} successfully "
                                     "verified".format(
                                         device.id,
@@ -711,7 +949,7 @@ class MatrixServer(object):
 
         self.send_buffer = b""
         self.transport_type = None
-        self.member_request_list = []
+        self.member_requests = set()
 
         if self.client:
             try:
@@ -728,7 +966,11 @@ class MatrixServer(object):
         self.keys_claimed = defaultdict(bool)
         self.group_session_shared = defaultdict(bool)
         self.ignore_while_sharing = defaultdict(bool)
-        self.to_device_sent = []
+        self.group_session_untrusted = set()
+        self.to_device_sent = dict()
+        self.to_device_in_flight = set()
+
+        self.stop_decryption_pool()
 
         if self.server_buffer:
             message = ("{prefix}matrix: disconnected from server").format(
@@ -980,12 +1222,10 @@ class MatrixServer(object):
 
         input = room_buffer.weechat_buffer.input
 
-        typing_enabled = bool(int(W.string_eval_expression(
+        typing_enabled = CONDITION_CACHE.evaluate(
             G.CONFIG.network.typing_notice_conditions,
-            {},
-            {"typing_enabled": str(int(room_buffer.typing_enabled))},
-            {"type": "condition"}
-        )))
+            {"typing_enabled": str(int(room_buffer.typing_enabled))}
+        )
 
         if not typing_enabled:
             return
@@ -1077,6 +1317,69 @@ class MatrixServer(object):
         self.send(request)
         self.group_session_shared[room_id] = True
 
+    def prepare_group_session(self, room_buffer):
+        """Make sure a group session is shared before a message is sent.
+
+        Called when the user starts typing in a room. If the room doesn't have
+        a valid outbound group session the keys are claimed and the session is
+        shared in the background, so the message doesn't need to wait for
+        those requests when it gets sent.
+
+        Args:
+            room_buffer(RoomBuffer): the room the user is typing in.
+        """
+        room_id = room_buffer.room.room_id
+
+        if (not self.connected
+                or not self.client.logged_in
+                or not self.client.olm
+                or not room_buffer.room.encrypted
+                or not room_buffer.members_fetched):
+            return
+
+        # Wait until we know about all the devices in the room.
+        if self.keys_queried or self.client.should_query_keys:
+            return
+
+        if (self.keys_claimed[room_id]
+                or self.group_session_shared[room_id]
+                or room_id in self.group_session_untrusted):
+            return
+
+        # The user is typing a weechat command, not a message.
+        input = room_buffer.weechat_buffer.input
+        if input.startswith("/") and not input.startswith("//"):
+            return
+
+        if not CONDITION_CACHE.evaluate(
+            G.CONFIG.network.typing_notice_conditions,
+            {"typing_enabled": str(int(room_buffer.typing_enabled))}
+        ):
+            return
+
+        if not self.client.olm.should_share_group_session(room_id):
+            return
+
+        try:
+            if self.client.get_missing_sessions(room_id):
+                _, request = self.client.keys_claim(room_id)
+                self.keys_claimed[room_id] = True
+                self.send(request)
+            else:
+                self.share_group_session(room_id)
+        except OlmTrustError:
+            # Don't walk all the devices of the room on every keystroke,
+            # room_send_event() reports the error once the user sends a
+            # message.
+            self.group_session_untrusted.add(room_id)
+        except (LocalProtocolError, EncryptionError):
+            pass
+
+    def devices_changed(self):
+        """Forget the rooms that had unverified devices, called every time
+        the device list or the trust of a device changes."""
+        self.group_session_untrusted.clear()
+
     def room_send_event(
         self,
         room_id,    # type: str
@@ -1203,13 +1506,59 @@ class MatrixServer(object):
         if not self.connected or not self.client.logged_in:
             return
 
-        if room_id in self.member_request_list:
+        self.rooms_with_missing_members.discard(room_id)
+
+        if room_id in self.member_requests:
             return
 
-        self.member_request_list.append(room_id)
+        self.member_requests.add(room_id)
         _, request = self.client.joined_members(room_id)
         self.send(request)
 
+    def _member_fetch_priority(self, room_id):
+        # type: (str) -> Tuple[bool, bool]
+        # This is computed once when the room is queued. Rooms the user
+        # switches to request their members right away in any case.
+        room_buffer = self.room_buffers.get(room_id)
+
+        if not room_buffer:
+            return (False, False)
+
+        # Encryption needs the full member list before we can send a
+        # message.
+        return (
+            room_buffer.weechat_buffer.displayed,
+            room_buffer.room.encrypted,
+        )
+
+    def fetch_missing_members(self):
+        """Request the member lists of the queued rooms.
+
+        Up to network.max_member_requests requests are kept in flight. Once
+        all the member lists arrived a key query is made, at that point we
+        know all the members of our encrypted rooms.
+        """
+        if not self.connected or not self.client.logged_in:
+            return
+
+        free_slots = (G.CONFIG.network.max_member_requests
+                      - len(self.member_requests))
+
+        rooms = self.rooms_with_missing_members
+
+        while free_slots > 0 and rooms:
+            room_id = rooms.pop()
+
+            if room_id not in self.member_requests:
+                self.get_joined_members(room_id)
+                free_slots -= 1
+
+        if self.member_requests or self.rooms_with_missing_members:
+            return
+
+        if self.client.should_query_keys and not self.keys_queried:
+            self.keys_query()
+
     def _print_message_error(self, message):
         server_buffer_prnt(
             self,
@@ -1405,61 +1754,184 @@ class MatrixServer(object):
             room_buffer = self.find_room_from_id(room_id)
             room_buffer.handle_joined_room(info)
 
-    def add_unhandled_users(self, rooms, n):
-        # type: (List[RoomBuffer], int) -> bool
-        total_users = 0
+    def _update_room_metadata(self, response):
+        """Push the buffer metadata of the rooms in the sync to weechat.
 
-        while total_users <= n:
-            try:
-                room_buffer = rooms.pop()
-            except IndexError:
-                return False
+        Events only mark what changed, so a sync containing hundreds of
+        membership events still recomputes the room name once.
+        """
+        modes_changed = False
 
-            handled_users = 0
+        for room_id in chain(response.rooms.leave, response.rooms.join):
+            room_buffer = self.room_buffers.get(room_id)
 
+            if room_buffer and room_buffer.update_metadata():
+                modes_changed = True
+
+        if modes_changed:
+            W.bar_item_update("buffer_modes")
+            W.bar_item_update("matrix_modes")
+
+    def lazy_load_queue(self):
+        # type: () -> List[Tuple[Any, int, RoomBuffer]]
+        """Return a heap of the rooms that have users left to add.
+
+        Rooms that are displayed in a window come first, followed by rooms
+        with the highest hotlist priority and the most recently viewed ones.
+        """
+        rooms = [
+            (room_buffer.lazy_load_priority, i, room_buffer)
+            for i, room_buffer in enumerate(self.room_buffers.values())
+            if room_buffer.unhandled_users
+        ]
+        heapq.heapify(rooms)
+        return rooms
+
+    def add_unhandled_users(self, rooms, n):
+        # type: (List[Tuple[Any, int, RoomBuffer]], int) -> bool
+        """Add up to n users from the given lazy load queue.
+
+        Returns True if there are users left to add.
+        """
+        total_users = 0
+
+        while rooms and total_users < n:
+            _, _, room_buffer = rooms[0]
             users = room_buffer.unhandled_users
+            batch = []
 
-            for user_id in users:
-                room_buffer.add_user(user_id, 0, True)
-                handled_users += 1
+            while users and total_users < n:
+                batch.append(users.pop())
                 total_users += 1
 
-                if total_users >= n:
-                    room_buffer.unhandled_users = users[handled_users:]
-                    rooms.append(room_buffer)
-                    return True
+            room_buffer.add_users(batch)
 
-            room_buffer.unhandled_users = []
+            if not users:
+                heapq.heappop(rooms)
 
-        return False
+        return bool(rooms)
 
     def _hook_lazy_user_adding(self):
         if not self.lazy_load_hook:
-            hook = W.hook_timer(1 * 1000, 0, 0,
+            self.lazy_load_budget.reset()
+            hook = W.hook_timer(LAZY_LOAD_INTERVAL * 1000, 0, 0,
                                 "matrix_load_users_cb", self.name)
             self.lazy_load_hook = hook
 
     def decrypt_printed_messages(self, key_event):
         """Decrypt already printed messages and send them to the buffer"""
-        try:
-            room_buffer = self.find_room_from_id(key_event.room_id)
-        except KeyError:
+        undecrypted_events = self.undecrypted_events.pop_session(
+            key_event.room_id,
+            key_event.session_id
+        )
+
+        room_buffer = self.room_buffers.get(key_event.room_id)
+
+        if not room_buffer or not undecrypted_events:
             return
 
         decrypted_events = []
 
-        for undecrypted_event in room_buffer.undecrypted_events:
-            if undecrypted_event.session_id != key_event.session_id:
+        for undecrypted_event in undecrypted_events:
+            if self.decrypt_in_background(undecrypted_event):
+                continue
+
+            try:
+                event = self.client.decrypt_event(undecrypted_event)
+            except EncryptionError:
+                event = None
+
+            # The key might not be able to decrypt older messages, keep
+            # the event around in case we get a better one.
+            if not event or isinstance(event, UnknownBadEvent):
+                self.undecrypted_events.add(
+                    key_event.room_id,
+                    undecrypted_event
+                )
                 continue
 
-            event = self.client.decrypt_event(undecrypted_event)
-            if event:
-                decrypted_events.append((undecrypted_event, event))
+            decrypted_events.append(event)
+
+        self.handle_decrypted_events(room_buffer, decrypted_events)
+
+    def decrypt_in_background(self, event):
+        # type: (MegolmEvent) -> bool
+        """Hand an undecrypted event over to the decryption workers.
+
+        Returns True if the event will be decrypted in the background, the
+        room buffer is notified about the result with
+        replace_undecrypted_lines() or undecryptable_line().
+        """
+        if not self.client:
+            return False
+
+        session = self.client.background_session(event)
+
+        if not session:
+            return False
+
+        if not self.decryption_pool:
+            self.decryption_pool = WorkerPool(
+                "{}.decryption".format(self.name),
+                G.CONFIG.network.decryption_threads
+            )
+
+        # Decrypting doesn't modify the session, the rest of the decryption
+        # happens in _megolm_decrypted() on the main thread.
+        self.decryption_pool.submit(
+            session.decrypt,
+            (event.ciphertext,),
+            partial(self._megolm_decrypted, event, session),
+            event.session_id
+        )
+
+        return True
+
+    def _megolm_decrypted(self, undecrypted_event, session, result, error):
+        room_buffer = self.room_buffers.get(undecrypted_event.room_id)
+
+        if not room_buffer or not self.client:
+            return
+
+        event = None
+
+        if not error:
+            plaintext, message_index = result
+
+            try:
+                event = self.client.finish_megolm_decryption(
+                    undecrypted_event,
+                    session,
+                    plaintext,
+                    message_index
+                )
+            except EncryptionError:
+                pass
+
+        # Events that fail to parse don't have an event id we could use to
+        # find their line, treat them like the ones we couldn't decrypt.
+        if not event or isinstance(event, UnknownBadEvent):
+            room_buffer.undecryptable_line(undecrypted_event)
+            return
+
+        self.handle_decrypted_events(room_buffer, [event])
 
-        for event_pair in decrypted_events:
-            undecrypted_event, event = event_pair
-            room_buffer.undecrypted_events.remove(undecrypted_event)
-            room_buffer.replace_undecrypted_line(event)
+    @staticmethod
+    def handle_decrypted_events(room_buffer, events):
+        # type: (RoomBuffer, List[Union[Event, BadEventType]]) -> None
+        """Let the room and the buffer know about events that were decrypted
+        after their placeholder was printed."""
+        for event in events:
+            if not isinstance(event, (BadEvent, UnknownBadEvent)):
+                room_buffer.room.handle_event(event)
+
+        room_buffer.replace_undecrypted_lines(events)
+
+    def stop_decryption_pool(self):
+        if self.decryption_pool:
+            pool = self.decryption_pool
+            self.decryption_pool = None
+            pool.shutdown()
 
     def start_verification(self, device):
         _, request = self.client.start_key_verification(device)
@@ -1479,6 +1951,66 @@ class MatrixServer(object):
         _, request = self.client.to_device(message)
         self.send(request)
 
+    def schedule_to_device_flush(self):
+        """Send out the queued to-device messages on the next main loop
+        iteration, messages that get queued until then end up in the same
+        requests."""
+        if self.to_device_hook or not self.client:
+            return
+
+        if not self.client.outgoing_to_device_messages:
+            return
+
+        self.to_device_hook = W.hook_timer(
+            1, 0, 1, "matrix_to_device_cb", self.name
+        )
+
+    def flush_to_device_messages(self):
+        """Send out all queued to-device messages that aren't already on
+        their way.
+
+        Messages of the same type are merged into a single request.
+        """
+        if not self.connected or not self.client.logged_in:
+            return
+
+        batches = defaultdict(list) \
+            # type: DefaultDict[str, List[ToDeviceBatch]]
+
+        for message in self.client.outgoing_to_device_messages:
+            if id(message) in self.to_device_in_flight:
+                continue
+
+            type_batches = batches[message.type]
+
+            if not any(batch.add(message) for batch in type_batches):
+                batch = ToDeviceBatch(message.type)
+                batch.add(message)
+                type_batches.append(batch)
+
+        for type_batches in batches.values():
+            for batch in type_batches:
+                _, request = self.client.to_device(batch, batch.tx_id)
+                self.send(request)
+
+                self.to_device_sent[batch.tx_id] = batch
+                self.to_device_in_flight.update(
+                    id(message) for message in batch.messages
+                )
+
+    def _to_device_done(self, batch, sent):
+        # type: (ToDeviceBatch, bool) -> None
+        if self.to_device_sent.pop(batch.tx_id, None) is None:
+            return
+
+        for message in batch.messages:
+            self.to_device_in_flight.discard(id(message))
+
+            # Nio only knows about the individual messages, let it mark them
+            # as sent one by one.
+            if sent and self.client.olm:
+                self.client.olm.handle_response(ToDeviceResponse(message))
+
     def confirm_sas(self, sas):
         _, request = self.client.confirm_short_auth_string(sas.transaction_id)
         self.send(request)
@@ -1486,6 +2018,7 @@ class MatrixServer(object):
         device = sas.other_olm_device
 
         if sas.verified:
+            self.devices_changed()
             self.info("Device {} of user {} successfully verified".format(
                 device.id,
                 device.user_id
@@ -1515,9 +2048,9 @@ class MatrixServer(object):
                 }
                 W.hook_hsignal_send("matrix_room_key_received", message)
 
-                # TODO try to decrypt some cached undecrypted messages with the
-                # new key
-                # self.decrypt_printed_messages(event)
+                # This handles forwarded room keys as well, they are a
+                # subclass of the room key event.
+                self.decrypt_printed_messages(event)
 
         if self.client.should_upload_keys:
             self.keys_upload()
@@ -1540,19 +2073,21 @@ class MatrixServer(object):
                 if (not G.CONFIG.network.lazy_load_room_users
                         or room_buffer.room.encrypted
                         or room_buffer.room.member_count <= 1):
-                    self.rooms_with_missing_members.append(
+                    self.rooms_with_missing_members.add(
                         room_buffer.room.room_id
                     )
             if room_buffer.unhandled_users:
                 self._hook_lazy_user_adding()
                 break
 
+        self._update_room_metadata(response)
+
         self.next_batch = response.next_batch
         self.schedule_sync()
         W.bar_item_update("matrix_typing_notice")
 
         if self.rooms_with_missing_members:
-            self.get_joined_members(self.rooms_with_missing_members.pop())
+            self.fetch_missing_members()
 
     def handle_delete_device_auth(self, response):
         device_id = self.device_deletion_queue.pop(response.uuid, None)
@@ -1580,8 +2115,9 @@ class MatrixServer(object):
         if isinstance(response, (SyncError, LoginError)):
             self.disconnect()
         elif isinstance(response, JoinedMembersError):
-            self.rooms_with_missing_members.append(response.room_id)
-            self.get_joined_members(self.rooms_with_missing_members.pop())
+            self.member_requests.discard(response.room_id)
+            self.rooms_with_missing_members.add(response.room_id)
+            self.fetch_missing_members()
         elif isinstance(response, RoomSendError):
             self.handle_own_messages_error(response)
         elif isinstance(response, ShareGroupSessionError):
@@ -1593,10 +2129,8 @@ class MatrixServer(object):
             )
 
         elif isinstance(response, ToDeviceError):
-            try:
-                self.to_device_sent.remove(response.to_device_message)
-            except ValueError:
-                pass
+            if isinstance(response.to_device_message, ToDeviceBatch):
+                self._to_device_done(response.to_device_message, False)
 
     def handle_response(self, response):
         # type: (Response) -> None
@@ -1619,10 +2153,8 @@ class MatrixServer(object):
                 room_buffer.backlog_pending = False
 
         elif isinstance(response, ToDeviceResponse):
-            try:
-                self.to_device_sent.remove(response.to_device_message)
-            except ValueError:
-                pass
+            if isinstance(response.to_device_message, ToDeviceBatch):
+                self._to_device_done(response.to_device_message, True)
 
         elif isinstance(response, LoginResponse):
             self._handle_login(response)
@@ -1653,6 +2185,7 @@ class MatrixServer(object):
 
         elif isinstance(response, KeysQueryResponse):
             self.keys_queried = False
+            self.devices_changed()
             W.bar_item_update("buffer_modes")
             W.bar_item_update("matrix_modes")
 
@@ -1668,24 +2201,19 @@ class MatrixServer(object):
                     W.hook_hsignal_send("matrix_device_changed", message)
 
         elif isinstance(response, JoinedMembersResponse):
-            self.member_request_list.remove(response.room_id)
+            self.member_requests.discard(response.room_id)
             room_buffer = self.room_buffers[response.room_id]
             users = [user.user_id for user in response.members]
 
             # Don't add the users directly use the lazy load hook.
-            room_buffer.unhandled_users += users
+            room_buffer.queue_users(users)
             self._hook_lazy_user_adding()
             room_buffer.members_fetched = True
             room_buffer.update_buffer_name()
 
-            # Fetch the users for the next room.
-            if self.rooms_with_missing_members:
-                self.get_joined_members(self.rooms_with_missing_members.pop())
-            # We are done adding all the users, do a full key query now since
-            # the client knows all the encrypted room members.
-            else:
-                if self.client.should_query_keys and not self.keys_queried:
-                    self.keys_query()
+            # Fetch the users for the next rooms, or do a full key query if
+            # this was the last one.
+            self.fetch_missing_members()
 
         elif isinstance(response, KeysClaimResponse):
             self.keys_claimed[response.room_id] = False
@@ -1696,6 +2224,11 @@ class MatrixServer(object):
                     self.ignore_while_sharing[response.room_id]
                 )
             except OlmTrustError as e:
+                # The keys might have been claimed because the user started
+                # typing, only complain if a message is waiting to be sent.
+                if not self.encryption_queue[response.room_id]:
+                    return
+
                 m = ("Untrusted devices found in room: {}".format(e))
                 room_buffer = self.find_room_from_id(response.room_id)
                 room_buffer.error(m)
@@ -1756,7 +2289,14 @@ class MatrixServer(object):
 
     def create_room_buffer(self, room_id, prev_batch):
         room = self.client.rooms[room_id]
-        buf = RoomBuffer(room, self.name, self.homeserver, prev_batch)
+        buf = RoomBuffer(
+            room,
+            self.name,
+            self.homeserver,
+            prev_batch,
+            self.undecrypted_events,
+            self.user_registry
+        )
 
         # We sadly don't get a correct summary on full_state from synapse so we
         # can't trust it that the members are fully synced
@@ -1775,6 +2315,11 @@ class MatrixServer(object):
         except (ValueError, KeyError):
             return None
 
+    def _room_displayed(self, room_id):
+        # type: (str) -> bool
+        room_buffer = self.room_buffers.get(room_id)
+        return bool(room_buffer and room_buffer.weechat_buffer.displayed)
+
     def find_room_from_id(self, room_id):
         room_buffer = self.room_buffers[room_id]
         return room_buffer
@@ -1785,43 +2330,45 @@ class MatrixServer(object):
             the configuration option matrix.network.max_nicklist_users. It
             removes users that have not been active for a day until there are
             less than max_nicklist_users or no users are left for removal.
-            It never removes users that have a bigger power level than the
-            default one.
-        This function is run every hour by the server timer callback"""
+            Users that spoke the least recently are removed first, it never
+            removes users that have a bigger power level than the default one.
+        This function is run every hour by the server timer callback, it only
+            picks the rooms that need cleaning up, the users are removed in
+            small batches by collect_users()."""
+
+        self.user_gc_time = time.time()
+        self.user_gc_rooms = deque(
+            room_buffer for room_buffer in self.room_buffers.values()
+            if (len(room_buffer.displayed_nicks) >
+                G.CONFIG.network.max_nicklist_users)
+        )
 
-        now = time.time()
-        self.user_gc_time = now
+    def collect_users(self, n):
+        # type: (int) -> None
+        """Remove up to n inactive users from the rooms picked by the last
+        garbage_collect_users() run."""
+        older_than = self.user_gc_time - 86400
+        removed = 0
 
-        def day_passed(t1, t2):
-            return (t2 - t1) > 86400
+        while self.user_gc_rooms and removed < n:
+            room_buffer = self.user_gc_rooms[0]
+            user = None
 
-        for room_buffer in self.room_buffers.values():
-            to_remove = max(
-                (len(room_buffer.displayed_nicks) -
-                    G.CONFIG.network.max_nicklist_users),
-                0
-            )
+            if (len(room_buffer.displayed_nicks) >
+                    G.CONFIG.network.max_nicklist_users):
+                user = room_buffer.weechat_buffer.pop_stalest_user(older_than)
 
-            if not to_remove:
+            if not user:
+                self.user_gc_rooms.popleft()
                 continue
 
-            removed = 0
-            removed_user_ids = []
+            user_id = room_buffer.find_user_id(user.nick)
+            room_buffer.weechat_buffer.part(user.nick, 0, False)
 
-            for user_id, nick in room_buffer.displayed_nicks.items():
-                user = room_buffer.weechat_buffer.users[nick]
+            if user_id:
+                room_buffer.remove_displayed_nick(user_id)
 
-                if (not user.speaking_time or
-                        day_passed(user.speaking_time, now)):
-                    room_buffer.weechat_buffer.part(nick, 0, False)
-                    removed_user_ids.append(user_id)
-                    removed += 1
-
-                if removed >= to_remove:
-                    break
-
-            for user_id in removed_user_ids:
-                del room_buffer.displayed_nicks[user_id]
+            removed += 1
 
     def buffer_merge(self):
         if not self.server_buffer:
@@ -1911,15 +2458,18 @@ def matrix_config_server_change_cb(server_name, option):
 @utf8_decode
 def matrix_load_users_cb(server_name, remaining_calls):
     server = SERVERS[server_name]
+    budget = server.lazy_load_budget
+
     start = time.time()
+    lateness = budget.lateness(start)
 
-    rooms = [x for x in server.room_buffers.values() if x.unhandled_users]
+    rooms = server.lazy_load_queue()
+    users_left = server.add_unhandled_users(rooms, budget.value)
 
-    while server.add_unhandled_users(rooms, 100):
-        current = time.time()
+    budget.update(time.time() - start, lateness)
 
-        if current - start >= 0.1:
-            return W.WEECHAT_RC_OK
+    if users_left:
+        return W.WEECHAT_RC_OK
 
     # We are done adding users, we can unhook now.
     W.unhook(server.lazy_load_hook)
@@ -1928,6 +2478,15 @@ def matrix_load_users_cb(server_name, remaining_calls):
     return W.WEECHAT_RC_OK
 
 
+@utf8_decode
+def matrix_to_device_cb(server_name, remaining_calls):
+    server = SERVERS[server_name]
+    server.to_device_hook = None
+    server.flush_to_device_messages()
+
+    return W.WEECHAT_RC_OK
+
+
 @utf8_decode
 def matrix_timer_cb(server_name, remaining_calls):
     server = SERVERS[server_name]
@@ -1954,15 +2513,9 @@ def matrix_timer_cb(server_name, remaining_calls):
         server.disconnect()
         return W.WEECHAT_RC_OK
 
-    for i, message in enumerate(server.client.outgoing_to_device_messages):
-        if i >= 5:
-            break
-
-        if message in server.to_device_sent:
-            continue
-
-        server.to_device(message)
-        server.to_device_sent.append(message)
+    # Messages are usually flushed right after the response that queued
+    # them, this catches the rest.
+    server.flush_to_device_messages()
 
     if server.sync_time and current_time > server.sync_time:
         timeout = 0 if server.transport_type == TransportType.HTTP else 30000
@@ -1977,6 +2530,9 @@ def matrix_timer_cb(server_name, remaining_calls):
     if current_time > (server.user_gc_time + 3600):
         server.garbage_collect_users()
 
+    if server.user_gc_rooms:
+        server.collect_users(USER_GC_BATCH_SIZE)
+
     return W.WEECHAT_RC_OK
 
 
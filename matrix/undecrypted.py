@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2018, 2019 Damir Jelić <poljar@termina.org.uk>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Module keeping track of printed events that we couldn't decrypt."""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from nio import MegolmEvent
+
+# The default for the maximal number of undecrypted events we remember over
+# all rooms of a server.
+MAX_UNDECRYPTED_EVENTS = 10000
+
+
+class UndecryptedEvents(object):
+    """Server wide store of undecrypted megolm events.
+
+    The events are grouped by room and by the megolm session that was used to
+    encrypt them, once the room key for a session arrives all the events of
+    the session can be fetched at once.
+
+    If the store grows over its limit events are dropped from the room that
+    was least recently viewed, rooms that are currently displayed in a window
+    are only considered if no other room is left.
+    """
+
+    def __init__(self, max_events=MAX_UNDECRYPTED_EVENTS, is_displayed=None):
+        # type: (int, Optional[Callable[[str], bool]]) -> None
+        self.max_events = max_events
+        self._is_displayed = is_displayed or (lambda room_id: False)
+        # Rooms are ordered from the least recently viewed to the most
+        # recently viewed one, sessions inside a room from the least recently
+        # used one.
+        self._rooms = OrderedDict() \
+            # type: OrderedDict[str, OrderedDict[str, Dict[str, MegolmEvent]]]
+        self._count = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size(self):
+        # type: () -> int
+        """The approximate size of the stored ciphertexts in bytes."""
+        return self._size
+
+    @property
+    def room_count(self):
+        # type: () -> int
+        return len(self._rooms)
+
+    def room_stats(self):
+        # type: () -> List[Tuple[str, int, int]]
+        """Return a (room id, event count, byte size) tuple for every room,
+        the least recently viewed room first."""
+        stats = []
+
+        for room_id, sessions in self._rooms.items():
+            count = 0
+            size = 0
+            for events in sessions.values():
+                count += len(events)
+                size += sum(len(e.ciphertext) for e in events.values())
+            stats.append((room_id, count, size))
+
+        return stats
+
+    def resize(self, max_events):
+        # type: (int) -> None
+        self.max_events = max_events
+        self._evict()
+
+    def touch_room(self, room_id):
+        # type: (str) -> None
+        """Mark the room as viewed, it will be the last one to lose events."""
+        if room_id in self._rooms:
+            self._rooms.move_to_end(room_id)
+
+    def add(self, room_id, event):
+        # type: (str, MegolmEvent) -> None
+        # Events from the backlog don't get a room id from nio, we need it to
+        # decrypt the event later on.
+        if not event.room_id:
+            event.room_id = room_id
+
+        sessions = self._rooms.get(room_id)
+
+        if sessions is None:
+            sessions = OrderedDict()
+            self._rooms[room_id] = sessions
+
+        events = sessions.get(event.session_id)
+
+        if events is None:
+            events = OrderedDict()
+            sessions[event.session_id] = events
+        else:
+            sessions.move_to_end(event.session_id)
+
+        old_event = events.pop(event.event_id, None)
+
+        if old_event:
+            self._count -= 1
+            self._size -= len(old_event.ciphertext)
+
+        events[event.event_id] = event
+        self._count += 1
+        self._size += len(event.ciphertext)
+
+        self._evict()
+
+    def _eviction_order(self):
+        # type: () -> Iterator[str]
+        # Displayed rooms are only evicted as a last resort. Every room is
+        # checked at most once per eviction, the check asks weechat about the
+        # buffer of the room.
+        displayed = []
+
+        for room_id in list(self._rooms):
+            if self._is_displayed(room_id):
+                displayed.append(room_id)
+            else:
+                yield room_id
+
+        for room_id in displayed:
+            yield room_id
+
+    def _evict(self):
+        if self._count <= self.max_events:
+            return
+
+        for room_id in self._eviction_order():
+            sessions = self._rooms[room_id]
+
+            while sessions and self._count > self.max_events:
+                session_id, events = next(iter(sessions.items()))
+                _, event = events.popitem(last=False)
+                self._count -= 1
+                self._size -= len(event.ciphertext)
+
+                if not events:
+                    del sessions[session_id]
+
+            if not sessions:
+                del self._rooms[room_id]
+
+            if self._count <= self.max_events:
+                return
+
+    def pop_session(self, room_id, session_id):
+        # type: (str, str) -> List[MegolmEvent]
+        """Remove and return all the events of the given megolm session."""
+        sessions = self._rooms.get(room_id)
+
+        if not sessions:
+            return []
+
+        events = sessions.pop(session_id, None)
+
+        if not sessions:
+            del self._rooms[room_id]
+
+        if not events:
+            return []
+
+        self._count -= len(events)
+        self._size -= sum(len(e.ciphertext) for e in events.values())
+        return list(events.values())
+
+    def remove_room(self, room_id):
+        # type: (str) -> None
+        """Forget all the events of a room, e.g. when the buffer is closed."""
+        for session_id in list(self._rooms.get(room_id, ())):
+            self.pop_session(room_id, session_id)
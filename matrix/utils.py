@@ -17,8 +17,12 @@
 
 from __future__ import unicode_literals, division
 
+import re
 import time
-from typing import Any, Dict, List
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import (Any, Callable, Dict, FrozenSet, Iterable, List, Optional,
+                    Tuple)
 
 from .globals import W
 
@@ -26,6 +30,218 @@ if False:
     from .server import MatrixServer
 
 
+class OrderedSet(object):
+    """A set that remembers the insertion order of its items.
+
+    Membership tests, adding and removing items are O(1), items can be
+    drained in insertion order with pop().
+    """
+
+    def __init__(self, items=()):
+        # type: (Iterable[Any]) -> None
+        self._items = OrderedDict()  # type: OrderedDict[Any, None]
+        self.update(items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return "OrderedSet({!r})".format(list(self._items))
+
+    def add(self, item):
+        # type: (Any) -> None
+        self._items[item] = None
+
+    def update(self, items):
+        # type: (Iterable[Any]) -> None
+        for item in items:
+            self._items[item] = None
+
+    def discard(self, item):
+        # type: (Any) -> None
+        self._items.pop(item, None)
+
+    def remove(self, item):
+        # type: (Any) -> None
+        del self._items[item]
+
+    def pop(self, last=True):
+        # type: (bool) -> Any
+        """Remove and return the newest item, or the oldest one if last is
+        False."""
+        item, _ = self._items.popitem(last=last)
+        return item
+
+    def clear(self):
+        # type: () -> None
+        self._items.clear()
+
+
+class SortedSet(object):
+    """A set that keeps its items in descending order of their key.
+
+    The key of an item is computed once when the item is added. Membership
+    tests and pop() are O(1), adding and removing single items does a binary
+    search and moves the items after it.
+    """
+
+    def __init__(self, key, items=()):
+        # type: (Callable[[Any], Any], Iterable[Any]) -> None
+        self._key = key
+        self._keys = dict()  # type: Dict[Any, Any]
+        # Ascending (key, item) pairs, the first item is at the end.
+        self._sorted = []  # type: List[Tuple[Any, Any]]
+        self.update(items)
+
+    def __contains__(self, item):
+        return item in self._keys
+
+    def __iter__(self):
+        return (item for _, item in reversed(self._sorted))
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def __repr__(self):
+        return "SortedSet({!r})".format(list(self))
+
+    def add(self, item):
+        # type: (Any) -> None
+        if item in self._keys:
+            return
+
+        key = self._key(item)
+        self._keys[item] = key
+        insort(self._sorted, (key, item))
+
+    def update(self, items):
+        # type: (Iterable[Any]) -> None
+        new = []
+
+        for item in items:
+            if item not in self._keys:
+                key = self._key(item)
+                self._keys[item] = key
+                new.append((key, item))
+
+        if len(new) > 1:
+            # Merging the sorted runs of the old and new items is linear.
+            new.sort()
+            self._sorted.extend(new)
+            self._sorted.sort()
+        elif new:
+            insort(self._sorted, new[0])
+
+    def discard(self, item):
+        # type: (Any) -> None
+        if item not in self._keys:
+            return
+
+        key = self._keys.pop(item)
+        del self._sorted[bisect_left(self._sorted, (key, item))]
+
+    def pop(self):
+        # type: () -> Any
+        """Remove and return the item with the largest key."""
+        _, item = self._sorted.pop()
+        del self._keys[item]
+        return item
+
+
+# The default bridge puppet rules, puppets of bridges that encode the remote
+# nick in their user id get their nick from the user id, the rest uses their
+# display name.
+DEFAULT_BRIDGE_NICK_RULES = ";".join(
+    [
+        "{}=displayname".format(prefix) for prefix in (
+            "@_discord_",
+            "@_slack_",
+            "@_discordpuppet_",
+            "@_slackpuppet_",
+            "@whatsapp_",
+            "@facebook_",
+            "@telegram_",
+            "@signal_",
+            "@_telegram_",
+            "@_xmpp_",
+            "@irc_",
+        )
+    ] + [
+        "{}=strip".format(prefix) for prefix in (
+            "@twilio_",
+            "@freenode_",
+            "@_ircnet_",
+            "@_oftc_",
+            "@gitter_",
+        )
+    ]
+)
+
+
+class BridgeNickRules(object):
+    """Rules to pick the nick of bridge puppet users.
+
+    Every rule maps a user id prefix to an action:
+        displayname: Use the display name of the user (if there is one).
+        strip: Use the user id with the prefix and the server part removed.
+
+    All the prefixes are compiled into a single anchored regex, longer
+    prefixes win over shorter ones.
+    """
+
+    DISPLAY_NAME = "displayname"
+    STRIP = "strip"
+
+    def __init__(self, rules):
+        # type: (List[Tuple[str, str]]) -> None
+        self.rules = dict(rules)  # type: Dict[str, str]
+
+        if self.rules:
+            prefixes = sorted(self.rules, key=len, reverse=True)
+            self._regex = re.compile(
+                "|".join(re.escape(prefix) for prefix in prefixes)
+            )  # type: Optional[Any]
+        else:
+            self._regex = None
+
+    @classmethod
+    def parse(cls, value):
+        # type: (str) -> BridgeNickRules
+        """Parse a rule string ("@prefix_=displayname;@other_=strip")."""
+        rules = []
+
+        for setting in value.split(";"):
+            prefix, _, action = setting.strip().rpartition("=")
+
+            # skip malformed settings
+            if not prefix or action not in (cls.DISPLAY_NAME, cls.STRIP):
+                continue
+
+            rules.append((prefix, action))
+
+        return cls(rules)
+
+    def nick(self, user_id, display_name=None):
+        # type: (str, Optional[str]) -> str
+        """Return the nick that should be shown for a user."""
+        match = self._regex.match(user_id) if self._regex else None
+
+        if match:
+            if self.rules[match.group()] == self.STRIP:
+                return strip_matrix_server(user_id[match.end():])
+
+            if display_name:
+                return display_name[0:50]
+
+        return shorten_sender(user_id)
+
+
 def key_from_value(dictionary, value):
     # type: (Dict[str, Any], Any) -> str
     return list(dictionary.keys())[list(dictionary.values()).index(value)]
@@ -104,6 +320,128 @@ def shorten_sender(sender):
     return strip_matrix_server(sender)[1:]
 
 
+# Escape sequences returned by W.color(), keyed by the color name.
+COLOR_CACHE = dict()  # type: Dict[str, str]
+COLOR_CACHE_SIZE = 1024
+
+
+def cached_color(color_name):
+    # type: (str) -> str
+    """Like W.color() but the result is remembered.
+
+    The same handful of colors is needed for every printed line, this saves
+    the round trip into weechat. Escapes of weechat.color.* options are
+    resolved at display time, but the ones of other plugin options embed the
+    color, the cache needs to be cleared with clear_color_cache() if one of
+    those changes.
+    """
+    try:
+        return COLOR_CACHE[color_name]
+    except KeyError:
+        if len(COLOR_CACHE) >= COLOR_CACHE_SIZE:
+            COLOR_CACHE.clear()
+
+        color = W.color(color_name)
+        COLOR_CACHE[color_name] = color
+        return color
+
+
+def clear_color_cache():
+    COLOR_CACHE.clear()
+
+
+CONDITION_REFERENCE = re.compile(r"\$\{([^{}]*)\}")
+LOCAL_VARIABLE_REFERENCE = re.compile(r"buffer\.local_variables\.\w+$")
+VARIABLE_REFERENCE = re.compile(r"\w+$")
+
+
+class ConditionCache(object):
+    """Cache of evaluated weechat conditions.
+
+    Weechat evaluates conditions in the context of the current buffer and
+    window. The result is remembered for the condition string, the current
+    buffer and the extra variables that are passed to the condition, it needs
+    to be cleared if the local variables of a buffer change.
+
+    Only conditions that reference nothing but the extra variables and
+    explicitly the local variables of the buffer are cached. Other names,
+    e.g. ${date} or ${window}, infos, options, window properties or secured
+    data can change without us noticing.
+    """
+
+    def __init__(self):
+        self._results = dict()  # type: Dict[Tuple[str, str, Tuple], bool]
+        self._variables = dict()  # type: Dict[str, Optional[FrozenSet[str]]]
+
+    def __len__(self):
+        return len(self._results)
+
+    def _referenced_variables(self, condition):
+        # type: (str) -> Optional[FrozenSet[str]]
+        """Get the names that the condition references without a prefix,
+        None if it references something that can't be cached."""
+        try:
+            return self._variables[condition]
+        except KeyError:
+            pass
+
+        references = CONDITION_REFERENCE.findall(condition)
+        variables = None  # type: Optional[FrozenSet[str]]
+
+        # Nested references aren't found by the regex.
+        if condition.count("${") == len(references):
+            names = set()
+
+            for reference in references:
+                if LOCAL_VARIABLE_REFERENCE.match(reference):
+                    continue
+
+                if not VARIABLE_REFERENCE.match(reference):
+                    break
+
+                names.add(reference)
+            else:
+                variables = frozenset(names)
+
+        self._variables[condition] = variables
+        return variables
+
+    def cacheable(self, condition, extra_vars):
+        # type: (str, Dict[str, str]) -> bool
+        variables = self._referenced_variables(condition)
+        return variables is not None and variables.issubset(extra_vars)
+
+    def evaluate(self, condition, extra_vars):
+        # type: (str, Dict[str, str]) -> bool
+        if not self.cacheable(condition, extra_vars):
+            return self._evaluate(condition, extra_vars)
+
+        key = (condition, W.current_buffer(), tuple(sorted(extra_vars.items())))
+
+        try:
+            return self._results[key]
+        except KeyError:
+            result = self._evaluate(condition, extra_vars)
+            self._results[key] = result
+            return result
+
+    @staticmethod
+    def _evaluate(condition, extra_vars):
+        # type: (str, Dict[str, str]) -> bool
+        return bool(int(W.string_eval_expression(
+            condition,
+            {},
+            extra_vars,
+            {"type": "condition"}
+        )))
+
+    def clear(self):
+        self._results.clear()
+
+
+CONDITION_CACHE = ConditionCache()
+
+
 def string_strikethrough(string):
     return "".join(["{}\u0336".format(c) for c in string])
 
@@ -112,7 +450,7 @@ def string_color_and_reset(string, color):
     """Color string with color, then reset all attributes."""
 
     lines = string.split('\n')
-    lines = ("{}{}{}".format(W.color(color), line, W.color("reset"))
+    lines = ("{}{}{}".format(cached_color(color), line, cached_color("reset"))
              for line in lines)
     return "\n".join(lines)
 
@@ -121,7 +459,8 @@ def string_color(string, color):
     """Color string with color, then reset the color attribute."""
 
     lines = string.split('\n')
-    lines = ("{}{}{}".format(W.color(color), line, W.color("resetcolor"))
+    lines = ("{}{}{}".format(cached_color(color), line,
+                             cached_color("resetcolor"))
              for line in lines)
     return "\n".join(lines)
 
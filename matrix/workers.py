@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2018, 2019 Damir Jelić <poljar@termina.org.uk>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER
+# RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF
+# CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Module implementing background worker threads.
+
+Weechat isn't thread safe, none of the weechat API may be used from a worker
+thread. Workers only run the pure python (or C library) part of a job, the
+result is handed back to the weechat main loop through a pipe that is watched
+with hook_fd(). Result callbacks always run on the main loop.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # type: ignore
+
+from .globals import W
+from .utf import utf8_decode
+
+# Pools that are currently running, keyed by their name so the fd callback
+# can find them.
+WORKER_POOLS = dict()  # type: Dict[str, WorkerPool]
+
+
+class WorkerPoolShutdown(Exception):
+    """Passed to the callback of jobs that never ran."""
+
+
+class WorkerPool(object):
+    """A small pool of worker threads.
+
+    Every worker has its own job queue, jobs that are submitted with the same
+    key always end up on the same worker which keeps them ordered relative to
+    each other.
+    """
+
+    def __init__(self, name, thread_count):
+        # type: (str, int) -> None
+        self.name = name
+        self._results = deque()  # type: Deque[Tuple[Callable, Any, Any]]
+        self._next_worker = 0
+        self._read_fd, self._write_fd = os.pipe()
+
+        for fd in (self._read_fd, self._write_fd):
+            os.set_blocking(fd, False)
+
+        self._queues = [queue.Queue() for _ in range(max(thread_count, 1))]
+        self._threads = []  # type: List[threading.Thread]
+
+        for i, job_queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._work,
+                args=(job_queue,),
+                name="{}-worker-{}".format(name, i),
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        self._fd_hook = W.hook_fd(
+            self._read_fd, 1, 0, 0, "worker_pool_fd_cb", name
+        )
+
+        WORKER_POOLS[name] = self
+
+    def submit(self, func, args, callback, key=None):
+        # type: (Callable, Tuple, Callable[[Any, Any], None], Any) -> None
+        """Run func(*args) on a worker thread.
+
+        The callback is called on the main loop with the result of the function
+        and an exception, one of them will always be None.
+        """
+        if key is None:
+            index = self._next_worker
+            self._next_worker = (index + 1) % len(self._queues)
+        else:
+            index = hash(key) % len(self._queues)
+
+        self._queues[index].put((func, args, callback))
+
+    def _work(self, job_queue):
+        while True:
+            job = job_queue.get()
+
+            if job is None:
+                return
+
+            func, args, callback = job
+
+            try:
+                result, error = func(*args), None
+            except Exception as e:  # pylint: disable=broad-except
+                result, error = None, e
+
+            self._results.append((callback, result, error))
+            self._wake_up()
+
+    def _wake_up(self):
+        try:
+            os.write(self._write_fd, b"\0")
+        except OSError:
+            # The pipe is full, the main loop has a wakeup pending anyways.
+            pass
+
+    def dispatch(self):
+        """Run the callbacks of all finished jobs."""
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError:
+            pass
+
+        while self._results:
+            callback, result, error = self._results.popleft()
+
+            try:
+                callback(result, error)
+            except BaseException:
+                # The pipe is already drained, make sure the main loop comes
+                # back for the remaining results before the error propagates.
+                if self._results:
+                    self._wake_up()
+                raise
+
+    def shutdown(self):
+        """Stop the workers.
+
+        Jobs that didn't start yet are cancelled, their callbacks receive a
+        WorkerPoolShutdown error.
+        """
+        W.unhook(self._fd_hook)
+        WORKER_POOLS.pop(self.name, None)
+
+        cancelled = []
+
+        for job_queue in self._queues:
+            while True:
+                try:
+                    job = job_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                if job:
+                    cancelled.append(job)
+
+            job_queue.put(None)
+
+        for thread in self._threads:
+            thread.join()
+
+        self.dispatch()
+
+        for _, _, callback in cancelled:
+            callback(None, WorkerPoolShutdown())
+
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+@utf8_decode
+def worker_pool_fd_cb(pool_name, file_descriptor):
+    pool = WORKER_POOLS.get(pool_name)
+
+    if pool:
+        pool.dispatch()
+
+    return W.WEECHAT_RC_OK
@@ -2,11 +2,92 @@
 
 from __future__ import unicode_literals
 
-from matrix.buffer import WeechatChannelBuffer
-from matrix.utils import parse_redact_args
+from nio import (
+    MatrixRoom,
+    RedactionEvent,
+    RoomMemberEvent,
+    RoomTopicEvent,
+    UnknownEvent,
+)
+
+from matrix.buffer import (
+    RoomBuffer,
+    RoomUser,
+    UserRegistry,
+    WeechatChannelBuffer,
+)
+from matrix.completion import UserCompletionIndex
+from matrix.server import MatrixServer
+from matrix.utils import (
+    BridgeNickRules,
+    ConditionCache,
+    OrderedSet,
+    SortedSet,
+    parse_redact_args,
+)
+from matrix._weechat import MockConfig
+import matrix.globals as G
+
+G.CONFIG = MockConfig()
 
 
 class TestClass(object):
+    def test_condition_cache(self, monkeypatch):
+        evaluated = []
+
+        def string_eval_expression(condition, pointers, extra_vars, options):
+            evaluated.append(condition)
+            return extra_vars["markers_enabled"]
+
+        monkeypatch.setattr(
+            G.W, "string_eval_expression", string_eval_expression,
+            raising=False
+        )
+
+        cache = ConditionCache()
+        condition = "${markers_enabled}"
+
+        assert cache.evaluate(condition, {"markers_enabled": "1"})
+        assert cache.evaluate(condition, {"markers_enabled": "1"})
+        assert not cache.evaluate(condition, {"markers_enabled": "0"})
+        assert len(evaluated) == 2
+
+        cache.clear()
+        assert cache.evaluate(condition, {"markers_enabled": "1"})
+        assert len(evaluated) == 3
+
+    def test_condition_cache_skips_dynamic_conditions(self, monkeypatch):
+        evaluated = []
+
+        def string_eval_expression(condition, *_):
+            evaluated.append(condition)
+            return "1"
+
+        monkeypatch.setattr(
+            G.W, "string_eval_expression", string_eval_expression,
+            raising=False
+        )
+
+        cache = ConditionCache()
+        conditions = [
+            "${typing_enabled}",
+            "${typing_enabled} && ${buffer.local_variables.server}",
+            "${typing_enabled} && ${server}",
+            "${typing_enabled} && ${date}",
+            "${typing_enabled} && ${date:%H} < 22",
+            "${typing_enabled} && ${info:away}",
+            "${typing_enabled} && ${weechat.look.buffer_time_format}",
+            "${window.number} == 1",
+            "${sec.data.${typing_enabled}}",
+        ]
+
+        for _ in range(2):
+            for condition in conditions:
+                assert cache.evaluate(condition, {"typing_enabled": "1"})
+
+        assert len(cache) == 2
+        assert evaluated == conditions + conditions[2:]
+
     def test_buffer(self):
         b = WeechatChannelBuffer("test_buffer_name", "example.org", "alice")
         assert b
@@ -16,6 +97,256 @@ class TestClass(object):
         b.message("alice", "hello world", 0, 0)
         assert b
 
+    def test_room_buffer_nick_collision(self):
+        room = MatrixRoom("!test:example.org", "@alice:example.org")
+        room.add_member("@bob:example.org", "Bob", None)
+        room.add_member("@bob:other.org", "Bob", None)
+        homeserver = MatrixServer._parse_url("example.org", 443)
+        b = RoomBuffer(room, "example", homeserver, None)
+
+        b.add_user("@bob:example.org", 0, False)
+        b.add_user("@bob:other.org", 0, False)
+        assert b.find_nick("@bob:example.org") == "bob"
+        assert b.find_nick("@bob:other.org") == "bob:other.org"
+        assert b.find_user_id("bob:other.org") == "@bob:other.org"
+
+        b.remove_displayed_nick("@bob:example.org")
+        assert b.find_user_id("bob") is None
+        assert b.find_user_id("bob:other.org") == "@bob:other.org"
+
+    def test_user_registry_shared_between_rooms(self):
+        registry = UserRegistry()
+        homeserver = MatrixServer._parse_url("example.org", 443)
+        buffers = []
+
+        for room_id in ("!a:example.org", "!b:example.org"):
+            room = MatrixRoom(room_id, "@alice:example.org")
+            room.add_member("@bob:example.org", "Bob", None)
+            b = RoomBuffer(room, "example", homeserver, None, None, registry)
+            b.add_user("@bob:example.org", 0, False)
+            buffers.append(b)
+
+        first, second = (b.weechat_buffer.users["bob"] for b in buffers)
+        assert first is not second
+        assert first.host is second.host
+        assert first.color is second.color
+        assert len(registry) == 1
+        assert not hasattr(first, "__dict__")
+
+        # Users are forgotten once the last room stops displaying them.
+        buffers[0].remove_displayed_nick("@bob:example.org")
+        assert len(registry) == 1
+        buffers[1].remove_displayed_nick("@bob:example.org")
+        assert len(registry) == 0
+        assert not registry._colors
+
+    def test_power_level_diff(self):
+        room = MatrixRoom("!test:example.org", "@alice:example.org")
+        homeserver = MatrixServer._parse_url("example.org", 443)
+        b = RoomBuffer(room, "example", homeserver, None)
+
+        for name in ("alice", "bob", "carol"):
+            room.add_member("@{}:example.org".format(name), None, None)
+            b.add_user("@{}:example.org".format(name), 0, True, True)
+
+        updated = []
+        b.weechat_buffer.remove_user_from_nicklist = updated.append
+
+        room.power_levels.users = {"@alice:example.org": 100}
+        b._handle_power_level(None)
+        assert [u.nick for u in updated] == ["alice"]
+        assert b.weechat_buffer.users["alice"].prefix == "&"
+
+        # Same prefix, nothing to do.
+        del updated[:]
+        room.power_levels.users = {"@alice:example.org": 101}
+        b._handle_power_level(None)
+        assert updated == []
+
+        # Users removed from the map fall back to the default level.
+        room.power_levels.users = {"@bob:example.org": 50}
+        b._handle_power_level(None)
+        assert sorted(u.nick for u in updated) == ["alice", "bob"]
+        assert b.weechat_buffer.users["alice"].prefix == ""
+
+    def test_replace_unprinted_decrypted_events(self, monkeypatch):
+        class Line(object):
+            def __init__(self, event_id):
+                self.tags = ["matrix_id_{}".format(event_id)]
+                self.message = "<Decrypting...>"
+
+            def update(self, prefix, message):
+                self.message = message
+
+        lines = [Line("$reaction"), Line("$redaction")]
+        monkeypatch.setattr(
+            WeechatChannelBuffer, "lines", property(lambda self: lines)
+        )
+
+        room = MatrixRoom("!test:example.org", "@alice:example.org")
+        homeserver = MatrixServer._parse_url("example.org", 443)
+        b = RoomBuffer(room, "example", homeserver, None)
+
+        redacted = []
+        b._redact_line = redacted.append
+
+        source = {"sender": "@bob:example.org", "origin_server_ts": 0}
+        reaction = UnknownEvent(
+            dict(source, event_id="$reaction"), "m.reaction"
+        )
+        redaction = RedactionEvent(
+            dict(source, event_id="$redaction"), "$message"
+        )
+
+        b.replace_undecrypted_lines([reaction, redaction])
+
+        assert [line.message for line in lines] == ["", ""]
+        assert redacted == [redaction]
+
+    def test_metadata_updated_once_per_sync(self, monkeypatch):
+        monkeypatch.setattr(G.CONFIG.network, "max_nicklist_users", 1000)
+        room = MatrixRoom("!test:example.org", "@alice:example.org")
+        homeserver = MatrixServer._parse_url("example.org", 443)
+        b = RoomBuffer(room, "example", homeserver, None)
+
+        renames = []
+        b.update_buffer_name = lambda: renames.append(room.display_name)
+
+        for i in range(50):
+            user_id = "@user{}:example.org".format(i)
+            room.add_member(user_id, None, None)
+            source = {
+                "event_id": "$join{}".format(i),
+                "sender": user_id,
+                "origin_server_ts": 0,
+            }
+            event = RoomMemberEvent(
+                source, user_id, "join", None, {"membership": "join"}
+            )
+            b.handle_state_event(event)
+
+        topic = RoomTopicEvent(
+            {"event_id": "$topic", "sender": "@alice:example.org",
+             "origin_server_ts": 0},
+            "Hello",
+        )
+        b.handle_state_event(topic)
+
+        assert renames == []
+        assert b.name_dirty
+        assert b.pending_topic == "Hello"
+
+        assert not b.update_metadata()
+        assert len(renames) == 1
+        assert b.pending_topic is None
+
+        b.update_metadata()
+        assert len(renames) == 1
+
+    def test_queue_users_sorted(self):
+        room = MatrixRoom("!test:example.org", "@alice:example.org")
+        homeserver = MatrixServer._parse_url("example.org", 443)
+        b = RoomBuffer(room, "example", homeserver, None)
+
+        for name in ("bob", "Carol", "alice", "dave"):
+            room.add_member("@{}:example.org".format(name), None, None)
+
+        b.queue_users(["@bob:example.org", "@Carol:example.org"])
+        b.queue_users(["@alice:example.org", "@dave:example.org"])
+        assert list(b.unhandled_users) == [
+            "@dave:example.org",
+            "@Carol:example.org",
+            "@bob:example.org",
+            "@alice:example.org",
+        ]
+
+    def test_user_completion_index(self):
+        users = ["@bob:x", "@Bobby:x", "@alice:x", "@bo:y", "@carol:x"]
+        speaking_times = {"@bo:y": 10, "@Bobby:x": 20}
+        index = UserCompletionIndex()
+
+        assert index.complete(users, "bo", speaking_times.get) == [
+            "Bobby:x", "bo:y", "bob:x"
+        ]
+        assert index.complete(users, "@BOB", speaking_times.get, 1) == [
+            "Bobby:x"
+        ]
+        assert index.complete(users, "dave", speaking_times.get) == []
+
+        users.append("@dave:x")
+        assert index.complete(users, "dave", speaking_times.get) == ["dave:x"]
+
+        # Recent speakers are offered even if they are past the matches that
+        # get ranked.
+        users = ["@user{:05}:x".format(i) for i in range(5000)]
+        index = UserCompletionIndex()
+        completions = index.complete(
+            users, "u", lambda _: None, 3,
+            recent_speakers=["@user04999:x", "@gone:x", "@bob:x"]
+        )
+        assert completions == ["user04999:x", "user00000:x", "user00001:x"]
+
+    def test_ordered_set(self):
+        users = OrderedSet(["@c:x", "@a:x", "@b:x", "@a:x"])
+        assert list(users) == ["@c:x", "@a:x", "@b:x"]
+
+        users.discard("@a:x")
+        users.discard("@missing:x")
+        assert "@a:x" not in users
+        assert users.pop(last=False) == "@c:x"
+        assert len(users) == 1
+
+    def test_sorted_set(self):
+        keys = []
+
+        def key(user_id):
+            keys.append(user_id)
+            return user_id.lower()
+
+        users = SortedSet(key, ["@b:x", "@D:x"])
+        users.update(["@a:x", "@c:x", "@b:x"])
+        users.add("@e:x")
+        assert list(users) == ["@e:x", "@D:x", "@c:x", "@b:x", "@a:x"]
+        assert len(keys) == 5
+
+        users.discard("@c:x")
+        users.discard("@missing:x")
+        assert "@c:x" not in users
+        assert users.pop() == "@e:x"
+        assert list(users) == ["@D:x", "@b:x", "@a:x"]
+
+    def test_bridge_nick_rules(self):
+        rules = BridgeNickRules.parse(
+            "@_bridge_=displayname;@_bridge_irc_=strip;malformed;@x_=bogus"
+        )
+        assert len(rules.rules) == 2
+        assert rules.nick("@_bridge_1234:example.org", "Bob") == "Bob"
+        assert rules.nick("@_bridge_1234:example.org") == "_bridge_1234"
+        assert rules.nick("@_bridge_irc_bob:example.org", "Bob") == "bob"
+        assert rules.nick("@x_bob:example.org", "Bob") == "x_bob"
+
+    def test_pop_stalest_user(self):
+        b = WeechatChannelBuffer("test_buffer_name", "example.org", "alice")
+
+        for nick, level in (("bob", 0), ("carol", 0), ("dave", 100)):
+            b.join(RoomUser(nick, "@{}:x".format(nick), level), 0, False)
+
+        b.message("dave", "hi", 100)
+        b.message("carol", "hi", 200)
+        b.message("bob", "hi", 300)
+        b.message("carol", "hi", 400)
+
+        # Dave spoke first but he is an admin.
+        assert b.pop_stalest_user(1000).nick == "bob"
+        assert b.pop_stalest_user(1000).nick == "carol"
+        assert b.pop_stalest_user(1000) is None
+
+        b.part("bob", 0, False)
+        b.join(RoomUser("bob", "@bob:x"), 0, False)
+        b.message("bob", "hi", 500)
+        assert b.pop_stalest_user(500) is None
+        assert b.pop_stalest_user(501).nick == "bob"
+
     def test_redact_args_parse(self):
         args = '$81wbnOYZllVZJcstsnXpq7dmugA775-JT4IB-uPT680|"Hello world" No specific reason'
         event_id, reason = parse_redact_args(args)
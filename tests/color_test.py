@@ -2,13 +2,18 @@
 
 from __future__ import unicode_literals
 
+import itertools
+
 import webcolors
 from collections import OrderedDict
 from hypothesis import given
 from hypothesis.strategies import sampled_from, text, characters
 
-from matrix.colors import (G, Formatted, FormattedString,
-                           color_html_to_weechat, color_weechat_to_html)
+from matrix.colors import (G, Attributes, Formatted, FormattedString,
+                           MatrixHtmlTokenizer, XtermColorTable,
+                           color_find_rgb,
+                           color_html_to_weechat, color_weechat_to_html,
+                           markdown_closing_indexes)
 from matrix._weechat import MockConfig
 
 G.CONFIG = MockConfig()
@@ -22,6 +27,66 @@ weechat_prism = (
 
 first_16_html_colors = list(webcolors.HTML4_HEX_TO_NAMES.values())
 
+# HTML as sent by Matrix clients, used to check that both HTML parsers agree
+# and by benchmarks/html_parser_bench.py.
+MX_REPLY = (
+    '<mx-reply><blockquote><a href="https://matrix.to/#/!room:example.org/'
+    '$event:example.org">In reply to</a> <a href="https://matrix.to/#/'
+    '@alice:example.org">@alice:example.org</a><br>original</blockquote>'
+    "</mx-reply>the <em>answer</em>"
+)
+
+HTML_CORPUS = [
+    html_prism,
+    "<strong>bold</strong> <em>italic</em> <u>under</u> <del>gone</del>",
+    "<blockquote>\n<p>quoted <strong>text</strong></p>\n</blockquote>\n"
+    "<p>reply &amp; more &lt;3 &#x1F600;</p>",
+    '<pre><code class="language-python">def f(x):\n    return x &lt; 2\n'
+    "</code></pre>\n",
+    "<pre><code>plain\ncode</code></pre>",
+    'a<br>b<br/>c<br />d <font data-mx-color="#ff0000" '
+    "data-mx-bg-color='#00ff00'>colors</font>",
+    '<a href="https://example.org/?a=1&amp;b=2">link</a> <code>inline</code>',
+    "<ul>\n<li>one</li>\n<li>two</li>\n</ul>\n",
+    "<FONT COLOR=red>upper case</FONT> &nbsp;trailing",
+    MX_REPLY,
+    # Input HTMLParser has to handle.
+    "<!-- comment -->text <3 <script>if (a < b) {}</script>",
+    "unterminated &amp",
+    "<strong/>stray end</em>",
+]
+
+
+def test_html_tokenizer_matches_html_parser():
+    def substrings(html, fast):
+        return [
+            (s.text, sorted(s.attributes.items(), key=lambda a: a[0]))
+            for s in Formatted.from_html(html, fast).substrings
+        ]
+
+    corpus = HTML_CORPUS + [
+        '<font color="#ff0000" data-mx-bg-color="#0000ff">a</font>b',
+        '<code class="language-rust">x</code><em>a &lt; b</em>',
+        "<pre>pre <strong>bold</strong></pre><br>tail &amp",
+        "a &amp>",
+        "<em>unclosed",
+    ] + [
+        Formatted.from_input_line(line).to_html() for line in (
+            "**bold* bold *bital etc* bold **bold** * *italic*",
+            "norm** `code **code *code` norm `norm",
+            "\x0304Hello \x02world",
+        )
+    ]
+
+    for html in corpus:
+        assert substrings(html, True) == substrings(html, False), html
+
+
+def test_html_tokenizer_handles_replies():
+    tokenizer = MatrixHtmlTokenizer()
+    assert not tokenizer._needs_html_parser(MX_REPLY)
+    assert tokenizer._parse(MX_REPLY)
+
 
 def test_prism():
     formatted = Formatted.from_html(html_prism)
@@ -35,6 +100,21 @@ def test_color_conversion(color_name):
     assert new_color_name == color_name
 
 
+def check_xterm_color_table(table):
+    # Every 15th value of a channel plus the ones around the thresholds of
+    # color_find_rgb().
+    values = sorted(set(range(0, 256, 15)) | {
+        1, 2, 3, 47, 48, 94, 95, 113, 114, 115, 237, 238, 239, 254, 255
+    })
+
+    for r, g, b in itertools.product(values, repeat=3):
+        assert table.find(r, g, b) == color_find_rgb(r, g, b)
+
+
+def test_xterm_color_table():
+    check_xterm_color_table(XtermColorTable())
+
+
 def test_handle_strikethrough_first():
     valid_result = '\x1b[038;5;1mf̶o̶o̶\x1b[039m'
 
@@ -46,6 +126,30 @@ def test_handle_strikethrough_first():
     assert f1.to_weechat() == valid_result
     assert f2.to_weechat() == valid_result
 
+    # Rendering must not modify the attributes of the substrings.
+    assert f1.to_weechat() == valid_result
+
+
+def test_attributes_mapping():
+    attributes = Attributes({"bold": True, "fgcolor": "red"})
+
+    assert attributes["bold"] is True
+    assert attributes["italic"] is False
+    assert attributes.fgcolor == "red"
+    assert list(attributes) == list(Attributes.KEYS)
+    assert not attributes.is_default()
+    assert list(attributes.active()) == [("bold", True), ("fgcolor", "red")]
+
+    copy = attributes.copy()
+    assert copy == attributes
+    assert copy == dict(attributes.items())
+
+    copy["bold"] = False
+    copy["fgcolor"] = None
+    assert copy != attributes
+    assert copy.is_default()
+    assert copy == Attributes()
+
 
 def test_normalize_spaces_in_inline_code():
     """Normalize spaces in inline code blocks.
@@ -85,6 +189,20 @@ def test_input_line_underline():
     assert "\x1b[04mHello\x1b[024m" == formatted.to_weechat()
     assert "<u>Hello</u>" == formatted.to_html()
 
+def test_markdown_closing_indexes():
+    assert markdown_closing_indexes("plain") == {
+        "**": -1, "*": -1, "_": -1, "`": -1
+    }
+    assert markdown_closing_indexes("**a** *b* _c_ `d`") == {
+        "**": 3, "*": 8, "_": 12, "`": 16
+    }
+    # Matches don't overlap, like consecutive regex matches.
+    assert markdown_closing_indexes("a****")["**"] == 1
+    # Escapes and URLs don't contain delimiters but count as non-whitespace.
+    assert markdown_closing_indexes("\\** http://a_b*")["*"] == 2
+    assert markdown_closing_indexes("a \\_ http://a_b")["_"] == -1
+
+
 def test_input_line_markdown_emph():
     formatted = Formatted.from_input_line("*Hello*")
     assert "\x1b[03mHello\x1b[023m" == formatted.to_weechat()
@@ -123,3 +241,51 @@ def test_conversion():
     formatted = Formatted.from_input_line("*Hello*")
     formatted2 = Formatted.from_html(formatted.to_html())
     formatted.to_weechat() == formatted2.to_weechat()
+
+def test_render_cache():
+    from matrix.message_renderer import RenderCache
+
+    cache = RenderCache(max_size=2)
+    cache.put("<b>a</b>", "a")
+    cache.put("<b>b</b>", "b")
+    assert cache.get("<b>a</b>") == "a"
+
+    # b is the least recently used entry now.
+    cache.put("<b>c</b>", "c")
+    assert cache.get("<b>b</b>") is None
+    assert cache.get("<b>c</b>") == "c"
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_background_highlighting():
+    import time
+    from matrix.message_renderer import HIGHLIGHTER, RENDER_CACHE, Render
+
+    code = "\n".join("x = {}".format(i) for i in range(10))
+    html = '<pre><code class="language-python">{}</code></pre>'.format(code)
+    highlighted = Formatted.from_html(html).to_weechat()
+    results = []
+
+    G.CONFIG.look.background_highlight_lines = 5
+    RENDER_CACHE.clear()
+
+    try:
+        placeholder = Render.message(code, html, results.append)
+        assert placeholder != highlighted
+        assert placeholder.count("\n") == highlighted.count("\n")
+
+        for _ in range(100):
+            HIGHLIGHTER._pool.dispatch()
+            if results:
+                break
+            time.sleep(0.01)
+
+        assert results == [highlighted]
+        assert Render.message(code, html, results.append) == highlighted
+    finally:
+        G.CONFIG.look.background_highlight_lines = 0
+        HIGHLIGHTER.stop()
+        RENDER_CACHE.clear()
@@ -0,0 +1,103 @@
+from matrix.config import ConfigSection, Option, matrix_config_change_cb
+from matrix._weechat import MockConfig
+import matrix.globals as G
+
+G.CONFIG = MockConfig()
+
+W = G.W
+
+
+class ConfigShim(object):
+    """Keeps the option values that weechat would store, options are
+    referenced by name."""
+    def __init__(self):
+        self.values = {}
+
+    def config_new_section(self, *_):
+        return "section"
+
+    def config_new_option(self, _config, _section, name, _type, _desc,
+                          _string_values, _min, _max, default, *_):
+        self.values[name] = default
+        return name
+
+    def config_boolean(self, ptr):
+        return 1 if self.values[ptr] == "on" else 0
+
+    def config_integer(self, ptr):
+        return int(self.values[ptr])
+
+    def config_string(self, ptr):
+        return self.values[ptr]
+
+
+OPTIONS = [
+    Option("flag", "boolean", "", 0, 0, "on", "A boolean"),
+    Option("count", "integer", "", 0, 100, "5", "An integer"),
+    Option("scaled", "integer", "", 0, 100, "7", "A cast integer",
+           lambda value: value * 2),
+    Option("tint", "color", "", 0, 0, "red", "A color"),
+    Option("words", "string", "", 0, 0, "a,b", "A cast string",
+           lambda value: value.split(",")),
+]
+
+
+class PropertySection(object):
+    """The section as it used to be built, reading every option through
+    option_property."""
+    def __init__(self, option_ptrs):
+        self._option_ptrs = option_ptrs
+
+
+for _option in OPTIONS:
+    setattr(PropertySection, _option.name, ConfigSection.option_property(
+        _option.name, _option.type, cast_func=_option.cast_func
+    ))
+
+
+def old_values(section):
+    reference = PropertySection(section._option_ptrs)
+    return {o.name: getattr(reference, o.name) for o in OPTIONS}
+
+
+def new_values(section):
+    return {o.name: getattr(section, o.name) for o in OPTIONS}
+
+
+class TestClass(object):
+    def shim(self, monkeypatch):
+        shim = ConfigShim()
+        for name in ("config_new_section", "config_new_option",
+                     "config_boolean", "config_integer", "config_string"):
+            monkeypatch.setattr(W, name, getattr(shim, name), raising=False)
+        return shim
+
+    def test_refresh_matches_option_properties(self, monkeypatch):
+        shim = self.shim(monkeypatch)
+        section = ConfigSection.build("test", OPTIONS)("test", "config",
+                                                       OPTIONS)
+
+        assert new_values(section) == old_values(section)
+        assert section.flag is True
+        assert section.scaled == 14
+        assert section.words == ["a", "b"]
+
+        shim.values.update(flag="off", count="9", scaled="3", tint="blue",
+                           words="c")
+        section.refresh()
+
+        assert new_values(section) == old_values(section)
+        assert section.flag is False
+        assert section.scaled == 6
+
+    def test_change_callback_refreshes_the_option(self, monkeypatch):
+        shim = self.shim(monkeypatch)
+        section = ConfigSection.build("test", OPTIONS)("test", "config",
+                                                       OPTIONS)
+        monkeypatch.setattr(G.CONFIG, "test", section, raising=False)
+
+        shim.values["count"] = "42"
+        assert matrix_config_change_cb("test.count", "count") == \
+            W.WEECHAT_RC_OK
+        assert section.count == 42
+        assert new_values(section) == old_values(section)
@@ -1,5 +1,18 @@
-from matrix.server import MatrixServer
+import json
+
+import pytest
+from nio import EncryptionError, MegolmEvent, OlmTrustError, RoomMessageText
+from nio.crypto import InboundGroupSession
+from olm import OutboundGroupSession
+
+from matrix.server import (
+    AdaptiveBudget,
+    LAZY_LOAD_INTERVAL,
+    MatrixClient,
+    MatrixServer,
+)
 from matrix._weechat import MockConfig
+from matrix.utils import CONDITION_CACHE
 import matrix.globals as G
 
 G.CONFIG = MockConfig()
@@ -19,3 +32,174 @@ class TestClass(object):
         )
         assert homeserver.hostname == "example.org"
         assert homeserver.geturl() == "https://example.org:80/_matrix"
+
+    def test_adaptive_budget(self):
+        budget = AdaptiveBudget(target=0.05, minimum=20, maximum=200)
+        assert budget.lateness(10) == 0
+        assert budget.lateness(10 + LAZY_LOAD_INTERVAL) == 0
+
+        budget.update(0.01, 0)
+        assert budget.value == 125
+
+        for _ in range(20):
+            budget.update(0.01, 0)
+        assert budget.value == 200
+
+        budget.update(0.1, 0)
+        assert budget.value == 100
+
+        # The main loop is busy, back off even though our tick was fast.
+        lateness = budget.lateness(10 + 3 * LAZY_LOAD_INTERVAL)
+        budget.update(0.01, lateness)
+        assert budget.value == 50
+
+    def test_finish_megolm_decryption(self, tmp_path):
+        room_id = "!test:example.org"
+        client = MatrixClient(
+            "https://example.org",
+            "@alice:example.org",
+            "ALICE",
+            store_path=str(tmp_path)
+        )
+        client.user_id = "@alice:example.org"
+        client.load_store()
+
+        outbound = OutboundGroupSession()
+        session = InboundGroupSession(
+            outbound.session_key,
+            "bob_ed25519",
+            "bob_curve25519",
+            room_id
+        )
+        client.olm.inbound_group_store.add(session)
+
+        def megolm_event(event_id):
+            event = MegolmEvent.from_dict({
+                "event_id": event_id,
+                "sender": "@bob:example.org",
+                "origin_server_ts": 0,
+                "type": "m.room.encrypted",
+                "content": {
+                    "algorithm": "m.megolm.v1.aes-sha2",
+                    "sender_key": "bob_curve25519",
+                    "device_id": "BOB",
+                    "session_id": session.id,
+                    "ciphertext": outbound.encrypt(json.dumps({
+                        "type": "m.room.message",
+                        "room_id": room_id,
+                        "content": {"msgtype": "m.text", "body": event_id},
+                    })),
+                },
+            })
+            event.room_id = room_id
+            return event
+
+        event = megolm_event("$message")
+        expected = client.olm.decrypt_megolm_event(event)
+        decrypted = client.finish_megolm_decryption(
+            event, session, *session.decrypt(event.ciphertext)
+        )
+
+        assert isinstance(decrypted, RoomMessageText)
+        assert vars(decrypted) == vars(expected)
+        assert decrypted.body == "$message"
+        assert decrypted.decrypted and not decrypted.verified
+        # The sending device is unknown, its keys need to be queried.
+        assert client.olm.users_for_key_query == {"@bob:example.org"}
+        assert client.olm.inbound_group_store.get(
+            room_id, "bob_curve25519", session.id
+        ) is session
+
+        # Reusing the message index for another event is refused by both.
+        replayed = megolm_event("$replayed")
+        replayed.ciphertext = event.ciphertext
+
+        with pytest.raises(EncryptionError):
+            client.olm.decrypt_megolm_event(replayed)
+
+        with pytest.raises(EncryptionError):
+            client.finish_megolm_decryption(
+                replayed, session, *session.decrypt(replayed.ciphertext)
+            )
+
+    def test_group_session_trust_failure_is_remembered(self, monkeypatch):
+        monkeypatch.setattr(
+            G.W, "string_eval_expression", lambda *_: "1", raising=False
+        )
+        CONDITION_CACHE.clear()
+
+        shared = []
+
+        class Olm(object):
+            def should_share_group_session(self, room_id):
+                shared.append(room_id)
+                return True
+
+        class Client(object):
+            logged_in = True
+            should_query_keys = False
+            olm = Olm()
+
+            def get_missing_sessions(self, room_id):
+                return {}
+
+        def share_group_session(room_id, *_):
+            raise OlmTrustError("unverified devices")
+
+        class RoomBuffer(object):
+            members_fetched = True
+            typing_enabled = True
+
+        room_buffer = RoomBuffer()
+        room_buffer.room = type(
+            "Room", (), {"room_id": "!test:example.org", "encrypted": True}
+        )()
+        room_buffer.weechat_buffer = type("Buffer", (), {"input": "/help"})()
+
+        server = MatrixServer("test", None)
+        server._connected = True
+        server.client = Client()
+        server.share_group_session = share_group_session
+
+        server.prepare_group_session(room_buffer)
+        assert shared == []
+
+        room_buffer.weechat_buffer.input = "hello"
+        server.prepare_group_session(room_buffer)
+        server.prepare_group_session(room_buffer)
+        assert shared == ["!test:example.org"]
+
+        server.devices_changed()
+        server.prepare_group_session(room_buffer)
+        assert len(shared) == 2
+
+    def test_missing_members_are_fetched_by_priority(self, monkeypatch):
+        monkeypatch.setattr(G.CONFIG.network, "max_member_requests", 2)
+
+        class Client(object):
+            logged_in = True
+            should_query_keys = False
+
+        def room_buffer(displayed, encrypted):
+            buf = type("RoomBuffer", (), {})()
+            buf.weechat_buffer = type("Buffer", (), {"displayed": displayed})()
+            buf.room = type("Room", (), {"encrypted": encrypted})()
+            return buf
+
+        server = MatrixServer("test", None)
+        server._connected = True
+        server.client = Client()
+        server.room_buffers = {
+            "!plain:x": room_buffer(False, False),
+            "!encrypted:x": room_buffer(False, True),
+            "!displayed:x": room_buffer(True, False),
+        }
+
+        fetched = []
+        server.get_joined_members = fetched.append
+
+        server.rooms_with_missing_members.update(server.room_buffers)
+        server.fetch_missing_members()
+
+        assert fetched == ["!displayed:x", "!encrypted:x"]
+        assert list(server.rooms_with_missing_members) == ["!plain:x"]
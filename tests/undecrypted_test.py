@@ -0,0 +1,93 @@
+from matrix.undecrypted import UndecryptedEvents
+
+
+class FakeEvent(object):
+    def __init__(self, event_id, session_id, room_id=None):
+        self.event_id = event_id
+        self.session_id = session_id
+        self.room_id = room_id
+        self.ciphertext = "ciphertext"
+
+
+class TestClass(object):
+    def test_events_are_grouped_by_session(self):
+        store = UndecryptedEvents()
+        store.add("!room:example.org", FakeEvent("$1", "a"))
+        store.add("!room:example.org", FakeEvent("$2", "b"))
+        store.add("!room:example.org", FakeEvent("$3", "a"))
+
+        events = store.pop_session("!room:example.org", "a")
+
+        assert [e.event_id for e in events] == ["$1", "$3"]
+        assert events[0].room_id == "!room:example.org"
+        assert len(store) == 1
+        assert store.pop_session("!room:example.org", "a") == []
+
+    def test_duplicate_events_are_counted_once(self):
+        store = UndecryptedEvents()
+        store.add("!room:example.org", FakeEvent("$1", "a"))
+        store.add("!room:example.org", FakeEvent("$1", "a"))
+
+        assert len(store) == 1
+
+    def test_least_recently_used_session_is_evicted(self):
+        store = UndecryptedEvents(max_events=3)
+        store.add("!room:example.org", FakeEvent("$1", "a"))
+        store.add("!room:example.org", FakeEvent("$2", "b"))
+        store.add("!room:example.org", FakeEvent("$3", "a"))
+        store.add("!room:example.org", FakeEvent("$4", "c"))
+
+        assert len(store) == 3
+        assert store.pop_session("!room:example.org", "b") == []
+
+    def test_room_removal(self):
+        store = UndecryptedEvents()
+        store.add("!room:example.org", FakeEvent("$1", "a"))
+        store.add("!other:example.org", FakeEvent("$2", "b"))
+        store.remove_room("!room:example.org")
+
+        assert len(store) == 1
+
+    def test_displayed_and_viewed_rooms_are_evicted_last(self):
+        displayed = {"!open:example.org"}
+        store = UndecryptedEvents(3, lambda room_id: room_id in displayed)
+
+        store.add("!open:example.org", FakeEvent("$1", "a"))
+        store.add("!viewed:example.org", FakeEvent("$2", "b"))
+        store.add("!other:example.org", FakeEvent("$3", "c"))
+        store.touch_room("!viewed:example.org")
+
+        store.add("!other:example.org", FakeEvent("$4", "c"))
+        assert store.pop_session("!other:example.org", "c")[0].event_id == "$4"
+
+        store.add("!other:example.org", FakeEvent("$5", "c"))
+        store.add("!other:example.org", FakeEvent("$6", "c"))
+        assert len(store.pop_session("!open:example.org", "a")) == 1
+        assert store.pop_session("!viewed:example.org", "b") == []
+
+    def test_rooms_are_checked_once_per_eviction(self):
+        checked = []
+
+        def is_displayed(room_id):
+            checked.append(room_id)
+            return room_id == "!open:example.org"
+
+        store = UndecryptedEvents(100, is_displayed)
+
+        for room_id in ("!open:example.org", "!other:example.org"):
+            for i in range(10):
+                store.add(room_id, FakeEvent(room_id + str(i), "a"))
+
+        store.resize(5)
+        assert len(store) == 5
+        assert sorted(checked) == ["!open:example.org", "!other:example.org"]
+
+    def test_size_is_tracked(self):
+        store = UndecryptedEvents()
+        store.add("!room:example.org", FakeEvent("$1", "a"))
+        store.add("!room:example.org", FakeEvent("$2", "a"))
+        assert store.size == 2 * len("ciphertext")
+
+        store.remove_room("!room:example.org")
+        assert store.size == 0
+        assert store.room_count == 0
@@ -0,0 +1,98 @@
+import select
+import threading
+
+import pytest
+
+from matrix.workers import WorkerPool, WorkerPoolShutdown
+from matrix._weechat import MockConfig
+import matrix.globals as G
+
+G.CONFIG = MockConfig()
+
+
+class TestClass(object):
+    def test_results_are_dispatched_in_order(self):
+        pool = WorkerPool("test", 2)
+        results = []
+
+        for i in range(10):
+            pool.submit(
+                lambda x: x * 2,
+                (i,),
+                lambda result, error: results.append((result, error)),
+                "same-key"
+            )
+
+        while len(results) < 10:
+            select.select([pool._read_fd], [], [], 1)
+            pool.dispatch()
+
+        pool.shutdown()
+
+        assert results == [(i * 2, None) for i in range(10)]
+
+    def test_errors_are_passed_to_the_callback(self):
+        pool = WorkerPool("test", 1)
+        results = []
+
+        def fail():
+            raise ValueError("failed")
+
+        pool.submit(fail, (), lambda *args: results.append(args))
+
+        while not results:
+            select.select([pool._read_fd], [], [], 1)
+            pool.dispatch()
+
+        pool.shutdown()
+
+        result, error = results[0]
+        assert result is None
+        assert isinstance(error, ValueError)
+
+    def test_failing_callback_keeps_the_pool_awake(self):
+        pool = WorkerPool("test", 1)
+        results = []
+
+        def fail(result, error):
+            raise ValueError("callback failed")
+
+        pool.submit(lambda: 1, (), fail, "same-key")
+        pool.submit(lambda: 2, (), lambda *args: results.append(args),
+                    "same-key")
+
+        while len(pool._results) < 2:
+            select.select([pool._read_fd], [], [], 1)
+
+        with pytest.raises(ValueError):
+            pool.dispatch()
+
+        # The remaining result is dispatched on the next wakeup.
+        readable, _, _ = select.select([pool._read_fd], [], [], 1)
+        assert readable
+        pool.dispatch()
+        pool.shutdown()
+
+        assert results == [(2, None)]
+
+    def test_shutdown_cancels_pending_jobs(self):
+        pool = WorkerPool("test", 1)
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def block():
+            started.set()
+            release.wait()
+            return "done"
+
+        pool.submit(block, (), lambda *args: results.append(args))
+        pool.submit(lambda: 1, (), lambda *args: results.append(args))
+
+        started.wait()
+        threading.Timer(0.1, release.set).start()
+        pool.shutdown()
+
+        assert results[0] == ("done", None)
+        assert results[1][0] is None
+        assert isinstance(results[1][1], WorkerPoolShutdown)